@@ -60,6 +60,12 @@ class Board(object):
             logging.error('packet count of %i outside of expected range', packet_count)
             packet_count = 1
         self.interface.setPacketCount(packet_count)
+        packet_size = self.getPacketSize()
+        logging.info("board packet size is %i bytes", packet_size)
+        if packet_size < 64:
+            logging.error('packet size of %i outside of expected range', packet_size)
+            packet_size = 64
+        self.interface.setPacketSize(packet_size)
         self.transport.init(self.debug_clock_frequency)
         self.target.init()
         
@@ -93,8 +99,30 @@ class Board(object):
     def getInfo(self):
         return self.interface.getInfo()
 
+    def getStatistics(self):
+        """
+        Return a dict of the performance counters and histograms of the
+        interface, transport and target layers.
+        """
+        return {
+            'interface' : self.interface.getStatistics(),
+            'transport' : self.transport.getStatistics(),
+            'target' : self.target.getStatistics(),
+            }
+
+    def resetStatistics(self):
+        self.interface.resetStatistics()
+        self.transport.resetStatistics()
+        self.target.resetStatistics()
+
     def getPacketCount(self):
         """
         Return the number of commands the remote device's buffer can hold.
         """
         return 1
+
+    def getPacketSize(self):
+        """
+        Return the size in bytes of a single packet the remote device accepts.
+        """
+        return self.interface.getPacketSize()
@@ -135,9 +135,11 @@ class MbedBoard(Board):
         
     @staticmethod
     def getAllConnectedBoards(transport = "cmsis_dap", close = False, blocking = True,
-                                target_override = None, frequency = 1000000):
+                                target_override = None, frequency = 1000000, exclude = ()):
         """
-        Return an array of all mbed boards connected
+        Return an array of all mbed boards connected, except those whose
+        unique id is in exclude.  Excluded boards are not opened, so they
+        may be in use.
         """
         first = True
         while True:
@@ -148,7 +150,7 @@ class MbedBoard(Board):
                     # exception comes in there will be no resources to close
                     sleep(0.2)
             
-                all_mbeds = INTERFACE[usb_backend].getAllConnectedInterface(mbed_vid, mbed_pid)
+                all_mbeds = INTERFACE[usb_backend].getAllConnectedInterface(mbed_vid, mbed_pid, exclude)
                 if all_mbeds == None:
                     all_mbeds = []
                 
@@ -196,6 +198,13 @@ class MbedBoard(Board):
                 logging.info("Waiting for a USB device connected")
                 first = False
     
+    @staticmethod
+    def getConnectedBoardIDs():
+        """
+        Return the unique ids of the connected boards without opening them.
+        """
+        return INTERFACE[usb_backend].getConnectedSerialNumbers(mbed_vid, mbed_pid)
+
     @staticmethod
     def chooseBoard(transport = "cmsis_dap", blocking = True, return_first = False, board_id = None, target_override = None, frequency = 1000000, init_board = True):
         """
@@ -268,8 +277,42 @@ class MbedBoard(Board):
                 raise
         return mbed
 
+    @staticmethod
+    def chooseBoards(transport = "cmsis_dap", board_ids = None, target_override = None, frequency = 1000000):
+        """
+        Return the connected boards with the given unique ids, or all
+        connected boards if board_ids is None.  The interfaces of the other
+        boards are closed.  The boards are not initialized.
+        """
+        all_mbeds = MbedBoard.getAllConnectedBoards(transport, False, False, target_override, frequency)
+        if board_ids is None:
+            return all_mbeds
+
+        selected = []
+        for mbed in all_mbeds:
+            if mbed.unique_id in board_ids:
+                selected.append(mbed)
+            else:
+                mbed.interface.close()
+        found = [mbed.unique_id for mbed in selected]
+        for board_id in board_ids:
+            if board_id not in found:
+                print("Board %s is not connected" % board_id)
+        # Keep the order requested
+        selected.sort(key=lambda mbed: board_ids.index(mbed.unique_id))
+        return selected
+
     def getPacketCount(self):
         """
         Return the number of commands the remote device's buffer can hold.
         """
         return self.transport.info('PACKET_COUNT')
+
+    def getPacketSize(self):
+        """
+        Return the size in bytes of a single packet the remote device accepts.
+        """
+        packet_size = self.transport.info('PACKET_SIZE')
+        if packet_size is None:
+            return self.interface.getPacketSize()
+        return packet_size
@@ -17,14 +17,50 @@
 
 from pyOCD.target.target import TARGET_RUNNING
 import logging
-from struct import unpack
-from time import time
+from time import time, sleep
 from flash_builder import FLASH_PAGE_ERASE, FLASH_CHIP_ERASE, FlashBuilder
 
 DEFAULT_PAGE_PROGRAM_WEIGHT = 0.130
 DEFAULT_PAGE_ERASE_WEIGHT   = 0.048
 DEFAULT_CHIP_ERASE_WEIGHT   = 0.174
 
+# A flash algo function times out after FLASH_TIMEOUT_FACTOR times its
+# expected duration, but not before FLASH_MIN_TIMEOUT seconds
+FLASH_TIMEOUT_FACTOR = 10
+FLASH_MIN_TIMEOUT = 5.0
+# Rate at which the analyzer computes CRCs, used for its expected duration
+ANALYZER_B_PER_S = 1000 * 1000
+# Number of reads the probe retries per completion check with value match
+MIN_MATCH_RETRY = 8
+MAX_MATCH_RETRY = 1024
+# Time between completion checks when the probe can't wait for the halt
+MIN_POLL_INTERVAL = 0.0005
+MAX_POLL_INTERVAL = 0.05
+
+class FlashTimeoutError(RuntimeError):
+    """
+    A flash algo function did not return in time
+    """
+    pass
+
+# Program to erase the sectors from r0 up to r1, r2 bytes at a time, by calling
+# the erase sector function in r3.  It returns the first error or 0.  This works
+# on cortex-m processors.
+# It runs from the top of the flash algo's stack: sp must point at the program
+# when called, and the program moves sp above itself before returning.
+#   push {r3-r7, lr}; mov r4, r0; mov r5, r1; mov r6, r2; mov r7, r3
+# loop:
+#   cmp r4, r5; bhs done; mov r0, r4; blx r7; cmp r0, #0; bne out
+#   adds r4, r4, r6; b loop
+# done:
+#   movs r0, #0
+# out:
+#   pop {r2, r4-r7}; pop {r3}; add sp, #48; bx r3
+erase_range_stub = (
+    0x4604b5f8, 0x4616460d, 0x42ac461f, 0x4620d205, 0x280047b8, 0x19a4d102, 0x2000e7f7, 0xbc08bcf4,
+    0x4718b00c, 0xbf00bf00, 0xbf00bf00, 0xbf00bf00,
+    );
+
 # Program to compute the CRC of sectors.  This works on cortex-m processors.
 # Code is relocatable and only needs to be on a 4 byte boundary.
 # 200 bytes of executable data below + 1024 byte crc table = 1224 bytes
@@ -80,6 +116,11 @@ class Flash(object):
         self.target = target
         self.flash_algo = flash_algo
         self.flash_algo_debug = False
+        self.timeout = None
+        self.overall_timeout = None
+        self.deadline = None
+        self._operation = None
+        self._operation_start = None
         if flash_algo is not None:
             self.end_flash_algo = flash_algo['load_address'] + len(flash_algo)*4
             self.begin_stack = flash_algo['begin_stack']
@@ -113,6 +154,7 @@ class Flash(object):
         self.target.setTargetState("PROGRAM")
 
         # update core register to execute the init subroutine
+        self._expectOperation("init", 0)
         result = self.callFunctionAndWait(self.flash_algo['pc_init'], init=True)
 
         # check the return code
@@ -137,6 +179,8 @@ class Flash(object):
         self.target.writeBlockMemoryAligned32(self.begin_data, data)
 
         # update core register to execute the subroutine
+        self._expectOperation("computeCrcs(%i sectors)" % len(data),
+                              float(sum(size for addr, size in sectors)) / ANALYZER_B_PER_S)
         result = self.callFunctionAndWait(self.flash_algo['analyzer_address'], self.begin_data, len(data))
 
         # Read back the CRCs for each section
@@ -149,6 +193,7 @@ class Flash(object):
         """
 
         # update core register to execute the eraseAll subroutine
+        self._expectOperation("eraseAll", self.getFlashInfo().erase_weight)
         result = self.callFunctionAndWait(self.flash_algo['pc_eraseAll'])
 
         # check the return code
@@ -161,12 +206,55 @@ class Flash(object):
         """
 
         # update core register to execute the erasePage subroutine
+        self._expectOperation("erasePage(0x%x)" % flashPtr, self.getPageInfo(flashPtr).erase_weight)
         result = self.callFunctionAndWait(self.flash_algo['pc_erase_sector'], flashPtr)
 
         # check the return code
         if result != 0:
             logging.error('erasePage(0x%x) error: %i', flashPtr, result)
 
+    def startErasePage(self, flashPtr):
+        """
+        Start erasing one page. Use waitForCompletion to get the result.
+        """
+
+        # update core register to execute the erasePage subroutine
+        self._expectOperation("erasePage(0x%x)" % flashPtr, self.getPageInfo(flashPtr).erase_weight)
+        self.callFunction(self.flash_algo['pc_erase_sector'], flashPtr)
+
+    def eraseRange(self, start, end):
+        """
+        Erase the pages from start up to end with a single call
+        """
+        self.startEraseRange(start, end)
+        result = self.waitForCompletion()
+
+        # check the return code
+        if result != 0:
+            logging.error('eraseRange(0x%x..0x%x) error: %i', start, end, result)
+
+    def startEraseRange(self, start, end):
+        """
+        Start erasing the pages from start up to end, which must all have
+        the same size. Use waitForCompletion to get the result.
+
+        The flash algo's pc_erase_range function is used if it has one.
+        Otherwise a program that calls pc_erase_sector for each page is
+        loaded at the top of the stack.
+        """
+        page_info = self.getPageInfo(start)
+        self._expectOperation("eraseRange(0x%x..0x%x)" % (start, end),
+                              page_info.erase_weight * (end - start) / page_info.size)
+        if 'pc_erase_range' in self.flash_algo:
+            self.callFunction(self.flash_algo['pc_erase_range'], start, end)
+            return
+
+        stub_addr = self.begin_stack - len(erase_range_stub) * 4
+        self.target.writeBlockMemoryAligned32(stub_addr, erase_range_stub)
+        page_size = page_info.size
+        # The stub calls the erase function with BLX, which needs the Thumb bit
+        self.callFunction(stub_addr | 1, start, end, page_size, self.flash_algo['pc_erase_sector'] | 1, sp=stub_addr)
+
     def programPage(self, flashPtr, bytes):
         """
         Flash one page
@@ -176,12 +264,13 @@ class Flash(object):
         bytes = self.overrideSecurityBits(flashPtr, bytes)
 
         # first transfer in RAM
-        self.target.writeBlockMemoryUnaligned8(self.begin_data, bytes)
+        self.target.writeMemoryBytes(self.begin_data, bytes)
 
         # get info about this page
         page_info = self.getPageInfo(flashPtr)
 
         # update core register to execute the program_page subroutine
+        self._expectOperation("programPage(0x%x)" % flashPtr, page_info.program_weight)
         result = self.callFunctionAndWait(self.flash_algo['pc_program_page'], flashPtr, page_info.size, self.begin_data)
 
         # check the return code
@@ -204,6 +293,7 @@ class Flash(object):
         page_info = self.getPageInfo(flashPtr)
 
         # update core register to execute the program_page subroutine
+        self._expectOperation("programPage(0x%x)" % flashPtr, page_info.program_weight)
         result = self.callFunction(self.flash_algo['pc_program_page'], flashPtr, page_info.size, self.page_buffers[bufferNumber])
 
     def loadPageBuffer(self, bufferNumber, flashPtr, bytes):
@@ -213,7 +303,7 @@ class Flash(object):
         bytes = self.overrideSecurityBits(flashPtr, bytes)
 
         # transfer the buffer to device RAM
-        self.target.writeBlockMemoryUnaligned8(self.page_buffers[bufferNumber], bytes)
+        self.target.writeMemoryBytes(self.page_buffers[bufferNumber], bytes)
 
     def programPhrase(self, flashPtr, bytes):
         """
@@ -234,10 +324,11 @@ class Flash(object):
         bytes = self.overrideSecurityBits(flashPtr, bytes)
 
         # first transfer in RAM
-        self.target.writeBlockMemoryUnaligned8(self.begin_data, bytes)
+        self.target.writeMemoryBytes(self.begin_data, bytes)
 
         # update core register to execute the program_page subroutine
-        result = self.callFunctionAndWait(self.flash_algo['pc_program_page'], flashPtr, bytes_len, self.begin_data)
+        self._expectOperation("programPhrase(0x%x)" % flashPtr, self.getPageInfo(flashPtr).program_weight)
+        result = self.callFunctionAndWait(self.flash_algo['pc_program_page'], flashPtr, len(bytes), self.begin_data)
 
         # check the return code
         if result != 0:
@@ -294,14 +385,11 @@ class Flash(object):
         if flashPtr is None:
             flashPtr = self.getFlashInfo().rom_start
 
-        f = open(path_file, "rb")
-
         with open(path_file, "rb") as f:
-            data = f.read()
-        data = unpack(str(len(data)) + 'B', data)
+            data = bytearray(f.read())
         self.flashBlock(flashPtr, data, smart_flash, chip_erase, progress_cb, fast_verify)
 
-    def callFunction(self, pc, r0=None, r1=None, r2=None, r3=None, init=False):
+    def callFunction(self, pc, r0=None, r1=None, r2=None, r3=None, init=False, sp=None):
         reg_list = []
         data_list = []
 
@@ -338,17 +426,73 @@ class Flash(object):
         if init:
             reg_list.append('sp')
             data_list.append(self.begin_stack)
+        elif sp is not None:
+            reg_list.append('sp')
+            data_list.append(sp)
         reg_list.append('lr')
         data_list.append(self.flash_algo['load_address'] + 1)
         self.target.writeCoreRegistersRaw(reg_list, data_list)
 
         # resume target
         self.target.resume()
+        self._operation_start = time()
+
+    def _expectOperation(self, description, expected):
+        """
+        Describe the next function call and give its expected duration in
+        seconds, used for its timeout and polling interval.
+        """
+        self._operation = (description, expected)
+
+    def setTimeout(self, timeout):
+        """
+        Set the number of seconds each flash algo function may run for, or
+        None to derive it from the function's expected duration.
+        """
+        self.timeout = timeout
+
+    def setDeadline(self, timeout):
+        """
+        Raise a FlashTimeoutError if a flash algo function is still running
+        timeout seconds from now. None removes the deadline.
+        """
+        self.overall_timeout = timeout
+        self.deadline = time() + timeout if timeout is not None else None
 
     ## @brief Wait until the breakpoint is hit.
+    #
+    # The probe waits for S_HALT with value match reads where the transport
+    # supports it. Otherwise each check is a single read and the core is
+    # polled at an interval that grows up to an eighth of the expected
+    # duration of the function.
     def waitForCompletion(self):
-        while(self.target.getState() == TARGET_RUNNING):
-            pass
+        description, expected = self._operation or ("function", 0)
+        self._operation = None
+        timeout = self.timeout
+        if timeout is None:
+            timeout = max(FLASH_MIN_TIMEOUT, expected * FLASH_TIMEOUT_FACTOR)
+        deadline = self._operation_start + timeout
+
+        retry = MIN_MATCH_RETRY
+        interval = MIN_POLL_INTERVAL
+        max_interval = min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, expected / 8))
+        while True:
+            check_start = time()
+            if self.target.waitForHalt(retry):
+                break
+            now = time()
+            if self.deadline is not None and now > self.deadline:
+                self._timedOut("Flash operation did not complete within %.3f s, timed out in %s" %
+                               (self.overall_timeout, description))
+            if now > deadline:
+                self._timedOut("Flash algo %s did not complete within %.3f s" % (description, timeout))
+
+            # Sleep for what is left of the interval after the check
+            remaining = interval - (now - check_start)
+            if remaining > 0:
+                sleep(remaining)
+            retry = min(retry * 2, MAX_MATCH_RETRY)
+            interval = min(interval * 2, max_interval)
 
         if self.flash_algo_debug:
             analyzer_supported = self.flash_algo['analyzer_supported']
@@ -393,6 +537,15 @@ class Flash(object):
 
         return self.target.readCoreRegister('r0')
 
+    def _timedOut(self, message):
+        # Stop the function so the target can be used again
+        self.target.halt()
+        pc = self.target.readCoreRegister('pc')
+        if self.flash_algo_debug:
+            self.target.setVectorCatchFault(self._vector_catch_enabled)
+            self.target.setVectorCatchReset(self._reset_catch_enabled)
+        raise FlashTimeoutError("%s; halted at pc 0x%08x" % (message, pc))
+
     def callFunctionAndWait(self, pc, r0=None, r1=None, r2=None, r3=None, init=False):
         self.callFunction(pc, r0, r1, r2, r3, init)
         return self.waitForCompletion()
@@ -17,7 +17,14 @@
 
 from pyOCD.target.target import TARGET_RUNNING
 import logging
-from struct import unpack
+import os
+import json
+import base64
+import bisect
+import hashlib
+import threading
+from collections import OrderedDict
+from struct import pack, unpack
 from time import time
 from binascii import crc32
 
@@ -33,6 +40,21 @@ FLASH_ANALYSIS_PARTIAL_PAGE_READ = "PAGE_READ"
 PAGE_ESTIMATE_SIZE = 32
 PAGE_READ_WEIGHT = 0.3
 DATA_TRANSFER_B_PER_S = 40 * 1000 # ~40KB/s, depends on clock speed, theoretical limit for HID is 56,000 B/s
+ALGO_CALL_WEIGHT = 0.004 # Time to start a flash algo function and poll for its completion
+
+# Default size of the chunks compared by delta programming. Must be a power of 2.
+DELTA_CHUNK_SIZE = 256
+
+# Stages of pipelined programming
+PIPELINE_ERASE = "erase"
+PIPELINE_LOAD = "load"
+PIPELINE_PROGRAM = "program"
+PIPELINE_STALL = "stall"                # Loads while the target waits
+
+# Version of the serialized FlashPlan format
+FLASH_PLAN_VERSION = 1
+# Directory of the on disk flash plan cache, if set
+FLASH_PLAN_CACHE_ENV = 'PYOCD_FLASH_PLAN_CACHE'
 
 class ProgrammingInfo(object):
     def __init__(self):
@@ -40,23 +62,32 @@ class ProgrammingInfo(object):
         self.program_time = None                # Total programming time
         self.analyze_type = None                # Type of flash analysis performed - FLASH_ANALYSIS_CRC32 or FLASH_ANALYSIS_PARTIAL_PAGE_READ
         self.analyze_time = None                # Time to analyze flash contents
+        self.program_byte_count = None          # Number of bytes programmed
+        self.skipped_byte_count = None          # Number of bytes not programmed because they were already the same
+        self.delta_page_count = None            # Number of pages partially programmed without an erase
+        self.stage_time = None                  # Time spent in each stage of pipelined programming
+        self.stage_utilization = None           # Fraction of the pipelined programming time spent in each stage
 
 def _same( d1, d2 ):
     assert len(d1) == len(d2)
-    for i in range(len(d1)):
-        if d1[i] != d2[i]:
-            return False
-    return True
+    return bytearray(d1) == bytearray(d2)
 
 def _erased( d ):
-    for i in range(len(d)):
-        if d[i] != 0xFF:
-            return False
-    return True
+    d = bytearray(d)
+    return d.count('\xff') == len(d)
 
 def _stub_progress(percent):
     pass
 
+def _page_crc(data, size):
+    # CRC of page data padded with 0xFF to the page size, as computed
+    # by the analyzer on the target
+    data = bytearray(data)
+    pad_size = size - len(data)
+    if pad_size > 0:
+        data.extend('\xff' * pad_size)
+    return crc32(data) & 0xFFFFFFFF
+
 class flash_page(object):
     def __init__(self, addr, size, data, erase_weight, program_weight):
         self.addr = addr
@@ -66,20 +97,25 @@ class flash_page(object):
         self.program_weight = program_weight
         self.erased = None
         self.same = None
+        self.crc = None
+        self.delta_bytes = None
+        self.batched_erase = False      # Erased by the same call as the previous page
 
     def getProgramWeight(self):
         """
         Get time to program a page including the data transfer
         """
-        return self.program_weight + \
+        return self.program_weight + ALGO_CALL_WEIGHT + \
             float(len(self.data)) / float(DATA_TRANSFER_B_PER_S)
 
     def getEraseProgramWeight(self):
         """
         Get time to erase and program a page including data transfer time
         """
-        return self.erase_weight + self.program_weight + \
-            float(len(self.data)) / float(DATA_TRANSFER_B_PER_S)
+        erase_weight = self.erase_weight
+        if not self.batched_erase:
+            erase_weight += ALGO_CALL_WEIGHT
+        return erase_weight + self.getProgramWeight()
 
     def getVerifyWeight(self):
         """
@@ -92,15 +128,243 @@ class flash_operation(object):
         self.addr = addr
         self.data = data
 
+## @brief Page of a FlashPlan.
+#
+# holes lists the (offset, length) ranges of data between flash operations
+# that keep the current flash contents. They are read from the target when
+# the page is programmed, so the CRC and erased state of a page with holes
+# are only known then.
+class plan_page(object):
+    def __init__(self, addr, size, erase_weight, program_weight):
+        self.addr = addr
+        self.size = size
+        self.erase_weight = erase_weight
+        self.program_weight = program_weight
+        self.data = bytearray()
+        self.holes = []
+        self.crc = None
+        self.erased = None
+
+## @brief Host side work of programming an image.
+#
+# The plan splits the flash operations into pages and computes the CRC and
+# erased state of each page once. It does not access the target, so one plan
+# can be shared by the builders of all boards of the same target type.
+#
+# Plans are identified by a key made of the target type and a hash of the
+# flash operations, and can be serialized with toDict so a FlashPlanCache
+# can keep them across runs.
+class FlashPlan(object):
+    def __init__(self, pages, key = None):
+        self.pages = pages
+        self.key = key
+
+    @staticmethod
+    def getKey(flash, operation_list):
+        """
+        Return the key of the plan for operation_list on flash's target type.
+        """
+        digest = hashlib.sha1()
+        for operation in operation_list:
+            digest.update(pack('<II', operation.addr, len(operation.data)))
+            digest.update(bytearray(operation.data))
+        return "%s_%s" % (type(flash.target).__name__.lower(), digest.hexdigest())
+
+    @staticmethod
+    def build(flash, operation_list, key = None):
+        """
+        Split the sorted flash operations into pages.
+        """
+        plan = FlashPlan([], key)
+        if not operation_list:
+            return plan
+
+        flash_addr = operation_list[0].addr
+        info = flash.getPageInfo(flash_addr)
+        page_addr = flash_addr - (flash_addr % info.size)
+        current_page = plan_page(page_addr, info.size, info.erase_weight, info.program_weight)
+        plan.pages.append(current_page)
+        for operation in operation_list:
+            pos = 0
+            while pos < len(operation.data):
+
+                # Check if operation is in next page
+                flash_addr = operation.addr + pos
+                if flash_addr >= current_page.addr + current_page.size:
+                    info = flash.getPageInfo(flash_addr)
+                    page_addr = flash_addr - (flash_addr % info.size)
+                    current_page = plan_page(page_addr, info.size, info.erase_weight, info.program_weight)
+                    plan.pages.append(current_page)
+
+                # Record the page gap if there is one
+                page_data_end = current_page.addr + len(current_page.data)
+                if flash_addr != page_data_end:
+                    gap = flash_addr - page_data_end
+                    current_page.holes.append((len(current_page.data), gap))
+                    current_page.data.extend('\xff' * gap)
+
+                # Copy data to page and increment pos
+                space_left_in_page = current_page.size - len(current_page.data)
+                space_left_in_data = len(operation.data) - pos
+                amount = min(space_left_in_page, space_left_in_data)
+                current_page.data.extend(operation.data[pos:pos+amount])
+
+                #increment position
+                pos += amount
+
+        for page in plan.pages:
+            if not page.holes:
+                page.crc = _page_crc(page.data, page.size)
+                page.erased = _erased(page.data)
+        return plan
+
+    def toDict(self):
+        """
+        Return the plan as a dictionary that can be saved as JSON.
+        """
+        pages = []
+        for page in self.pages:
+            pages.append({
+                'addr' : page.addr,
+                'size' : page.size,
+                'erase_weight' : page.erase_weight,
+                'program_weight' : page.program_weight,
+                'data' : base64.b64encode(bytes(page.data)),
+                'holes' : page.holes,
+                'crc' : page.crc,
+                'erased' : page.erased,
+                })
+        return {'version' : FLASH_PLAN_VERSION, 'key' : self.key, 'pages' : pages}
+
+    @staticmethod
+    def fromDict(plan_dict):
+        """
+        Return the plan saved by toDict.
+        """
+        if plan_dict.get('version') != FLASH_PLAN_VERSION:
+            raise ValueError("Unsupported flash plan version %s" % plan_dict.get('version'))
+        pages = []
+        for page_dict in plan_dict['pages']:
+            page = plan_page(page_dict['addr'], page_dict['size'],
+                             page_dict['erase_weight'], page_dict['program_weight'])
+            page.data = bytearray(base64.b64decode(page_dict['data']))
+            page.holes = [tuple(hole) for hole in page_dict['holes']]
+            page.crc = page_dict['crc']
+            page.erased = page_dict['erased']
+            pages.append(page)
+        return FlashPlan(pages, plan_dict['key'])
+
+    def createPages(self, target):
+        """
+        Return new flash_page objects for programming target, with the
+        holes filled with the target's current flash contents.
+        """
+        pages = []
+        for planned in self.pages:
+            page = flash_page(planned.addr, planned.size, bytearray(planned.data),
+                              planned.erase_weight, planned.program_weight)
+            for offset, length in planned.holes:
+                page.data[offset:offset + length] = target.readMemoryBytes(planned.addr + offset, length)
+            page.crc = planned.crc
+            page.erased = planned.erased
+            pages.append(page)
+        return pages
+
+## @brief Cache of FlashPlans in memory and optionally on disk.
+#
+# The most recently used plans are kept in memory. If a directory is given,
+# each plan is also saved there as <key>.json so later runs can reuse it.
+class FlashPlanCache(object):
+    def __init__(self, directory = None, max_plans = 8):
+        self.directory = directory
+        self.max_plans = max_plans
+        self.plans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the plan with the given key, or None if it is not cached.
+        """
+        with self._lock:
+            plan = self.plans.pop(key, None)
+            if plan is None:
+                plan = self._load(key)
+            if plan is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.plans[key] = plan
+            return plan
+
+    def put(self, plan):
+        """
+        Add a plan to the cache.
+        """
+        with self._lock:
+            self.plans.pop(plan.key, None)
+            self.plans[plan.key] = plan
+            while len(self.plans) > self.max_plans:
+                self.plans.popitem(last = False)
+            self._save(plan)
+
+    def clear(self):
+        """
+        Drop the plans held in memory. Plans on disk are kept.
+        """
+        with self._lock:
+            self.plans.clear()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "r") as f:
+                plan = FlashPlan.fromDict(json.load(f))
+        except IOError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring invalid flash plan %s: %s", self._path(key), e)
+            return None
+        if plan.key != key:
+            return None
+        return plan
+
+    def _save(self, plan):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first so readers never see a partial plan
+            tmp_path = self._path(plan.key) + ".%i.tmp" % os.getpid()
+            with open(tmp_path, "w") as f:
+                json.dump(plan.toDict(), f)
+            os.rename(tmp_path, self._path(plan.key))
+        except (IOError, OSError) as e:
+            logging.warning("Unable to save flash plan: %s", e)
+
+# Cache used by default by all FlashBuilders
+plan_cache = FlashPlanCache(os.getenv(FLASH_PLAN_CACHE_ENV))
+
 class FlashBuilder(object):
 
     def __init__(self, flash, base_addr = 0):
         self.flash = flash
         self.flash_start = base_addr
         self.flash_operation_list = []
+        self.flash_operation_addrs = []
         self.page_list = []
+        self.plan = None
+        self.plan_cache = plan_cache
         self.perf = ProgrammingInfo()
         self.enable_double_buffering = True
+        self.enable_delta = False
+        self.delta_chunk_size = DELTA_CHUNK_SIZE
         self.max_errors = 10
 
     def enableDoubleBuffer(self, enable):
@@ -109,6 +373,25 @@ class FlashBuilder(object):
     def setMaxErrors(self, count):
         self.max_errors = count
 
+    def enableDeltaProgramming(self, enable, chunk_size = DELTA_CHUNK_SIZE):
+        """
+        Compare changed pages in chunks of chunk_size bytes and, where the
+        differing chunks are erased, program only those chunks instead of
+        erasing and programming the whole page.
+
+        Requires a flash algorithm with CRC support and a minimum program
+        length. chunk_size must be a power of 2.
+        """
+        assert chunk_size & (chunk_size - 1) == 0, "Chunk size must be a power of 2"
+        self.enable_delta = enable
+        self.delta_chunk_size = chunk_size
+
+    def setPlanCache(self, cache):
+        """
+        Set the FlashPlanCache to use, or None to always build the plan.
+        """
+        self.plan_cache = cache
+
     def addData(self, addr, data):
         """
         Add a block of data to be programmed
@@ -120,27 +403,65 @@ class FlashBuilder(object):
         if addr < self.flash_start:
             raise Exception("Invalid flash address 0x%x is before flash start 0x%x" % (addr, self.flash_start))
 
+        # Keep list sorted
+        operation = flash_operation(addr, data)
+        index = bisect.bisect_right(self.flash_operation_addrs, addr)
+
+        # Verify this does not overlap with its neighbours
+        if index > 0:
+            self._checkOverlap(self.flash_operation_list[index - 1], operation)
+        if index < len(self.flash_operation_list):
+            self._checkOverlap(operation, self.flash_operation_list[index])
+
         # Add operation to list
-        self.flash_operation_list.append(flash_operation(addr, data))
+        self.flash_operation_list.insert(index, operation)
+        self.flash_operation_addrs.insert(index, addr)
+        self.plan = None
 
-        # Keep list sorted
-        self.flash_operation_list = sorted(self.flash_operation_list, key=lambda operation: operation.addr)
-        # Verify this does not overlap
-        prev_flash_operation = None
-        for operation in self.flash_operation_list:
-            if prev_flash_operation != None:
-                if prev_flash_operation.addr + len(prev_flash_operation.data) > operation.addr:
-                    raise ValueError("Error adding data - Data at 0x%x..0x%x overlaps with 0x%x..0x%x"
-                            % (prev_flash_operation.addr, prev_flash_operation.addr + len(prev_flash_operation.data),
-                               operation.addr, operation.addr + len(operation.data)))
-            prev_flash_operation = operation
-
-    def program(self, chip_erase = None, progress_cb = None, smart_flash = True, fast_verify = False):
+    def _checkOverlap(self, prev_flash_operation, operation):
+        if prev_flash_operation.addr + len(prev_flash_operation.data) > operation.addr:
+            raise ValueError("Error adding data - Data at 0x%x..0x%x overlaps with 0x%x..0x%x"
+                    % (prev_flash_operation.addr, prev_flash_operation.addr + len(prev_flash_operation.data),
+                       operation.addr, operation.addr + len(operation.data)))
+
+    def getPlan(self):
+        """
+        Return the FlashPlan of the data added so far, building it if needed.
+        """
+        if self.plan is None:
+            if self.plan_cache is None:
+                self.plan = FlashPlan.build(self.flash, self.flash_operation_list)
+                return self.plan
+            key = FlashPlan.getKey(self.flash, self.flash_operation_list)
+            self.plan = self.plan_cache.get(key)
+            if self.plan is None:
+                self.plan = FlashPlan.build(self.flash, self.flash_operation_list, key)
+                self.plan_cache.put(self.plan)
+        return self.plan
+
+    def setPlan(self, plan):
+        """
+        Use a plan built for the same data and target type by another
+        builder, typically one programming another board.
+        """
+        self.plan = plan
+
+    def program(self, chip_erase = None, progress_cb = None, smart_flash = True, fast_verify = False, timeout = None):
         """
         Determine fastest method of flashing and then run flash programming.
 
         Data must have already been added with addData
+
+        If timeout is given a FlashTimeoutError is raised if programming
+        takes longer than timeout seconds.
         """
+        self.flash.setDeadline(timeout)
+        try:
+            return self._program(chip_erase, progress_cb, smart_flash, fast_verify)
+        finally:
+            self.flash.setDeadline(None)
+
+    def _program(self, chip_erase, progress_cb, smart_flash, fast_verify):
 
         # Assumptions
         # 1. Page erases must be on page boundaries ( page_erase_addr % page_size == 0 )
@@ -162,37 +483,7 @@ class FlashBuilder(object):
             return
 
         # Convert the list of flash operations into flash pages
-        flash_addr = self.flash_operation_list[0].addr
-        info = self.flash.getPageInfo(flash_addr)
-        page_addr = flash_addr - (flash_addr % info.size)
-        current_page = flash_page(page_addr, info.size, [], info.erase_weight, info.program_weight)
-        self.page_list.append(current_page)
-        for flash_operation in self.flash_operation_list:
-            pos = 0
-            while pos < len(flash_operation.data):
-
-                # Check if operation is in next page
-                flash_addr = flash_operation.addr + pos
-                if flash_addr >= current_page.addr + current_page.size:
-                    info = self.flash.getPageInfo(flash_addr)
-                    page_addr = flash_addr - (flash_addr % info.size)
-                    current_page = flash_page(page_addr, info.size, [], info.erase_weight, info.program_weight)
-                    self.page_list.append(current_page)
-
-                # Fill the page gap if there is one
-                page_data_end = current_page.addr + len(current_page.data)
-                if flash_addr != page_data_end:
-                    old_data = self.flash.target.readBlockMemoryUnaligned8(page_data_end, flash_addr - page_data_end)
-                    current_page.data.extend(old_data)
-
-                # Copy data to page and increment pos
-                space_left_in_page = info.size - len(current_page.data)
-                space_left_in_data = len(flash_operation.data) - pos
-                amount = min(space_left_in_page, space_left_in_data)
-                current_page.data.extend(flash_operation.data[pos:pos+amount])
-
-                #increment position
-                pos += amount
+        self.page_list = self.getPlan().createPages(self.flash.target)
 
         # If smart flash was set to false then mark all pages
         # as requiring programming
@@ -236,6 +527,9 @@ class FlashBuilder(object):
             logging.debug("Chip erase weight %f, Page erase weight %f" % (chip_erase_program_time, page_program_time))
             chip_erase = chip_erase_program_time < page_program_time
 
+        if not chip_erase and self.enable_delta and self.perf.analyze_type == FLASH_ANALYSIS_CRC32:
+            self._delta_program()
+
         if chip_erase:
             if self.flash.isDoubleBufferingSupported() and self.enable_double_buffering:
                 logging.debug("Using double buffer chip erase program")
@@ -249,12 +543,28 @@ class FlashBuilder(object):
             else:
                 flash_operation = self._page_erase_program(progress_cb)
 
+        # Flash contents changed underneath any cached memory
+        self.flash.target.invalidateMemoryCache()
         self.flash.target.resetStopOnReset()
 
         program_finish = time()
         self.perf.program_time = program_finish-program_start
         self.perf.program_type = flash_operation
 
+        # Count the bytes written against the bytes that were already the same
+        total_bytes = sum(len(page.data) for page in self.page_list)
+        if chip_erase:
+            programmed = [page for page in self.page_list if not page.erased]
+        else:
+            programmed = [page for page in self.page_list if page.same is False]
+        delta_pages = [page for page in self.page_list if page.delta_bytes is not None]
+        self.perf.program_byte_count = sum(len(page.data) for page in programmed) + \
+                                       sum(page.delta_bytes for page in delta_pages)
+        self.perf.skipped_byte_count = total_bytes - self.perf.program_byte_count
+        self.perf.delta_page_count = len(delta_pages)
+        logging.debug("Programmed %i bytes, skipped %i bytes", self.perf.program_byte_count,
+                      self.perf.skipped_byte_count)
+
         return self.perf
 
     def getPerformance(self):
@@ -290,6 +600,47 @@ class FlashBuilder(object):
             page_erase_min_weight += page.getVerifyWeight()
         return page_erase_min_weight
 
+    def _mark_batched_erases(self):
+        """
+        Mark the pages that will be erased by the same call as the page
+        before them.
+        """
+        for run in self._erase_runs([page for page in self.page_list if page.same is False]):
+            run[0].batched_erase = False
+            for page in run[1:]:
+                page.batched_erase = True
+
+    def _erase_runs(self, pages):
+        """
+        Split the sorted pages into runs of contiguous pages of the same size
+        that can be erased together.
+        """
+        runs = []
+        for page in pages:
+            if runs and runs[-1][-1].addr + runs[-1][-1].size == page.addr \
+                    and runs[-1][-1].size == page.size:
+                runs[-1].append(page)
+            else:
+                runs.append([page])
+        return runs
+
+    def _start_erase(self, run):
+        """
+        Start erasing a run of pages with one flash algo call.
+        """
+        if len(run) == 1:
+            self.flash.startErasePage(run[0].addr)
+        else:
+            self.flash.startEraseRange(run[0].addr, run[-1].addr + run[-1].size)
+
+    def _check_erase_result(self, run, result):
+        if result != 0:
+            if len(run) == 1:
+                logging.error('erasePage(0x%x) error: %i', run[0].addr, result)
+            else:
+                logging.error('eraseRange(0x%x..0x%x) error: %i', run[0].addr,
+                              run[-1].addr + run[-1].size, result)
+
     def _compute_page_erase_pages_and_weight_sector_read(self):
         """
         Estimate how many pages are the same.
@@ -305,12 +656,13 @@ class FlashBuilder(object):
             # Analyze pages that haven't been analyzed yet
             if page.same is None:
                 size = min(PAGE_ESTIMATE_SIZE, len(page.data))
-                data = self.flash.target.readBlockMemoryUnaligned8(page.addr, size)
+                data = self.flash.target.readMemoryBytes(page.addr, size)
                 page_same = _same(data, page.data[0:size])
                 if page_same is False:
                     page.same = False
 
         # Put together page and time estimate
+        self._mark_batched_erases()
         for page in self.page_list:
             if page.same is False:
                 page_erase_count += 1
@@ -347,11 +699,8 @@ class FlashBuilder(object):
                 sector_list.append((page.addr, page.size))
                 page_list.append(page)
                 # Compute CRC of data (Padded with 0xFF)
-                data = list(page.data)
-                pad_size = page.size - len(page.data)
-                if pad_size > 0:
-                    data.extend([0xFF] * pad_size)
-                page.crc = crc32(bytearray(data)) & 0xFFFFFFFF
+                if page.crc is None:
+                    page.crc = _page_crc(page.data, page.size)
 
         # Analyze pages
         page_erase_count = 0
@@ -366,6 +715,7 @@ class FlashBuilder(object):
                     page.same = False
 
         # Put together page and time estimate
+        self._mark_batched_erases()
         for page in self.page_list:
             if page.same is False:
                 page_erase_count += 1
@@ -381,6 +731,90 @@ class FlashBuilder(object):
         self.page_erase_weight = page_erase_weight
         return page_erase_count, page_erase_weight
 
+    def _delta_chunk_size(self, page):
+        """
+        Return the size of the chunks to compare in page, or None if the page
+        can't be programmed in parts.
+        """
+        min_len = self.flash.minimumProgramLength
+        if not min_len or (min_len & (min_len - 1)):
+            return None
+        size = max(self.delta_chunk_size, min_len)
+        if size >= page.size or page.size % size:
+            return None
+        return size
+
+    def _delta_program(self):
+        """
+        Program the changed chunks of pages that don't need an erase.
+
+        The target CRC of each chunk of a changed page is compared with the
+        CRC of the new data. If every chunk that differs is erased on the
+        target, the new data of those chunks is programmed with programPhrase
+        and the page is marked as the same so it is not erased. Other pages
+        are left for the page erase program.
+        """
+        chunk_list = []
+        for page in self.page_list:
+            if page.same is False:
+                size = self._delta_chunk_size(page)
+                if size is not None:
+                    for offset in range(0, len(page.data), size):
+                        chunk_list.append((page, offset, size))
+        if not chunk_list:
+            return
+
+        # The CRC commands and results share the page buffer, so limit
+        # each call to a page worth of words
+        batch_size = min(page.size for page, offset, size in chunk_list) // 4
+        crc_list = []
+        for i in range(0, len(chunk_list), batch_size):
+            batch = chunk_list[i:i + batch_size]
+            crc_list.extend(self.flash.computeCrcs([(page.addr + offset, size) for page, offset, size in batch]))
+
+        # Group the chunks of each page, keeping only those that differ
+        changes = {}
+        erased_crc = {}
+        for (page, offset, size), crc in zip(chunk_list, crc_list):
+            changed = changes.setdefault(page.addr, (page, []))[1]
+            if changed is None:
+                continue
+            data = bytearray(page.data[offset:offset + size])
+            if _page_crc(data, size) == crc:
+                continue
+            if size not in erased_crc:
+                erased_crc[size] = _page_crc(bytearray(), size)
+            if crc != erased_crc[size]:
+                # Old data in this chunk must be erased first
+                changes[page.addr] = (page, None)
+                continue
+            data.extend('\xff' * (size - len(data)))
+            # Merge adjacent chunks so they are programmed in one call
+            if changed and changed[-1][0] + len(changed[-1][1]) == offset:
+                changed[-1][1].extend(data)
+            else:
+                changed.append((offset, data))
+
+        for page, changed in changes.values():
+            if changed is None:
+                continue
+            for offset, data in changed:
+                self.flash.programPhrase(page.addr + offset, data)
+            page.same = True
+            page.delta_bytes = sum(len(data) for offset, data in changed)
+            logging.debug("Delta programmed %i bytes of page 0x%x", page.delta_bytes, page.addr)
+
+        # Update the page erase estimates for the pages left
+        self.page_erase_count = 0
+        self.page_erase_weight = 0
+        self._mark_batched_erases()
+        for page in self.page_list:
+            if page.same is False:
+                self.page_erase_count += 1
+                self.page_erase_weight += page.getEraseProgramWeight()
+            elif page.same is None:
+                self.page_erase_weight += page.getVerifyWeight()
+
     def _chip_erase_program(self, progress_cb = _stub_progress):
         """
         Program by first performing a chip erase.
@@ -399,17 +833,6 @@ class FlashBuilder(object):
         progress_cb(1.0)
         return FLASH_CHIP_ERASE
 
-    def _next_unerased_page(self, i):
-        if i >= len(self.page_list):
-            return None, i
-        page = self.page_list[i]
-        while page.erased:
-            i += 1
-            if i >= len(self.page_list):
-                return None, i
-            page = self.page_list[i]
-        return page, i+1
-
     def _chip_erase_program_double_buffer(self, progress_cb = _stub_progress):
         """
         Program by first performing a chip erase.
@@ -421,46 +844,8 @@ class FlashBuilder(object):
         self.flash.eraseAll()
         progress += self.flash.getFlashInfo().erase_weight
 
-        # Set up page and buffer info.
-        error_count = 0
-        current_buf = 0
-        next_buf = 1
-        page, i = self._next_unerased_page(0)
-        assert page is not None
-
-        # Load first page buffer
-        self.flash.loadPageBuffer(current_buf, page.addr, page.data)
-
-        while page is not None:
-            # Kick off this page program.
-            current_addr = page.addr
-            current_weight = page.getProgramWeight()
-            self.flash.startProgramPageWithBuffer(current_buf, current_addr)
-
-            # Get next page and load it.
-            page, i = self._next_unerased_page(i)
-            if page is not None:
-                self.flash.loadPageBuffer(next_buf, page.addr, page.data)
-
-            # Wait for the program to complete.
-            result = self.flash.waitForCompletion()
-
-            # check the return code
-            if result != 0:
-                logging.error('programPage(0x%x) error: %i', current_addr, result)
-                error_count += 1
-                if error_count > self.max_errors:
-                    logging.error("Too many page programming errors, aborting program operation")
-                    break
-
-            # Swap buffers.
-            temp = current_buf
-            current_buf = next_buf
-            next_buf = temp
-
-            # Update progress.
-            progress += current_weight
-            progress_cb(float(progress) / float(self.chip_erase_weight))
+        pages = [page for page in self.page_list if not page.erased]
+        self._pipelined_program(pages, False, progress, self.chip_erase_weight, progress_cb)
 
         progress_cb(1.0)
         return FLASH_CHIP_ERASE
@@ -470,33 +855,25 @@ class FlashBuilder(object):
         Program by performing sector erases.
         """
         actual_page_erase_count = 0
-        actual_page_erase_weight = 0
-        progress = 0
 
         progress_cb(0.0)
 
-        for page in self.page_list:
-
-            # If the page is not the same
-            if page.same is False:
-                progress += page.getEraseProgramWeight()
-
-            # Read page data if unknown - after this page.same will be True or False
-            if page.same is None:
-                data = self.flash.target.readBlockMemoryUnaligned8(page.addr, len(page.data))
-                page.same = _same(page.data, data)
-                progress += page.getVerifyWeight()
+        # Fill in same flag for all pages, so runs of changed pages are known
+        progress = self._scan_pages_for_same(progress_cb)
+        self._mark_batched_erases()
 
-            # Program page if not the same
-            if page.same is False:
-                self.flash.erasePage(page.addr)
+        # Erase each run of changed pages with one call then program them
+        for run in self._erase_runs([page for page in self.page_list if page.same is False]):
+            self._start_erase(run)
+            self._check_erase_result(run, self.flash.waitForCompletion())
+            for page in run:
                 self.flash.programPage(page.addr, page.data)
                 actual_page_erase_count += 1
-                actual_page_erase_weight += page.getEraseProgramWeight()
+                progress += page.getEraseProgramWeight()
 
-            # Update progress
-            if self.page_erase_weight > 0:
-                progress_cb(float(progress) / float(self.page_erase_weight))
+                # Update progress
+                if self.page_erase_weight > 0:
+                    progress_cb(float(progress) / float(self.page_erase_weight))
 
         progress_cb(1.0)
 
@@ -513,96 +890,134 @@ class FlashBuilder(object):
         count = 0
         same_count = 0
 
-        for page in self.page_list:
-            # Read page data if unknown - after this page.same will be True or False
-            if page.same is None:
-                data = self.flash.target.readBlockMemoryUnaligned8(page.addr, len(page.data))
-                page.same = _same(page.data, data)
-                progress += page.getVerifyWeight()
-                count += 1
-                if page.same:
-                    same_count += 1
+        # Read page data if unknown - after this page.same will be True or False
+        pages = [page for page in self.page_list if page.same is None]
+        future = None
+        if pages:
+            future = self.flash.target.readMemoryAsync(pages[0].addr, len(pages[0].data))
+        for i, page in enumerate(pages):
+            data = future.result()
+            # Start reading the next page while this one is compared
+            if i + 1 < len(pages):
+                next_page = pages[i + 1]
+                future = self.flash.target.readMemoryAsync(next_page.addr, len(next_page.data))
+            page.same = _same(page.data, data)
+            progress += page.getVerifyWeight()
+            count += 1
+            if page.same:
+                same_count += 1
 
-                # Update progress
-                progress_cb(float(progress) / float(self.page_erase_weight))
+            # Update progress
+            progress_cb(float(progress) / float(self.page_erase_weight))
         return progress
 
-    def _next_nonsame_page(self, i):
-        if i >= len(self.page_list):
-            return None, i
-        page = self.page_list[i]
-        while page.same:
-            i += 1
-            if i >= len(self.page_list):
-                return None, i
-            page = self.page_list[i]
-        return page, i+1
-
     def _page_erase_program_double_buffer(self, progress_cb = _stub_progress):
         """
         Program by performing sector erases.
         """
-        actual_page_erase_count = 0
-        actual_page_erase_weight = 0
-        progress = 0
-
         progress_cb(0.0)
 
         # Fill in same flag for all pages. This is done up front so we're not trying
         # to read from flash while simultaneously programming it.
         progress = self._scan_pages_for_same(progress_cb)
+        self._mark_batched_erases()
 
-        # Set up page and buffer info.
-        error_count = 0
-        current_buf = 0
-        next_buf = 1
-        page, i = self._next_nonsame_page(0)
-
-        # Make sure there are actually pages to program differently from current flash contents.
-        if page is not None:
-            # Load first page buffer
-            self.flash.loadPageBuffer(current_buf, page.addr, page.data)
-
-            while page is not None:
-                assert page.same is not None
-
-                # Kick off this page program.
-                current_addr = page.addr
-                current_weight = page.getEraseProgramWeight()
-                self.flash.erasePage(current_addr)
-                self.flash.startProgramPageWithBuffer(current_buf, current_addr) #, erase_page=True)
-                actual_page_erase_count += 1
-                actual_page_erase_weight += page.getEraseProgramWeight()
+        pages = [page for page in self.page_list if page.same is False]
+        self._pipelined_program(pages, True, progress, self.page_erase_weight, progress_cb)
+
+        progress_cb(1.0)
 
-                # Get next page and load it.
-                page, i = self._next_nonsame_page(i)
-                if page is not None:
-                    self.flash.loadPageBuffer(next_buf, page.addr, page.data)
+        logging.debug("Estimated page erase count: %i", self.page_erase_count)
+        logging.debug("Actual page erase count: %i", len(pages))
 
-                # Wait for the program to complete.
-                result = self.flash.waitForCompletion()
+        return FLASH_PAGE_ERASE
 
-                # check the return code
-                if result != 0:
-                    logging.error('programPage(0x%x) error: %i', current_addr, result)
-                    error_count += 1
-                    if error_count > self.max_errors:
-                        logging.error("Too many page programming errors, aborting program operation")
-                        break
+    def _pipelined_program(self, pages, erase, progress, total_weight, progress_cb):
+        """
+        Erase if requested and program pages as a pipeline.
+
+        The target runs one flash algorithm function at a time, an erase or
+        a program, started with callFunction. Each run of contiguous pages is
+        erased with one call. While the target runs, the host loads
+        the next page into a free page buffer. All of the algorithm's page
+        buffers are used, so the loads stay ahead of the target. A buffer is
+        free again once the program reading from it has completed.
+
+        The time spent in each stage is saved in the ProgrammingInfo. A load
+        overlapping an erase or program only counts as load time, so the
+        erase, program and load times add up to at most the pipeline time.
+        """
+        stage_time = {PIPELINE_ERASE : 0.0, PIPELINE_LOAD : 0.0, PIPELINE_PROGRAM : 0.0, PIPELINE_STALL : 0.0}
+        free_buffers = range(self.flash.getPageBufferCount())
+        loaded = {}                 # Page index to the buffer holding its data
+        next_load = [0]
+        error_count = 0
+        pipeline_start = time()
+
+        def load_next():
+            buffer_number = free_buffers.pop(0)
+            page = pages[next_load[0]]
+            start = time()
+            self.flash.loadPageBuffer(buffer_number, page.addr, page.data)
+            stage_time[PIPELINE_LOAD] += time() - start
+            loaded[next_load[0]] = buffer_number
+            next_load[0] += 1
+
+        operations = []
+        index = 0
+        for run in (self._erase_runs(pages) if erase else [pages]):
+            if erase:
+                operations.append((PIPELINE_ERASE, run, None))
+            for page in run:
+                operations.append((PIPELINE_PROGRAM, run, index))
+                index += 1
+
+        for stage, run, index in operations:
+
+            # The target waits if the page to program hasn't been loaded yet
+            if stage == PIPELINE_PROGRAM and index not in loaded:
+                start = time()
+                load_next()
+                stage_time[PIPELINE_STALL] += time() - start
+
+            start = time()
+            if stage == PIPELINE_ERASE:
+                self._start_erase(run)
+            else:
+                page = pages[index]
+                self.flash.startProgramPageWithBuffer(loaded[index], page.addr)
+            busy = time() - start
 
-                # Swap buffers.
-                temp = current_buf
-                current_buf = next_buf
-                next_buf = temp
+            # Load the next page while the target is busy
+            if free_buffers and next_load[0] < len(pages):
+                load_next()
 
-                # Update progress
-                progress += current_weight
-                if self.page_erase_weight > 0:
-                    progress_cb(float(progress) / float(self.page_erase_weight))
+            start = time()
+            result = self.flash.waitForCompletion()
+            stage_time[stage] += busy + time() - start
 
-        progress_cb(1.0)
+            if stage == PIPELINE_PROGRAM:
+                free_buffers.append(loaded.pop(index))
+                if erase:
+                    progress += page.getEraseProgramWeight()
+                else:
+                    progress += page.getProgramWeight()
+                if total_weight > 0:
+                    progress_cb(float(progress) / float(total_weight))
 
-        logging.debug("Estimated page erase count: %i", self.page_erase_count)
-        logging.debug("Actual page erase count: %i", actual_page_erase_count)
+            # check the return code
+            if result != 0:
+                if stage == PIPELINE_ERASE:
+                    self._check_erase_result(run, result)
+                else:
+                    logging.error('programPage(0x%x) error: %i', page.addr, result)
+                error_count += 1
+                if error_count > self.max_errors:
+                    logging.error("Too many page programming errors, aborting program operation")
+                    break
 
-        return FLASH_PAGE_ERASE
+        pipeline_time = time() - pipeline_start
+        self.perf.stage_time = stage_time
+        self.perf.stage_utilization = dict((stage, (busy / pipeline_time) if pipeline_time else 0.0)
+                                           for stage, busy in stage_time.items())
+        logging.debug("Pipeline time %f, stage utilization %s", pipeline_time, self.perf.stage_utilization)
@@ -0,0 +1,116 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import logging
+import threading
+import traceback
+from time import time
+
+## @brief Outcome of programming one board.
+class BoardProgramResult(object):
+    def __init__(self, board):
+        self.unique_id = board.getUniqueID()
+        self.target_type = board.getTargetType()
+        self.passed = False
+        self.error = None
+        self.perf = None                # ProgrammingInfo from the FlashBuilder
+        self.connect_time = None        # Time to initialize the board
+        self.total_time = None          # Time from start to disconnect
+
+## @brief Program the same image into several boards concurrently.
+#
+# Each board is initialized, programmed and disconnected by its own worker
+# thread, so the USB round trips to the probes overlap. The FlashPlan, which
+# holds the page layout and CRCs of the image, is built once per target type
+# and shared by the workers.
+#
+# progress_cb, if given, is called as progress_cb(board, fraction) from the
+# worker threads.
+class MultiBoardProgrammer(object):
+    def __init__(self, boards, chip_erase = None, smart_flash = True, fast_verify = False,
+                 progress_cb = None, delta = False):
+        self.boards = boards
+        self.chip_erase = chip_erase
+        self.smart_flash = smart_flash
+        self.fast_verify = fast_verify
+        self.progress_cb = progress_cb
+        self.delta = delta
+        self.operations = []
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def addData(self, addr, data):
+        """
+        Add a block of data to program into every board.
+        """
+        self.operations.append((addr, data))
+
+    def program(self):
+        """
+        Program all boards and return a list of BoardProgramResult in the
+        order of the boards.
+        """
+        results = [BoardProgramResult(board) for board in self.boards]
+        threads = []
+        for board, result in zip(self.boards, results):
+            thread = threading.Thread(target = self._worker, args = (board, result),
+                                      name = "program %s" % board.getUniqueID())
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _getPlan(self, board, builder):
+        # Build each target type's plan once, with the first builder to ask
+        with self._lock:
+            plan = self._plans.get(board.getTargetType())
+            if plan is None:
+                plan = builder.getPlan()
+                self._plans[board.getTargetType()] = plan
+            return plan
+
+    def _worker(self, board, result):
+        start = time()
+        try:
+            board.init()
+            result.connect_time = time() - start
+            # Boost speed with deferred transfers
+            board.transport.setDeferredTransfer(True)
+
+            builder = board.flash.getFlashBuilder()
+            builder.enableDeltaProgramming(self.delta)
+            for addr, data in self.operations:
+                builder.addData(addr, data)
+            builder.setPlan(self._getPlan(board, builder))
+
+            progress = None
+            if self.progress_cb is not None:
+                progress = lambda fraction: self.progress_cb(board, fraction)
+            result.perf = builder.program(self.chip_erase, progress, self.smart_flash, self.fast_verify)
+            result.passed = True
+        except Exception as e:
+            result.error = e
+            logging.error("Programming board %s failed: %s", result.unique_id, e)
+            logging.debug(traceback.format_exc())
+        finally:
+            try:
+                board.uninit()
+            except Exception as e:
+                logging.error("Closing board %s failed: %s", result.unique_id, e)
+            result.total_time = time() - start
@@ -17,6 +17,32 @@
 
 import socket, select
 
+## @brief A client connection accepted by a listening GDBSocket.
+class GDBConnection(object):
+    def __init__(self, conn, packet_size):
+        self.conn = conn
+        self.packet_size = packet_size
+        # Send small RSP packets and acks without waiting to coalesce them
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def read(self):
+        return self.conn.recv(self.packet_size)
+
+    def write(self, data):
+        return self.conn.send(data)
+
+    def close(self):
+        return self.conn.close()
+
+    def setBlocking(self, blocking):
+        self.conn.setblocking(blocking)
+
+    def setTimeout(self, timeout):
+        self.conn.settimeout(timeout)
+
 class GDBSocket(object):
     def __init__(self, port, packet_size):
         self.packet_size = packet_size
@@ -39,6 +65,30 @@ class GDBSocket(object):
             self.conn, _ = self.s.accept()
         
         return self.conn
+
+    def listen(self):
+        """
+        Start listening for clients to accept() without blocking.
+        """
+        if self.s is None:
+            self.init()
+
+    def isListening(self):
+        return self.s is not None
+
+    def fileno(self):
+        return self.s.fileno()
+
+    def accept(self):
+        """
+        Accept a pending client and return it as a GDBConnection, or None
+        if the client went away.
+        """
+        try:
+            conn, _ = self.s.accept()
+        except socket.error:
+            return None
+        return GDBConnection(conn, self.packet_size)
     
     def read(self):
         return self.conn.recv(self.packet_size)
@@ -49,7 +99,9 @@ class GDBSocket(object):
     def close(self):
         if self.conn != None:
             self.conn.close()
-        return self.s.close()
+        if self.s is not None:
+            self.s.close()
+            self.s = None
     
     def setBlocking(self, blocking):
         self.conn.setblocking(blocking)
@@ -34,6 +34,9 @@ class GDBWebSocket(object):
             pass
         return self.wss
     
+    def fileno(self):
+        return self.wss.fileno()
+
     def read(self):
         return self.wss.recv()
     
@@ -15,20 +15,21 @@
  limitations under the License.
 """
 
-import logging, threading, socket
+import logging, threading, socket, select, collections
 from ..target.target import (TARGET_HALTED, BREAKPOINT_HW, BREAKPOINT_SW,
     WATCHPOINT_READ, WATCHPOINT_WRITE, WATCHPOINT_READ_WRITE)
 from ..transport import TransferError
-from ..utility.conversion import hexToByteList, hexEncode, hexDecode
-from struct import unpack
+from ..utility.conversion import hexEncode, hexDecode
+from ..utility.statistics import formatStatistics
 from time import sleep, time
 import sys
 from gdb_socket import GDBSocket
 from gdb_websocket import GDBWebSocket
 from syscall import GDBSyscallIOHandler
+import rsp
+from halt_watch import HALT_WATCH, DEFAULT_HALT_WATCH
 from ..target import semihost
 import traceback
-import Queue
 
 CTRL_C = '\x03'
 
@@ -37,35 +38,47 @@ LOG_MEM = False # Log memory accesses.
 LOG_ACK = False # Log ack or nak.
 LOG_PACKETS = False # Log all packets sent and received.
 
-def checksum(data):
-    return "%02x" % (sum([ord(c) for c in data]) % 256)
+# Longest time in seconds the server waits for input before checking for a
+# shutdown or restart request. Input itself is handled as soon as it arrives.
+SELECT_TIMEOUT = 0.2
+
+# Bounds for the packet size advertised to gdb. The size is a multiple of the
+# number of bytes the transport reads in one pipelined burst.
+MIN_PACKET_SIZE = 0x4000
+MAX_PACKET_SIZE = 0x10000
+
+checksum = rsp.checksum
 
 ## @brief Exception used to signal the GDB server connection closed.
 class ConnectionClosedException(Exception):
     pass
 
-## @brief Packet I/O thread.
+## @brief RSP packet I/O for one client connection.
 #
-# This class is a thread used by the GDBServer class to perform all RSP packet I/O. It
-# handles verifying checksums, acking, and receiving Ctrl-C interrupts. There is a queue
-# for received packets. The interface to this queue is the receive() method. The send()
-# method writes outgoing packets to the socket immediately.
-class GDBServerPacketIOThread(threading.Thread):
-    def __init__(self, abstract_socket):
-        super(GDBServerPacketIOThread, self).__init__(name="gdb-packet-thread")
+# This class performs the RSP packet I/O of one connection to the GDBServer. It handles
+# verifying checksums, acking, and receiving Ctrl-C interrupts. The server's event loop
+# calls poll() when the connection's socket is readable. Complete packets are appended,
+# together with the connection, to the command queue shared by all connections of the
+# server, so that commands reach the target one at a time in the order they arrived.
+# The receive() method takes the next packet of this connection from that queue. The
+# send() method writes outgoing packets to the socket immediately.
+class GDBServerConnection(object):
+    def __init__(self, abstract_socket, command_queue = None):
         self._abstract_socket = abstract_socket
-        self._receive_queue = Queue.Queue()
-        self._shutdown_event = threading.Event()
+        if command_queue is None:
+            command_queue = collections.deque()
+        self._command_queue = command_queue
         self.interrupt_event = threading.Event()
         self.send_acks = True
         self._clear_send_acks = False
-        self._buffer = ''
+        self._buffer = bytearray()
         self._expecting_ack = False
         self.drop_reply = False
         self._last_packet = ''
-        self._closed = False
-        self.setDaemon(True)
-        self.start()
+        self.closed = False
+
+    def fileno(self):
+        return self._abstract_socket.fileno()
 
     def set_send_acks(self, ack):
         if ack:
@@ -73,11 +86,16 @@ class GDBServerPacketIOThread(threading.Thread):
         else:
             self._clear_send_acks = True
 
-    def stop(self):
-        self._shutdown_event.set()
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self._abstract_socket.close()
+            except socket.error:
+                pass
 
     def send(self, packet):
-        if self._closed or not packet:
+        if self.closed or not packet:
             return
         if not self.drop_reply:
             self._last_packet = packet
@@ -86,75 +104,81 @@ class GDBServerPacketIOThread(threading.Thread):
             self.drop_reply = False
             logging.debug("GDB dropped reply %s", packet)
 
-    def receive(self, block=True):
-        if self._closed:
+    def notify(self, packet):
+        """
+        Write a notification packet. Notifications are not acked.
+        """
+        if not self.closed:
+            self._write(packet)
+
+    def receive(self):
+        """
+        Return the next packet received from this connection, or None if
+        there is none queued.
+        """
+        for index, (connection, packet) in enumerate(self._command_queue):
+            if connection is self:
+                del self._command_queue[index]
+                return packet
+        if self.closed:
             raise ConnectionClosedException()
-        while True:
-            try:
-                # If block is false, we'll get an Empty exception immediately if there
-                # are no packets in the queue. Same if block is true and it times out
-                # waiting on an empty queue.
-                return self._receive_queue.get(block, 0.1)
-            except Queue.Empty:
-                # Only exit the loop if block is false or connection closed.
-                if not block:
-                    return None
-                if self._closed:
-                    raise ConnectionClosedException()
-
-    def run(self):
-        self._abstract_socket.setTimeout(0.01)
-
-        while not self._shutdown_event.is_set():
-            try:
-                data = self._abstract_socket.read()
-
-                # Handle closed connection
-                if len(data) == 0:
-                    logging.debug("GDB packet thread: other side closed connection")
-                    self._closed = True
-                    break
-
-                if LOG_PACKETS:
-                    logging.debug('-->>>>>>>>>>>> GDB read %d bytes: %s', len(data), data)
-
-                self._buffer += data
-            except socket.error:
-                pass
+        return None
 
-            if self._shutdown_event.is_set():
-                break
+    def poll(self):
+        """
+        Read and process the data available on the socket. Only called
+        once the socket is readable, so the read does not block.
+        """
+        try:
+            data = self._abstract_socket.read()
+        except socket.error:
+            data = ''
+
+        # Handle closed connection
+        if len(data) == 0:
+            logging.debug("GDB connection: other side closed connection")
+            self.close()
+            return
 
-            self._process_data()
+        if LOG_PACKETS:
+            logging.debug('-->>>>>>>>>>>> GDB read %d bytes: %s', len(data), data)
 
-        logging.debug("GDB packet thread stopping")
+        self._buffer += data
+        self._process_data()
 
     def _write_packet(self, packet):
         if LOG_PACKETS:
             logging.debug('--<<<<<<<<<<<< GDB send %d bytes: %s', len(packet), packet)
 
-        # Make sure the entire packet is sent.
-        remaining = len(packet)
-        while remaining:
-            written = self._abstract_socket.write(packet)
-            remaining -= written
-            if remaining:
-                packet = packet[written:]
-
-        if self.send_acks:
+        if self._write(packet) and self.send_acks:
             self._expecting_ack = True
 
-    def _check_expected_ack(self):
-        # Handle expected ack.
-        c = self._buffer[0]
+    def _write(self, data):
+        # Make sure the entire data is sent. Returns False if the connection failed.
+        remaining = len(data)
+        try:
+            while remaining:
+                written = self._abstract_socket.write(data)
+                remaining -= written
+                if remaining:
+                    data = data[written:]
+        except socket.error:
+            logging.debug("GDB connection: write failed, closing")
+            self.close()
+            return False
+        return True
+
+    def _check_expected_ack(self, pos):
+        # Handle expected ack. Returns the buffer offset after the ack.
+        c = chr(self._buffer[pos])
         if c in ('+', '-'):
-            self._buffer = self._buffer[1:]
+            pos += 1
             if LOG_ACK:
                 logging.debug('got ack: %s', c)
             if c == '-':
                 # Handle nack from gdb
                 self._write_packet(self._last_packet)
-                return
+                return pos
 
             # Handle disabling of acks.
             if self._clear_send_acks:
@@ -162,52 +186,62 @@ class GDBServerPacketIOThread(threading.Thread):
                 self._clear_send_acks = False
         else:
             logging.debug("GDB: expected n/ack but got '%s'", c)
+        return pos
 
     def _process_data(self):
         # Process all incoming data until there are no more complete packets.
-        while len(self._buffer):
+        # The buffer is consumed by offset and compacted once at the end so
+        # that the cost is linear in the amount of data received.
+        buf = self._buffer
+        pos = 0
+        while pos < len(buf):
             if self._expecting_ack:
                 self._expecting_ack = False
-                self._check_expected_ack()
+                pos = self._check_expected_ack(pos)
+                if pos >= len(buf):
+                    break
 
             # Check for a ctrl-c.
-            if len(self._buffer) and self._buffer[0] == CTRL_C:
+            if buf[pos] == ord(CTRL_C):
                 self.interrupt_event.set()
-                self._buffer = self._buffer[1:]
+                pos += 1
+                continue
 
-            try:
-                # Look for complete packet and extract from buffer.
-                pkt_begin = self._buffer.index("$")
-                pkt_end = self._buffer.index("#") + 2
-                if pkt_begin >= 0 and pkt_end < len(self._buffer):
-                    pkt = self._buffer[pkt_begin:pkt_end+1]
-                    self._buffer = self._buffer[pkt_end+1:]
-                    self._handling_incoming_packet(pkt)
-                else:
-                    break
-            except ValueError:
+            # Look for complete packet and extract from buffer.
+            span = rsp.findPacket(buf, pos)
+            if span is None:
                 # No complete packet received yet.
                 break
+            pkt_begin, pkt_end = span
+            pos = pkt_end
+            self._handling_incoming_packet(str(buf[pkt_begin:pkt_end]))
+        del buf[:pos]
 
     def _handling_incoming_packet(self, packet):
         # Compute checksum
-        data, cksum = packet[1:].split('#')
+        data = packet[1:-3]
+        cksum = packet[-2:]
         computedCksum = checksum(data)
         goodPacket = (computedCksum.lower() == cksum.lower())
 
         if self.send_acks:
             ack = '+' if goodPacket else '-'
-            self._abstract_socket.write(ack)
+            self._write(ack)
             if LOG_ACK:
                 logging.debug(ack)
 
         if goodPacket:
-            self._receive_queue.put(packet)
+            self._command_queue.append((self, packet))
 
 class GDBServer(threading.Thread):
     """
     This class start a GDB server listening a gdb connection on a specific port.
     It implements the RSP (Remote Serial Protocol).
+
+    A single thread runs an event loop over the listening socket and every
+    client connection. The first client controls the target; clients that
+    connect while it is attached, such as a monitoring tool, may only read
+    the target.
     """
     def __init__(self, board, port_urlWSS, options = {}):
         threading.Thread.__init__(self)
@@ -235,15 +269,22 @@ class GDBServer(threading.Thread):
         self.telnet_port = options.get('telnet_port', 4444)
         self.semihost_use_syscalls = options.get('semihost_use_syscalls', False)
         self.server_listening_callback = options.get('server_listening_callback', None)
-        self.packet_size = 2048
-        self.packet_io = None
+        self.enable_memory_cache = options.get('enable_memory_cache', False)
+        self.target.enableMemoryCache(self.enable_memory_cache)
+        halt_watch = options.get('halt_watch', DEFAULT_HALT_WATCH)
+        if halt_watch not in HALT_WATCH:
+            raise ValueError("Unknown halt watch '%s'" % halt_watch)
+        self.halt_watch = HALT_WATCH[halt_watch](self.target)
+        self.packet_size = self.getPacketSize(board.transport)
+        self._initConnections()
         self.gdb_features = []
         self.flashBuilder = None
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()
         self.shutdown_event = threading.Event()
         self.detach_event = threading.Event()
         if self.wss_server == None:
             self.abstract_socket = GDBSocket(self.port, self.packet_size)
+            self.listener = self.abstract_socket
         else:
             self.abstract_socket = GDBWebSocket(self.wss_server)
 
@@ -283,9 +324,9 @@ class GDBServer(threading.Thread):
 
     def _cleanup(self):
         logging.debug("GDB server cleaning up")
-        if self.packet_io:
-            self.packet_io.stop()
-            self.packet_io = None
+        self._closeConnections()
+        if self.listener is not None:
+            self.listener.close()
         if self.semihost:
             self.semihost.cleanup()
             self.semihost = None
@@ -293,6 +334,143 @@ class GDBServer(threading.Thread):
             self.telnet_console.stop()
             self.telnet_console = None
 
+    def _initConnections(self):
+        self.listener = None
+        self.connections = []
+        self.command_queue = collections.deque()
+        # The connection allowed to change the target state. Other
+        # connections may only read it.
+        self.controller = None
+        # The connection whose command is being handled.
+        self.packet_io = None
+        self._initNonStop()
+
+    def _initNonStop(self):
+        # Set by QNonStop. Execution commands then reply at once and the
+        # stops are reported with %Stop notifications.
+        self.non_stop = False
+        # The target runs and the event loop watches for it to halt.
+        self._non_stop_running = False
+        # Stop replies not acknowledged by vStopped yet
+        self._stop_queue = collections.deque()
+        self._notify_stop = False
+
+    def _addConnection(self, abstract_socket):
+        connection = GDBServerConnection(abstract_socket, self.command_queue)
+        self.connections.append(connection)
+        if self.controller is None:
+            self.controller = connection
+            logging.info("One client connected!")
+        else:
+            logging.info("Read-only client connected, %d clients", len(self.connections))
+        return connection
+
+    def _removeConnection(self, connection):
+        connection.close()
+        if connection in self.connections:
+            self.connections.remove(connection)
+        for entry in [entry for entry in self.command_queue if entry[0] is connection]:
+            self.command_queue.remove(entry)
+        if connection is self.controller:
+            # The oldest remaining client takes control, in all-stop mode
+            self.controller = self.connections[0] if self.connections else None
+            self._initNonStop()
+
+    def _closeConnections(self):
+        for connection in list(self.connections):
+            self._removeConnection(connection)
+
+    def _pollConnections(self, timeout):
+        """
+        Wait up to timeout seconds for a connection to become readable, then
+        accept new clients and process the data received. Returns as soon as
+        there is input, so packets are not held back by a timer.
+        """
+        readers = [connection for connection in self.connections if not connection.closed]
+        if self.listener is not None and self.listener.isListening():
+            readers.append(self.listener)
+        if not readers:
+            if timeout:
+                sleep(timeout)
+            return
+        try:
+            readable = select.select(readers, [], [], timeout)[0]
+        except (select.error, socket.error, ValueError):
+            # A socket was closed under us
+            return
+        for reader in readable:
+            if reader is self.listener:
+                connection = self.listener.accept()
+                if connection is not None:
+                    self._addConnection(connection)
+            else:
+                reader.poll()
+
+    def _serviceCommands(self, exclude = None):
+        """
+        Handle the queued commands in arrival order, skipping those of the
+        exclude connection.
+        """
+        while not self.shutdown_event.isSet():
+            entry = None
+            for queued in self.command_queue:
+                if queued[0] is not exclude:
+                    entry = queued
+                    break
+            if entry is None:
+                break
+            self.command_queue.remove(entry)
+            self._handleCommand(*entry)
+
+        # Drop the clients that closed once their last commands are handled
+        for connection in list(self.connections):
+            if connection.closed and not any(queued[0] is connection for queued in self.command_queue):
+                self._removeConnection(connection)
+                logging.info("Client disconnected")
+
+    def _handleCommand(self, connection, packet):
+        previous = self.packet_io
+        self.packet_io = connection
+        try:
+            with self.lock:
+                if self._isAllowed(connection, packet):
+                    # decode and prepare resp
+                    resp, detach = self.handleMsg(packet)
+                else:
+                    logging.debug("Refused %s from read-only client", packet)
+                    resp, detach = self.createRSPPacket('E01'), 0 #EPERM
+
+                if resp is not None:
+                    # send resp
+                    connection.send(resp)
+        finally:
+            self.packet_io = previous
+
+        if detach:
+            was_controller = connection is self.controller
+            self._removeConnection(connection)
+            if was_controller and not self.persist:
+                self.shutdown_event.set()
+
+    def _isAllowed(self, connection, packet):
+        """
+        Return whether packet may be handled for connection. Clients other
+        than the controller may read memory at any time, and registers
+        while the target is halted.
+        """
+        if connection is self.controller or len(packet) < 2:
+            return True
+        cmd = packet[1]
+        if cmd in ('m', 'x', 'H', 'D'):
+            return True
+        if cmd == 'q':
+            return not packet.startswith('$qRcmd')
+        if packet.startswith('$QStartNoAckMode') or packet.startswith('$vCont?'):
+            return True
+        if cmd in ('?', 'g', 'p'):
+            return self.target.getState() == TARGET_HALTED
+        return False
+
     def run(self):
         while True:
             logging.info('GDB server started at port:%d', self.port)
@@ -303,79 +481,49 @@ class GDBServer(threading.Thread):
 
             self.shutdown_event.clear()
             self.detach_event.clear()
+            if self.listener is not None:
+                self.listener.listen()
 
             while not self.shutdown_event.isSet() and not self.detach_event.isSet():
-                connected = self.abstract_socket.connect()
-                if connected != None:
-                    self.packet_io = GDBServerPacketIOThread(self.abstract_socket)
-                    break
+                if self.wss_server is not None and not self.connections:
+                    if self.abstract_socket.connect() is not None:
+                        self._addConnection(self.abstract_socket)
+                    continue
+
+                for connection in self.connections:
+                    if connection.interrupt_event.isSet():
+                        logging.debug("Got unexpected ctrl-c, ignoring")
+                        connection.interrupt_event.clear()
+
+                if self._non_stop_running:
+                    timeout = self.halt_watch.nextInterval()
+                else:
+                    timeout = SELECT_TIMEOUT
+                self._pollConnections(timeout)
+                self._serviceCommands()
+                if self._non_stop_running:
+                    self._checkNonStopHalt()
+                self._sendStopNotification()
 
             if self.shutdown_event.isSet():
                 self._cleanup()
                 return
 
-            if self.detach_event.isSet():
-                continue
-
-            logging.info("One client connected!")
-
-            while True:
-
-                if self.shutdown_event.isSet():
-                    self._cleanup()
-                    return
-
-                if self.detach_event.isSet():
-                    break
-
-                if self.packet_io.interrupt_event.isSet():
-                    logging.debug("Got unexpected ctrl-c, ignoring")
-                    self.packet_io.interrupt_event.clear()
-
-                # read command
-                try:
-                    packet = self.packet_io.receive()
-                except ConnectionClosedException:
-                    break
-
-                if self.shutdown_event.isSet():
-                    self._cleanup()
-                    return
-
-                if self.detach_event.isSet():
-                    break
-
-                self.lock.acquire()
-
-                if len(packet) != 0:
-                    # decode and prepare resp
-                    resp, detach = self.handleMsg(packet)
-
-                    if resp is not None:
-                        # send resp
-                        self.packet_io.send(resp)
-
-                    if detach:
-                        self.abstract_socket.close()
-                        self.packet_io.stop()
-                        self.packet_io = None
-                        self.lock.release()
-                        if self.persist:
-                            break
-                        else:
-                            self._cleanup()
-                            return
-
-                self.lock.release()
+            # Restarted: drop the clients and accept new ones.
+            self._closeConnections()
 
     def handleMsg(self, msg):
         if msg[0] != '$':
             logging.debug('msg ignored: first char != $')
             return None, 0
 
+        # Registers cannot be accessed while the core runs
+        if self._non_stop_running and msg[1] in ('g', 'G', 'p', 'P'):
+            return self.createRSPPacket('E01'), 0 #EPERM
+
         # query command
         if msg[1] == '?':
-            return self.createRSPPacket(self.target.getTResponse()), 0
+            return self.haltReason(), 0
 
         # we don't send immediately the response for C and S commands
         elif msg[1] == 'C' or msg[1] == 'c':
@@ -418,8 +566,15 @@ class GDBServer(threading.Thread):
             return self.step()
 
         elif msg[1] == 'v':
+            if msg[2:].startswith('Cont'):
+                return self.vCont(msg[2:])
+            if msg[2:].startswith('Stopped'):
+                return self.vStopped(), 0
             return self.flashOp(msg[2:]), 0
 
+        elif msg[1] == 'x': # read memory with binary data
+            return self.getMemoryBinary(msg[2:]), 0
+
         elif msg[1] == 'X': # write memory with binary data
             return self.writeMemory(msg[2:]), 0
 
@@ -445,6 +600,13 @@ class GDBServer(threading.Thread):
         return self.createRSPPacket("")
 
     def breakpoint(self, data):
+        resp = self._breakpoint(data)
+        if self._non_stop_running:
+            # Breakpoints are otherwise only written when the target resumes
+            self.target.flushBreakpoints()
+        return resp
+
+    def _breakpoint(self, data):
         # handle breakpoint/watchpoint commands
         split = data.split('#')[0].split(',')
         addr = int(split[1], 16)
@@ -490,37 +652,56 @@ class GDBServer(threading.Thread):
         return self.createRSPPacket("OK")
 
     def resume(self):
+        if self.non_stop:
+            return self.resumeNonStop()
+
+        client = self.packet_io
         self.target.resume()
         logging.debug("target resumed")
+        self.halt_watch.start()
 
         val = ''
 
         while True:
             if self.shutdown_event.isSet():
-                self.packet_io.interrupt_event.clear()
+                client.interrupt_event.clear()
                 return self.createRSPPacket(val), 0
 
-            # Wait for a ctrl-c to be received.
-            if self.packet_io.interrupt_event.wait(0.01):
+            if client.closed:
+                logging.debug("client closed while the target runs")
+                return None, 0
+
+            # Wait for a ctrl-c or other input, at most until the next halt check.
+            self._pollConnections(self.halt_watch.nextInterval())
+            if client.interrupt_event.isSet():
                 logging.debug("receive CTRL-C")
-                self.packet_io.interrupt_event.clear()
+                client.interrupt_event.clear()
                 self.target.halt()
+                if self.enable_semihosting:
+                    self.semihost.flush()
                 val = self.target.getTResponse(True)
                 break
 
+            # Serve the read-only clients while the target runs
+            self._serviceCommands(exclude=client)
+
             try:
-                if self.target.getState() == TARGET_HALTED:
+                if self.halt_watch.isHalted():
                     # Handle semihosting
                     if self.enable_semihosting:
                         was_semihost = self.semihost.check_and_handle_semihost_request()
 
                         if was_semihost:
                             self.target.resume()
+                            self.halt_watch.start()
                             continue
 
                     logging.debug("state halted")
                     val = self.target.getTResponse()
                     break
+                elif self.enable_semihosting:
+                    # Don't hold console output back while the target runs
+                    self.semihost.flush(force=False)
             except Exception as e:
                 try:
                     self.target.halt()
@@ -533,15 +714,138 @@ class GDBServer(threading.Thread):
 
         return self.createRSPPacket(val), 0
 
+    def resumeNonStop(self):
+        self.target.resume()
+        logging.debug("target resumed in non-stop mode")
+        self.halt_watch.start()
+        self._non_stop_running = True
+        return self.createRSPPacket("OK"), 0
+
+    def _checkNonStopHalt(self):
+        """
+        Check whether the target resumed in non-stop mode halted, and queue
+        a stop notification if it did.
+        """
+        previous = self.packet_io
+        self.packet_io = self.controller
+        try:
+            with self.lock:
+                try:
+                    if not self.halt_watch.isHalted():
+                        if self.enable_semihosting:
+                            # Don't hold console output back while the target runs
+                            self.semihost.flush(force=False)
+                        return
+
+                    # Handle semihosting
+                    if self.enable_semihosting and self.semihost.check_and_handle_semihost_request():
+                        self.target.resume()
+                        self.halt_watch.start()
+                        return
+
+                    logging.debug("state halted")
+                    reply = self.target.getTResponse()
+                except Exception as e:
+                    try:
+                        self.target.halt()
+                    except:
+                        pass
+                    traceback.print_exc()
+                    logging.debug('Target is unavailable temporarily.')
+                    reply = 'S%02x' % self.target.getSignalValue()
+                self._non_stop_running = False
+                self._queueStop(reply)
+        finally:
+            self.packet_io = previous
+
+    def _stopReply(self, reply):
+        """
+        Return the packet reporting a stop. In non-stop mode the stop is
+        reported by a notification, and the command is answered with OK.
+        """
+        if self.non_stop:
+            self._queueStop(reply)
+            return self.createRSPPacket("OK"), 0
+        return self.createRSPPacket(reply), 0
+
+    def _queueStop(self, reply):
+        self._stop_queue.append(reply)
+        if len(self._stop_queue) == 1:
+            self._notify_stop = True
+
+    def _sendStopNotification(self):
+        # Only the first stop is notified. GDB fetches the others with vStopped.
+        if self._notify_stop and self.controller is not None:
+            self._notify_stop = False
+            self.controller.notify(rsp.createNotification('Stop:' + self._stop_queue[0]))
+
+    def vStopped(self):
+        # GDB acknowledges the stop reported last and asks for the next one.
+        if self._stop_queue:
+            self._stop_queue.popleft()
+        if self._stop_queue:
+            return self.createRSPPacket(self._stop_queue[0])
+        return self.createRSPPacket("OK")
+
+    def haltReason(self):
+        # Read-only clients get a plain stop reply, leaving the controller's stops alone
+        if not self.non_stop or self.packet_io is not self.controller:
+            return self.createRSPPacket(self.target.getTResponse())
+        if self._non_stop_running:
+            return self.createRSPPacket("OK")
+        # The reply counts as the stop notification, so vStopped ends the sequence.
+        reply = self.target.getTResponse()
+        self._stop_queue = collections.deque([reply])
+        self._notify_stop = False
+        return self.createRSPPacket(reply)
+
     def step(self):
         logging.debug("GDB step")
         self.target.step(not self.step_into_interrupt)
-        return self.createRSPPacket(self.target.getTResponse()), 0
+        return self._stopReply(self.target.getTResponse())
+
+    def rangeStep(self, start, end):
+        logging.debug("GDB range step %x-%x", start, end)
+        # Return to check for a ctrl-c between calls
+        while not self.target.rangeStep(start, end, not self.step_into_interrupt):
+            if self.shutdown_event.isSet():
+                break
+            self._pollConnections(0)
+            if self.packet_io.interrupt_event.isSet():
+                logging.debug("receive CTRL-C")
+                self.packet_io.interrupt_event.clear()
+                return self._stopReply(self.target.getTResponse(True))
+        return self._stopReply(self.target.getTResponse())
 
     def halt(self):
         self.target.halt()
+        self._non_stop_running = False
+        if self.non_stop:
+            # A stop requested with vCont;t is reported with signal 0
+            return self._stopReply('T00' + self.target.getTResponse()[3:])
         return self.createRSPPacket(self.target.getTResponse()), 0
 
+    def vCont(self, data):
+        cmd = data.split('#')[0]
+        if cmd == 'Cont?':
+            return self.createRSPPacket("vCont;c;C;s;S;t;r"), 0
+
+        # There is a single thread, so the first action applies to it.
+        actions = cmd.split(';')[1:]
+        if not actions:
+            return self.createRSPPacket(""), 0
+        action = actions[0].split(':')[0]
+        if action[0] in ('c', 'C'):
+            return self.resume()
+        elif action[0] in ('s', 'S'):
+            return self.step()
+        elif action[0] == 'r':
+            start, end = [int(addr, 16) for addr in action[1:].split(',')]
+            return self.rangeStep(start, end)
+        elif action[0] == 't':
+            return self.halt()
+        return self.createRSPPacket(""), 0
+
     def flashOp(self, data):
         ops = data.split(':')[0]
         logging.debug("flash op: %s", ops)
@@ -553,12 +857,7 @@ class GDBServer(threading.Thread):
             write_addr = int(data.split(':')[1], 16)
             logging.debug("flash write addr: 0x%x", write_addr)
             # search for second ':' (beginning of data encoded in the message)
-            second_colon = 0
-            idx_begin = 0
-            while second_colon != 2:
-                if data[idx_begin] == ':':
-                    second_colon += 1
-                idx_begin += 1
+            idx_begin = data.index(':', data.index(':') + 1) + 1
 
             # Get flash builder if there isn't one already
             if self.flashBuilder == None:
@@ -604,29 +903,10 @@ class GDBServer(threading.Thread):
 
             return self.createRSPPacket("OK")
 
-        elif 'Cont' in ops:
-            if 'Cont?' in ops:
-                return self.createRSPPacket("vCont;c;s;t")
-
         return None
 
     def unescape(self, data):
-        data_idx = 0
-
-        # unpack the data into binary array
-        str_unpack = str(len(data)) + 'B'
-        data = unpack(str_unpack, data)
-        data = list(data)
-
-        # check for escaped characters
-        while data_idx < len(data):
-            if data[data_idx] == 0x7d:
-                data.pop(data_idx)
-                data[data_idx] = data[data_idx] ^ 0x20
-            data_idx += 1
-
-        return data
-
+        return rsp.unescape(data)
 
     def getMemory(self, data):
         split = data.split(',')
@@ -638,20 +918,43 @@ class GDBServer(threading.Thread):
             logging.debug("GDB getMem: addr=%x len=%x", addr, length)
 
         try:
-            val = ''
-            mem = self.target.readBlockMemoryUnaligned8(addr, length)
+            mem = self.target.readMemoryBytes(addr, length)
             # Flush so an exception is thrown now if invalid memory was accesses
             self.target.flush()
-            for x in mem:
-                if x >= 0x10:
-                    val += hex(x)[2:4]
-                else:
-                    val += '0' + hex(x)[2:3]
+            val = hexEncode(mem)
         except TransferError:
             logging.debug("getMemory failed at 0x%x" % addr)
             val = 'E01' #EPERM
         return self.createRSPPacket(val)
 
+    def getMemoryBinary(self, data):
+        split = data.split(',')
+        addr = int(split[0], 16)
+        length = int(split[1].split('#')[0], 16)
+
+        if LOG_MEM:
+            logging.debug("GDB getMemBinary: addr=%x len=%x", addr, length)
+
+        try:
+            mem = self.target.readMemoryBytes(addr, length)
+            # Flush so an exception is thrown now if invalid memory was accesses
+            self.target.flush()
+        except TransferError:
+            logging.debug("getMemoryBinary failed at 0x%x" % addr)
+            return self.createRSPPacket('E01') #EPERM
+
+        # Escaping can make the reply longer than a packet. gdb accepts a
+        # short reply, so drop the tail without splitting an escape.
+        val = rsp.escape(mem)
+        max_size = self.packet_size - 5
+        if len(val) > max_size:
+            val = val[:max_size]
+            # Escaped data never contains a plain '}', so a trailing one is
+            # an escape that lost its character.
+            if val.endswith(rsp.ESCAPE_CHAR):
+                val = val[:-1]
+        return self.createRSPPacket('b' + val)
+
     def writeMemoryHex(self, data):
         split = data.split(',')
         addr = int(split[0], 16)
@@ -660,14 +963,14 @@ class GDBServer(threading.Thread):
         length = int(split[0], 16)
 
         split = split[1].split('#')
-        data = hexToByteList(split[0])
+        data = hexDecode(split[0])
 
         if LOG_MEM:
             logging.debug("GDB writeMemHex: addr=%x len=%x", addr, length)
 
         try:
             if length > 0:
-                self.target.writeBlockMemoryUnaligned8(addr, data)
+                self.target.writeMemoryBytes(addr, data)
                 # Flush so an exception is thrown now if invalid memory was accessed
                 self.target.flush()
             resp = "OK"
@@ -685,19 +988,12 @@ class GDBServer(threading.Thread):
         if LOG_MEM:
             logging.debug("GDB writeMem: addr=%x len=%x", addr, length)
 
-        idx_begin = 0
-        for i in range(len(data)):
-            if data[i] == ':':
-                idx_begin += 1
-                break
-            idx_begin += 1
-
-        data = data[idx_begin:len(data) - 3]
-        data = self.unescape(data)
+        idx_begin = data.index(':') + 1
+        data = self.unescape(data[idx_begin:len(data) - 3])
 
         try:
             if length > 0:
-                self.target.writeBlockMemoryUnaligned8(addr, data)
+                self.target.writeMemoryBytes(addr, data)
                 # Flush so an exception is thrown now if invalid memory was accessed
                 self.target.flush()
             resp = "OK"
@@ -736,7 +1032,7 @@ class GDBServer(threading.Thread):
             self.gdb_features = query[1].split(';')
 
             # Build our list of features.
-            features = ['qXfer:features:read+', 'QStartNoAckMode+']
+            features = ['qXfer:features:read+', 'QStartNoAckMode+', 'QNonStop+']
             features.append('PacketSize=' + hex(self.packet_size)[2:])
             if self.target.getMemoryMapXML() is not None:
                 features.append('qXfer:memory-map:read+')
@@ -796,7 +1092,8 @@ class GDBServer(threading.Thread):
             'resume': ['Resume target', 0x4],
             'help'  : ['Display this help', 0x80],
             'reg'   : ['Show registers', 0],
-            'init'  : ['Init reset sequence', 0]
+            'init'  : ['Init reset sequence', 0],
+            'stats' : ['Show statistics, or reset them with "stats reset"', 0]
         }
         resultMask = 0x00
         resp = 'OK'
@@ -808,6 +1105,22 @@ class GDBServer(threading.Thread):
         elif cmd.startswith('arm semihosting'):
             self.enable_semihosting = 'enable' in cmd
             logging.info("Semihosting %s", ('enabled' if self.enable_semihosting else 'disabled'))
+        elif cmd.split()[:1] == ['stats']:
+            if cmd.split()[1:] == ['reset']:
+                self.board.resetStatistics()
+            else:
+                resp = '\n'.join(formatStatistics(self.board.getStatistics())) + '\n'
+                resp = hexEncode(resp)
+        elif cmd.startswith('memory cache'):
+            args = cmd.split()[2:]
+            if args and args[0] in ('enable', 'disable'):
+                self.enable_memory_cache = args[0] == 'enable'
+                self.target.enableMemoryCache(self.enable_memory_cache)
+                logging.info("Memory cache %s", ('enabled' if self.enable_memory_cache else 'disabled'))
+            else:
+                stats = self.target.getMemoryCacheStatistics()
+                resp = ''.join('%s: %d\n' % (k, stats[k]) for k in sorted(stats)) or 'Memory cache disabled\n'
+                resp = hexEncode(resp)
         else:
             cmdList = cmd.split(' ')
             #check whether all the cmds is valid cmd for monitor
@@ -859,6 +1172,10 @@ class GDBServer(threading.Thread):
             # Disable acks after the reply and ack.
             self.packet_io.set_send_acks(False)
             return self.createRSPPacket("OK")
+        elif feature in ('NonStop:0', 'NonStop:1'):
+            self.non_stop = feature == 'NonStop:1'
+            logging.info("GDB %s mode", 'non-stop' if self.non_stop else 'all-stop')
+            return self.createRSPPacket("OK")
         else:
             return self.createRSPPacket("")
 
@@ -892,20 +1209,40 @@ class GDBServer(threading.Thread):
         return resp
 
 
+    @staticmethod
+    def getPacketSize(transport):
+        """
+        Return the packet size to advertise to gdb. It is the smallest
+        multiple of the transport's pipelined burst that is at least
+        MIN_PACKET_SIZE, so large memory reads keep the probe busy.
+        """
+        burst = transport.getMemoryBurstSize() if transport is not None else 0
+        if not burst:
+            return MIN_PACKET_SIZE
+        size = ((MIN_PACKET_SIZE + burst - 1) // burst) * burst
+        return min(size, MAX_PACKET_SIZE)
+
     def createRSPPacket(self, data):
-        resp = '$' + data + '#' + checksum(data)
-        return resp
+        return rsp.createPacket(data)
 
     def syscall(self, op):
         logging.debug("GDB server syscall: %s", op)
+        client = self.packet_io
         request = self.createRSPPacket('F' + op)
-        self.packet_io.send(request)
+        client.send(request)
+
+        while not client.interrupt_event.is_set():
+            if self.shutdown_event.isSet():
+                break
 
-        while not self.packet_io.interrupt_event.is_set():
             # Read a packet.
-            packet = self.packet_io.receive(False)
+            try:
+                packet = client.receive()
+            except ConnectionClosedException:
+                break
             if packet is None:
-                sleep(0.1)
+                self._pollConnections(SELECT_TIMEOUT)
+                self._serviceCommands(exclude=client)
                 continue
 
             # Check for file I/O response.
@@ -916,8 +1253,8 @@ class GDBServer(threading.Thread):
                 errno = int(args[1], base=16) if len(args) > 1 else 0
                 ctrl_c = args[2] if len(args) > 2 else ''
                 if ctrl_c == 'C':
-                    self.packet_io.interrupt_event.set()
-                    self.packet_io.drop_reply = True
+                    client.interrupt_event.set()
+                    client.drop_reply = True
                 return result, errno
 
             # decode and prepare resp
@@ -925,7 +1262,7 @@ class GDBServer(threading.Thread):
 
             if resp is not None:
                 # send resp
-                self.packet_io.send(resp)
+                client.send(resp)
 
             if detach:
                 self.detach_event.set()
@@ -0,0 +1,94 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from ..target.target import TARGET_HALTED
+
+## @brief Halt watch that polls the core state at a fixed interval.
+#
+# A halt watch decides how the GDB server waits for a running core to halt.
+# The server calls start() after each resume, then alternates between
+# waiting nextInterval() seconds for a Ctrl-C and calling isHalted().
+class PollHaltWatch(object):
+    def __init__(self, target, interval = 0.01):
+        self.target = target
+        self.interval = interval
+
+    def start(self):
+        """
+        Called each time the core is resumed.
+        """
+        pass
+
+    def nextInterval(self):
+        """
+        Return the number of seconds to wait before the next check.
+        """
+        return self.interval
+
+    def isHalted(self):
+        return self.target.getState() == TARGET_HALTED
+
+## @brief Halt watch that polls quickly after a resume and backs off.
+#
+# Short runs such as stepping over a function or a semihosting call are
+# noticed within a fraction of a millisecond, while a core running for a
+# long time is checked at most every max_interval seconds.
+class BackoffHaltWatch(PollHaltWatch):
+    def __init__(self, target, min_interval = 0.0005, max_interval = 0.1, factor = 2):
+        super(BackoffHaltWatch, self).__init__(target, min_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+
+    def start(self):
+        self.interval = self.min_interval
+
+    def nextInterval(self):
+        interval = self.interval
+        self.interval = min(interval * self.factor, self.max_interval)
+        return interval
+
+## @brief Backoff halt watch that lets the probe wait for S_HALT.
+#
+# Each check is a DAP_TRANSFER value-match read of DHCSR. The probe repeats
+# the read up to the current retry count without a USB round trip, so a
+# halt is seen while the probe is still reading. The retry count grows with
+# the interval and is bounded so a Ctrl-C is still handled promptly.
+class MatchHaltWatch(BackoffHaltWatch):
+    def __init__(self, target, min_interval = 0.0005, max_interval = 0.1, factor = 2,
+                 min_retry = 8, max_retry = 1024):
+        super(MatchHaltWatch, self).__init__(target, min_interval, max_interval, factor)
+        self.min_retry = min_retry
+        self.max_retry = max_retry
+        self.retry = min_retry
+
+    def start(self):
+        super(MatchHaltWatch, self).start()
+        self.retry = self.min_retry
+
+    def isHalted(self):
+        retry = self.retry
+        self.retry = min(retry * self.factor, self.max_retry)
+        return self.target.waitForHalt(retry)
+
+HALT_WATCH = {
+    'poll' : PollHaltWatch,
+    'backoff' : BackoffHaltWatch,
+    'match' : MatchHaltWatch,
+    }
+
+DEFAULT_HALT_WATCH = 'match'
@@ -0,0 +1,146 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import logging
+import threading
+from gdbserver import GDBServer
+from ..board.mbed_board import MbedBoard
+
+## @brief Serve every connected board from one process, one GDBServer per board.
+#
+# A single thread enumerates the probes every scan_interval seconds. Probes already
+# served are not opened again, which relies on mbed probes reporting their unique id
+# as USB serial number. Each new board, or only those in board_ids if given, is
+# initialized and gets a GDBServer on its own port: port plus the board's index in
+# board_ids, or plus the lowest index not used by another board. The telnet port for
+# semihosting is offset the same way. A board keeps its index while the process runs,
+# so it is served on the same ports when plugged in again. A port of 0 lets the system
+# pick free ports.
+#
+# The server of a board that disappears, or whose client detached, is stopped and its
+# board closed. A board still connected is served again on the next scan.
+class MultiBoardGDBServer(threading.Thread):
+    def __init__(self, port, options = {}, board_ids = None, target_override = None,
+                 frequency = 1000000, scan_interval = 1.0):
+        super(MultiBoardGDBServer, self).__init__(name="gdb-multi-board")
+        self.port = port
+        self.options = options
+        self.board_ids = board_ids
+        self.target_override = target_override
+        self.frequency = frequency
+        self.scan_interval = scan_interval
+        self.servers = {}               # unique id -> GDBServer
+        self._indexes = {}              # unique id -> port offset
+        self._stop_event = threading.Event()
+        self.setDaemon(True)
+        self.start()
+
+    def stop(self):
+        """
+        Stop scanning, then stop every server and close its board.
+        """
+        self._stop_event.set()
+        if self.isAlive():
+            self.join()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                logging.error("Board scan failed: %s", e)
+            self._stop_event.wait(self.scan_interval)
+
+        for unique_id in list(self.servers):
+            self._stopServer(unique_id)
+
+    def scan(self):
+        """
+        Stop the servers of boards that went away and start servers for
+        the boards that appeared.
+        """
+        present = set(MbedBoard.getConnectedBoardIDs() or [])
+        for unique_id, server in list(self.servers.items()):
+            if unique_id not in present:
+                logging.info("Board %s disconnected", unique_id)
+                self._stopServer(unique_id)
+            elif not server.isAlive():
+                self._stopServer(unique_id)
+
+        wanted = present - set(self.servers)
+        if self.board_ids is not None:
+            wanted &= set(self.board_ids)
+        if not wanted:
+            return
+
+        # Only the new boards are opened
+        boards = MbedBoard.getAllConnectedBoards(blocking = False, target_override = self.target_override,
+                                                 frequency = self.frequency, exclude = present - wanted)
+        for board in boards:
+            if board.unique_id in wanted:
+                self._startServer(board)
+            else:
+                board.interface.close()
+
+    def getPort(self, unique_id):
+        """
+        Return the GDB port of a board, or None if it has none yet.
+        """
+        index = self._indexes.get(unique_id)
+        if index is None or not self.port:
+            return None
+        return self.port + index
+
+    def _getIndex(self, unique_id):
+        if unique_id not in self._indexes:
+            if self.board_ids is not None:
+                index = self.board_ids.index(unique_id)
+            else:
+                used = set(self._indexes.values())
+                index = 0
+                while index in used:
+                    index += 1
+            self._indexes[unique_id] = index
+        return self._indexes[unique_id]
+
+    def _startServer(self, board):
+        index = self._getIndex(board.unique_id)
+        options = dict(self.options)
+        if options.get('telnet_port', 4444):
+            options['telnet_port'] = options.get('telnet_port', 4444) + index
+        port = self.port + index if self.port else 0
+        try:
+            board.init()
+            # Boost speed with deferred transfers
+            board.transport.setDeferredTransfer(True)
+            self.servers[board.unique_id] = GDBServer(board, port, options)
+        except Exception as e:
+            logging.error("Failed to serve board %s: %s", board.unique_id, e)
+            try:
+                board.uninit(False)
+            except Exception:
+                pass
+            return
+        logging.info("Board %s served on port %d", board.unique_id, port)
+
+    def _stopServer(self, unique_id):
+        server = self.servers.pop(unique_id)
+        try:
+            server.stop()
+        except Exception as e:
+            # The probe may be gone already
+            logging.debug("Closing board %s failed: %s", unique_id, e)
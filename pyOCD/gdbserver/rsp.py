@@ -0,0 +1,81 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import re
+
+## @file
+# GDB Remote Serial Protocol framing helpers.
+#
+# All of these run in linear time over the packet data so that large binary
+# transfers such as 'X' and 'vFlashWrite' are not limited by the host CPU.
+
+ESCAPE_CHAR = '}'
+ESCAPE_XOR = 0x20
+
+# Characters that must be escaped in binary data
+_ESCAPE_RE = re.compile(r'[#$}*]')
+
+def _escapeMatch(match):
+    return ESCAPE_CHAR + chr(ord(match.group()) ^ ESCAPE_XOR)
+
+def checksum(data):
+    """Return the two digit hex checksum of a packet payload"""
+    return "%02x" % (sum(bytearray(data)) & 0xff)
+
+def escape(data):
+    """Escape binary data (str or bytearray) for use in a packet payload"""
+    return _ESCAPE_RE.sub(_escapeMatch, str(data))
+
+def unescape(data):
+    """Remove escapes from binary packet data and return a bytearray"""
+    data = bytearray(data)
+    result = bytearray()
+    start = 0
+    end = len(data)
+    while start < end:
+        idx = data.find(ESCAPE_CHAR, start)
+        # A trailing escape character is kept as is
+        if idx < 0 or idx + 1 >= end:
+            result += data[start:]
+            break
+        result += data[start:idx]
+        result.append(data[idx + 1] ^ ESCAPE_XOR)
+        start = idx + 2
+    return result
+
+def createPacket(data):
+    """Frame a payload as an RSP packet"""
+    return '$' + data + '#' + checksum(data)
+
+def createNotification(data):
+    """Frame a payload as an RSP notification, which is not acked"""
+    return '%' + data + '#' + checksum(data)
+
+def findPacket(buf, start=0):
+    """
+    Look for a complete packet in buf starting at the given offset.
+
+    Returns a tuple of the offset of the '$' and the offset just past the
+    checksum, or None if no complete packet has been received yet.
+    """
+    begin = buf.find('$', start)
+    if begin < 0:
+        return None
+    hash_idx = buf.find('#', begin + 1)
+    if hash_idx < 0 or hash_idx + 3 > len(buf):
+        return None
+    return begin, hash_idx + 3
@@ -20,11 +20,13 @@ import logging
 from hidapi_backend import HidApiUSB
 from pyusb_backend import PyUSB
 from pywinusb_backend import PyWinUSB
+from sim_backend import SimulatedCMSISDAP
 
 INTERFACE = {
              'hidapiusb': HidApiUSB,
              'pyusb': PyUSB,
-             'pywinusb': PyWinUSB
+             'pywinusb': PyWinUSB,
+             'sim': SimulatedCMSISDAP
             }
 
 # Allow user to override backend with an environment variable.
@@ -47,9 +47,18 @@ class HidApiUSB(Interface):
         pass
 
     @staticmethod
-    def getAllConnectedInterface(vid, pid):
+    def getConnectedSerialNumbers(vid, pid):
         """
-        returns all the connected devices which matches HidApiUSB.vid/HidApiUSB.pid.
+        returns the USB serial numbers of the connected devices which
+        match vid/pid, without opening them
+        """
+        return [deviceInfo['serial_number'] for deviceInfo in hid.enumerate(vid, pid)]
+
+    @staticmethod
+    def getAllConnectedInterface(vid, pid, exclude = ()):
+        """
+        returns all the connected devices which matches HidApiUSB.vid/HidApiUSB.pid,
+        except those whose USB serial number is in exclude.
         returns an array of HidApiUSB (Interface) objects
         """
 
@@ -62,6 +71,9 @@ class HidApiUSB(Interface):
         boards = []
 
         for deviceInfo in devices:
+            if deviceInfo['serial_number'] in exclude:
+                # Already in use, leave it alone
+                continue
             try:
                 dev = hid.device(vendor_id=vid, product_id=pid, path = deviceInfo['path'])
             except IOError:
@@ -88,7 +100,7 @@ class HidApiUSB(Interface):
         """
         write data on the OUT endpoint associated to the HID interface
         """
-        for _ in range(64 - len(data)):
+        for _ in range(self.packet_size - len(data)):
             data.append(0)
         #logging.debug("send: %s", data)
         self.device.write([0] + data)
@@ -99,7 +111,7 @@ class HidApiUSB(Interface):
         """
         read data on the IN endpoint associated to the HID interface
         """
-        return self.device.read(64)
+        return bytearray(self.device.read(self.packet_size))
 
     def close(self):
         """
@@ -111,3 +123,7 @@ class HidApiUSB(Interface):
     def setPacketCount(self, count):
         # No interface level restrictions on count
         self.packet_count = count
+
+    def setPacketSize(self, size):
+        # HID report size is determined by the device
+        self.packet_size = size
@@ -23,6 +23,7 @@ class Interface(object):
         self.vendor_name = ""
         self.product_name = ""
         self.packet_count = 1
+        self.packet_size = 64
         return
     
     def init(self):
@@ -47,6 +48,24 @@ class Interface(object):
     def getPacketCount(self):
         return self.packet_count
 
+    def setPacketSize(self, size):
+        # Unless overridden the packet size cannot be changed
+        return
+
+    def getPacketSize(self):
+        return self.packet_size
+
+    def setReadTimeout(self, timeout):
+        # Unless overridden the read timeout cannot be changed
+        return
+
+    def getStatistics(self):
+        return {}
+
+    def resetStatistics(self):
+        # Unless overridden the interface keeps no statistics
+        return
+
     def close(self):
         return
     
@@ -16,7 +16,8 @@
 """
 
 from interface import Interface
-import logging, os, threading
+import logging, os, threading, collections
+from time import time
 
 try:
     import usb.core
@@ -28,6 +29,9 @@ except:
 else:
     isAvailable = True
 
+# Seconds read() waits for a response before the probe is taken to be hung
+DEFAULT_READ_TIMEOUT = 10.0
+
 class PyUSB(Interface):
     """
     This class provides basic functions to access
@@ -47,8 +51,16 @@ class PyUSB(Interface):
         self.ep_in = None
         self.dev = None
         self.closed = False
-        self.rcv_data = []
+        self.rcv_data = collections.deque()
+        self.rcv_cond = threading.Condition()
         self.read_sem = threading.Semaphore(0)
+        # Seconds to wait for a response in read(). None waits forever.
+        self.read_timeout = DEFAULT_READ_TIMEOUT
+        # Receive path statistics
+        self.read_count = 0
+        self.read_wait_time = 0.0
+        self.max_read_wait_time = 0.0
+        self.max_queue_depth = 0
     
     def start_rx(self):
         self.thread = threading.Thread(target = self.rx_task)
@@ -61,12 +73,26 @@ class PyUSB(Interface):
             if not self.closed:
                 # Timeouts appear to corrupt data occasionally.  Because of this the
                 # timeout is set to infinite.
-                self.rcv_data.append(self.ep_in.read(self.ep_in.wMaxPacketSize, -1))
+                data = bytearray(self.ep_in.read(self.packet_size, -1))
+                with self.rcv_cond:
+                    self.rcv_data.append(data)
+                    self.max_queue_depth = max(self.max_queue_depth, len(self.rcv_data))
+                    self.rcv_cond.notify()
 
     @staticmethod
-    def getAllConnectedInterface(vid, pid):
+    def getConnectedSerialNumbers(vid, pid):
+        """
+        returns the USB serial numbers of the connected devices which
+        match vid/pid, without opening them
         """
-        returns all the connected devices which matches PyUSB.vid/PyUSB.pid.
+        all_devices = usb.core.find(find_all=True, idVendor=vid, idProduct=pid)
+        return [usb.util.get_string(board, board.iSerialNumber) for board in (all_devices or [])]
+
+    @staticmethod
+    def getAllConnectedInterface(vid, pid, exclude = ()):
+        """
+        returns all the connected devices which matches PyUSB.vid/PyUSB.pid,
+        except those whose USB serial number is in exclude.
         returns an array of PyUSB (Interface) objects
         """
         # find all devices matching the vid/pid specified
@@ -80,6 +106,10 @@ class PyUSB(Interface):
 
         # iterate on all devices found
         for board in all_devices:
+            if exclude and usb.util.get_string(board, board.iSerialNumber) in exclude:
+                # Already in use, leave it alone
+                continue
+
             interface_number = -1
             
             # get active config
@@ -124,6 +154,7 @@ class PyUSB(Interface):
             new_board.intf_number = interface_number
             new_board.product_name = product_name
             new_board.vendor_name = vendor_name
+            new_board.packet_size = ep_in.wMaxPacketSize
             new_board.start_rx()
             boards.append(new_board)
             
@@ -134,11 +165,7 @@ class PyUSB(Interface):
         write data on the OUT endpoint associated to the HID interface
         """
 
-        report_size = 64
-        if self.ep_out:
-            report_size = self.ep_out.wMaxPacketSize
-
-        for _ in range(report_size - len(data)):
+        for _ in range(self.packet_size - len(data)):
            data.append(0)
 
         self.read_sem.release()
@@ -157,18 +184,62 @@ class PyUSB(Interface):
         return
         
         
-    def read(self):
+    def read(self, timeout = -1):
         """
         read data on the IN endpoint associated to the HID interface
+
+        Blocks until the receive thread has queued a packet.  If timeout
+        is -1 the interface's read timeout is used.
         """
-        while len(self.rcv_data) == 0:
-            pass
-        return self.rcv_data.pop(0)
+        if timeout == -1:
+            timeout = self.read_timeout
+        with self.rcv_cond:
+            if not self.rcv_data:
+                start = time()
+                while not self.rcv_data:
+                    if self.closed:
+                        raise Exception("Interface closed")
+                    if timeout is None:
+                        self.rcv_cond.wait()
+                    else:
+                        remaining = timeout - (time() - start)
+                        if remaining <= 0:
+                            raise Exception("Read timed out")
+                        self.rcv_cond.wait(remaining)
+                wait_time = time() - start
+                self.read_wait_time += wait_time
+                self.max_read_wait_time = max(self.max_read_wait_time, wait_time)
+            self.read_count += 1
+            return self.rcv_data.popleft()
+
+    def setReadTimeout(self, timeout):
+        self.read_timeout = timeout
+
+    def getStatistics(self):
+        with self.rcv_cond:
+            return {
+                'read_count' : self.read_count,
+                'read_wait_time' : self.read_wait_time,
+                'max_read_wait_time' : self.max_read_wait_time,
+                'queue_depth' : len(self.rcv_data),
+                'max_queue_depth' : self.max_queue_depth,
+                }
+
+    def resetStatistics(self):
+        with self.rcv_cond:
+            self.read_count = 0
+            self.read_wait_time = 0.0
+            self.max_read_wait_time = 0.0
+            self.max_queue_depth = 0
 
     def setPacketCount(self, count):
         # No interface level restrictions on count
         self.packet_count = count
 
+    def setPacketSize(self, size):
+        # HID report size is determined by the device
+        self.packet_size = size
+
     def close(self):
         """
         close the interface
@@ -176,5 +247,7 @@ class PyUSB(Interface):
         logging.debug("closing interface")
         self.closed = True
         self.read_sem.release()
+        with self.rcv_cond:
+            self.rcv_cond.notify_all()
         self.thread.join()
         usb.util.dispose_resources(self.dev)
@@ -53,16 +53,26 @@ class PyWinUSB(Interface):
     # handler called when a report is received
     def rx_handler(self, data):
         #logging.debug("rcv: %s", data[1:])
-        self.rcv_data.append(data[1:])
+        self.rcv_data.append(bytearray(data[1:]))
     
     def open(self):
         self.device.set_raw_data_handler(self.rx_handler)
         self.device.open()
         
     @staticmethod
-    def getAllConnectedInterface(vid, pid):
+    def getConnectedSerialNumbers(vid, pid):
         """
-        returns all the connected devices which matches PyWinUSB.vid/PyWinUSB.pid.
+        returns the USB serial numbers of the connected devices which
+        match vid/pid, without opening them
+        """
+        return [d.serial_number for d in hid.find_all_hid_devices()
+                if (d.vendor_id == vid) and (d.product_id == pid)]
+
+    @staticmethod
+    def getAllConnectedInterface(vid, pid, exclude = ()):
+        """
+        returns all the connected devices which matches PyWinUSB.vid/PyWinUSB.pid,
+        except those whose USB serial number is in exclude.
         returns an array of PyWinUSB (Interface) objects
         """
         all_devices = hid.find_all_hid_devices()
@@ -70,7 +80,7 @@ class PyWinUSB(Interface):
         # find devices with good vid/pid
         all_mbed_devices = []
         for d in all_devices:
-            if (d.vendor_id == vid) and (d.product_id == pid):
+            if (d.vendor_id == vid) and (d.product_id == pid) and d.serial_number not in exclude:
                 all_mbed_devices.append(d)
                 
         if not all_mbed_devices:
@@ -103,7 +113,7 @@ class PyWinUSB(Interface):
         """
         write data on the OUT endpoint associated to the HID interface
         """
-        for _ in range(64 - len(data)):
+        for _ in range(self.packet_size - len(data)):
             data.append(0)
         #logging.debug("send: %s", data)
         self.report.send([0] + data)
@@ -131,6 +141,10 @@ class PyWinUSB(Interface):
         # No interface level restrictions on count
         self.packet_count = count
 
+    def setPacketSize(self, size):
+        # HID report size is determined by the device
+        self.packet_size = size
+
     def close(self):
         """
         close the interface
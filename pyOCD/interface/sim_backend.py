@@ -0,0 +1,911 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from interface import Interface
+from ..transport.cmsis_dap_core import (COMMAND_ID, ID_INFO, DAP_OK, DAP_ERROR,
+    DAP_TRANSFER_OK, DAP_TRANSFER_FAULT, DAP_TRANSFER_MISMATCH)
+from binascii import crc32
+from time import time, sleep
+import collections
+import logging
+import os
+import struct
+
+# The simulator is always available but never picked automatically. Select it
+# with PYOCD_USB_BACKEND=sim.
+isAvailable = True
+
+# Environment variables used by getAllConnectedInterface()
+SIM_TARGET_ENV = 'PYOCD_SIM_TARGET'
+SIM_LATENCY_ENV = 'PYOCD_SIM_LATENCY'
+SIM_COUNT_ENV = 'PYOCD_SIM_COUNT'
+
+DEFAULT_SIM_TARGET = 'k64f'
+
+## @brief Parts the simulator knows how to model.
+#
+# The memory map and flash algorithm are taken from the pyOCD target and flash
+# classes of the same name.
+SIM_TARGETS = {
+    'k64f' : {
+        'board_id' : '0240',
+        'cpuid' : 0x410FC241,       # Cortex-M4 r0p1
+        'ahb_idr' : 0x24770011,
+        'mdm_idr' : 0x001c0000,
+        },
+    'kl25z' : {
+        'board_id' : '0200',
+        'cpuid' : 0x410CC601,       # Cortex-M0+ r0p1
+        'ahb_idr' : 0x04770031,
+        'mdm_idr' : 0x001c0020,
+        },
+    }
+
+# DAP_TRANSFER request bits
+REQ_APnDP = 1 << 0
+REQ_RnW = 1 << 1
+REQ_VALUE_MATCH = 1 << 4
+REQ_MATCH_MASK = 1 << 5
+
+# DP registers
+DP_IDCODE = 0x0
+DP_ABORT = 0x0
+DP_CTRL_STAT = 0x4
+DP_SELECT = 0x8
+DP_RDBUFF = 0xc
+STICKYERR = 1 << 5
+STKERRCLR = 1 << 2
+# CSYSPWRUPREQ and CDBGPWRUPREQ, each acknowledged by the bit above it
+PWRUPREQ_MASK = 0x50000000
+
+# AHB-AP registers
+AP_CSW = 0x00
+AP_TAR = 0x04
+AP_DRW = 0x0c
+AP_BD0 = 0x10
+AP_BASE = 0xf8
+AP_IDR = 0xfc
+CSW_SIZE_MASK = 0x7
+CSW_ADDRINC_SINGLE = 1 << 4
+
+# Kinetis MDM-AP
+MDM_APSEL = 1
+MDM_STATUS = 0x00
+MDM_CTRL = 0x04
+MDM_STATUS_FLASH_MASS_ERASE_ACKNOWLEDGE = 1 << 0
+MDM_STATUS_FLASH_READY = 1 << 1
+MDM_STATUS_MASS_ERASE_ENABLE = 1 << 5
+MDM_STATUS_CORE_HALTED = 1 << 16
+MDM_CTRL_FLASH_MASS_ERASE_IN_PROGRESS = 1 << 0
+MDM_CTRL_DEBUG_REQUEST = 1 << 2
+
+# System control space and debug components
+CPUID = 0xE000ED00
+AIRCR = 0xE000ED0C
+DFSR = 0xE000ED30
+CPACR = 0xE000ED88
+DHCSR = 0xE000EDF0
+DCRSR = 0xE000EDF4
+DCRDR = 0xE000EDF8
+DEMCR = 0xE000EDFC
+FP_CTRL = 0xE0002000
+FP_COMP0 = 0xE0002008
+DWT_CTRL = 0xE0001000
+
+DBGKEY = 0xA05F << 16
+C_DEBUGEN = 1 << 0
+C_HALT = 1 << 1
+C_STEP = 1 << 2
+C_MASKINTS = 1 << 3
+S_REGRDY = 1 << 16
+S_HALT = 1 << 17
+REGWnR = 1 << 16
+AIRCR_VECTKEY = 0x5FA << 16
+AIRCR_SYSRESETREQ = 1 << 2
+AIRCR_VECTRESET = 1 << 0
+VC_CORERESET = 1 << 0
+DFSR_HALTED = 1 << 0
+DFSR_BKPT = 1 << 1
+DFSR_VCATCH = 1 << 3
+FP_CTRL_ENABLE = 1 << 0
+FP_CTRL_KEY = 1 << 1
+BKPT_INSTR = 0xbe00
+BKPT_MASK = 0xff00
+BX_INSTR = 0x4700
+BX_MASK = 0xff87
+
+SP = 13
+LR = 14
+PC = 15
+XPSR = 16
+MSP = 17
+CFBP = 20
+
+FP_CODE_COUNT = 6
+FP_LIT_COUNT = 2
+DWT_COMP_COUNT = 4
+
+# Peripheral address ranges that accept any access
+PERIPHERAL_RANGES = ((0x40000000, 0x5fffffff), (0xe0000000, 0xe00fffff))
+
+class _Fault(Exception):
+    pass
+
+## @brief Model of a Cortex-M device seen through its SW-DP.
+#
+# Memory in the memory map is backed by bytearrays. Flash can only be changed
+# by the flash algorithm functions, which are modelled on the host: when the
+# core is resumed with the PC at a known function entry, the function runs to
+# completion and returns to LR, where the algorithm's BKPT halts the core.
+# The erase range program that Flash loads into RAM is recognized by its code
+# and modelled the same way. So is the CRC analyzer, which must also be at its
+# entry address.
+#
+# Code is not executed otherwise. A resumed core keeps running until it is
+# halted by the debugger, or until halt_after seconds have elapsed if that is
+# set, which models a breakpoint being hit. Code is taken to be straight-line,
+# as a step only advances the PC or follows a BX, so if an FPB breakpoint is
+# set above the PC the core halts on the nearest one right away. A step from
+# an FPB breakpoint halts on it again without moving.
+class SimulatedDevice(object):
+    def __init__(self, memory_map, flash_algo=None, cpuid=0x410FC241, ahb_idr=0x24770011,
+                 mdm_idr=None, idcode=0x2BA01477, tar_wrap=0x1000):
+        self.memory_map = memory_map
+        self.cpuid = cpuid
+        self.ahb_idr = ahb_idr
+        self.mdm_idr = mdm_idr
+        self.idcode = idcode
+        self.tar_wrap = tar_wrap
+        # Seconds the probe spends on each value-match retry
+        self.match_read_time = 0.0
+        self.halt_after = None
+        self.functions = {}
+        self.function_code = {}
+        self.memory = []
+        for region in memory_map.regions:
+            fill = 0xff if region.isFlash else 0x00
+            self.memory.append((region, bytearray([fill]) * region.length))
+        self.peripherals = {}
+
+        # DP and AP state
+        self.ctrl_stat = 0
+        self.select = 0
+        self.rdbuff = 0
+        self.csw = 0
+        self.tar = 0
+        self.mdm_ctrl = 0
+        self.mdm_status = MDM_STATUS_FLASH_READY | MDM_STATUS_MASS_ERASE_ENABLE
+
+        # Core state, the core starts running out of reset
+        self.regs = collections.defaultdict(int)
+        self.halted = False
+        self.dhcsr = 0
+        self.dcrdr = 0
+        self.demcr = 0
+        self.dfsr = 0
+        self.cpacr = 0
+        self.fp_ctrl = 0
+        self.fp_comp = [0] * FP_CODE_COUNT
+        self.dwt = {}
+        self._halt_at = None
+        self.in_reset = False
+        self.reset_count = 0
+        self.erase_range_code = None
+        self.erase_range_count = 0
+        self.resetCore()
+
+        if flash_algo is not None:
+            self.loadFlashAlgo(flash_algo)
+
+    ## @brief Register the functions of a pyOCD flash algorithm.
+    def loadFlashAlgo(self, algo):
+        self.functions[algo['pc_init'] & ~1] = lambda device: 0
+        self.functions[algo['pc_eraseAll'] & ~1] = SimulatedDevice._eraseAll
+        self.functions[algo['pc_erase_sector'] & ~1] = SimulatedDevice._eraseSector
+        self.functions[algo['pc_program_page'] & ~1] = SimulatedDevice._programPage
+        from ..flash.flash import erase_range_stub, analyzer
+        if algo.get('analyzer_supported'):
+            # The analyzer shares RAM with other programs, so its code must be there too
+            addr = algo['analyzer_address'] & ~1
+            self.functions[addr] = SimulatedDevice._computeCrcs
+            self.function_code[addr] = bytearray(struct.pack('<%iI' % len(analyzer), *analyzer))
+        # The erase range program is recognized by its code
+        self.erase_range_code = bytearray(struct.pack('<%iI' % len(erase_range_stub), *erase_range_stub))
+
+    def _eraseAll(self):
+        for region, data in self.memory:
+            if region.isFlash:
+                data[:] = bytearray([0xff]) * len(data)
+        return 0
+
+    def _eraseSector(self):
+        addr = self.regs[0]
+        region, data = self._findMemory(addr, 1)
+        if not region.isFlash:
+            return 1
+        offset = (addr - region.start) & ~(region.blocksize - 1)
+        data[offset:offset + region.blocksize] = bytearray([0xff]) * region.blocksize
+        return 0
+
+    def _programPage(self):
+        addr, size, buf = self.regs[0], self.regs[1], self.regs[2]
+        region, data = self._findMemory(addr, size)
+        if not region.isFlash:
+            return 1
+        src = self.readBytes(buf, size)
+        offset = addr - region.start
+        # Programming can only clear bits
+        for i in range(size):
+            data[offset + i] &= src[i]
+        return 0
+
+    def _computeCrcs(self):
+        ptr, count = self.regs[0], self.regs[1]
+        for i in range(count):
+            val = self.read32(ptr + i * 4)
+            size = 1 << (val & 0xffff)
+            addr = (val >> 16) * size
+            self.write32(ptr + i * 4, crc32(self.readBytes(addr, size)) & 0xffffffff)
+        return 0
+
+    ## @brief Apply a system reset.
+    def resetCore(self):
+        self.reset_count += 1
+        self.regs.clear()
+        self.regs[XPSR] = 0x01000000
+        boot = self.memory_map.getBootMemory()
+        if boot is not None:
+            self.regs[MSP] = self.regs[SP] = self.read32(boot.start)
+            self.regs[PC] = self.read32(boot.start + 4) & ~1
+        self.dhcsr &= C_DEBUGEN
+        self.fp_ctrl = 0
+        if (self.demcr & VC_CORERESET) and (self.dhcsr & C_DEBUGEN):
+            self._halt(DFSR_VCATCH)
+        else:
+            self.halted = False
+            self._run()
+
+    def setReset(self, asserted):
+        if asserted:
+            self.in_reset = True
+        elif self.in_reset:
+            self.in_reset = False
+            self.resetCore()
+
+    def _halt(self, reason):
+        self.halted = True
+        self._halt_at = None
+        self.dfsr |= reason
+        self.dhcsr = (self.dhcsr | C_HALT) & ~C_STEP
+
+    def _isBreakpoint(self, pc):
+        try:
+            # Any bkpt halts, whatever its immediate
+            if (self.read16(pc) & BKPT_MASK) == BKPT_INSTR:
+                return True
+        except _Fault:
+            return False
+        return self._isFPBBreakpoint(pc)
+
+    def _isFPBBreakpoint(self, pc):
+        if self.fp_ctrl & FP_CTRL_ENABLE:
+            for comp in self.fp_comp:
+                if (comp & 1) and (comp & 0x1ffffffc) == (pc & 0x1ffffffc):
+                    return True
+        return False
+
+    def _nextFPBBreakpoint(self, pc):
+        if not (self.fp_ctrl & FP_CTRL_ENABLE):
+            return None
+        addrs = []
+        for comp in self.fp_comp:
+            if comp & 1:
+                addr = comp & 0x1ffffffc
+                if (comp >> 30) == 2:
+                    addr += 2
+                if addr > pc:
+                    addrs.append(addr)
+        return min(addrs) if addrs else None
+
+    def _callFunction(self):
+        # Run a modelled function and return to LR
+        function = self.functions[self.regs[PC] & ~1]
+        self.regs[0] = function(self) & 0xffffffff
+        self.regs[PC] = self.regs[LR] & ~1
+
+    def _hasCode(self, pc, code):
+        if code is None:
+            return False
+        try:
+            return self.readBytes(pc, len(code)) == code
+        except _Fault:
+            return False
+
+    def _isFunction(self, pc):
+        if pc not in self.functions:
+            return False
+        return pc not in self.function_code or self._hasCode(pc, self.function_code[pc])
+
+    def _isEraseRangeStub(self, pc):
+        return self._hasCode(pc, self.erase_range_code)
+
+    def _eraseRange(self):
+        # Model the erase range program by calling the erase function per page
+        start, end, size, erase = self.regs[0], self.regs[1], self.regs[2], self.regs[3]
+        if not (erase & 1):
+            # BLX to an ARM state address is an INVSTATE UsageFault, and the
+            # core never gets back to the BKPT at LR
+            return
+        result = 0
+        for addr in range(start, end, size):
+            self.regs[0] = addr
+            result = self.functions[erase & ~1](self)
+            if result != 0:
+                break
+        self.erase_range_count += 1
+        self.regs[SP] = (self.regs[PC] & ~1) + len(self.erase_range_code)
+        self.regs[0] = result
+        self.regs[PC] = self.regs[LR] & ~1
+
+    def _run(self):
+        if self.mdm_ctrl & MDM_CTRL_DEBUG_REQUEST:
+            self._halt(DFSR_HALTED)
+            return
+        if self._isFunction(self.regs[PC] & ~1):
+            self._callFunction()
+        elif self._isEraseRangeStub(self.regs[PC] & ~1):
+            self._eraseRange()
+        if self.dhcsr & C_DEBUGEN and self._isBreakpoint(self.regs[PC]):
+            self._halt(DFSR_BKPT)
+            return
+        target = self._nextFPBBreakpoint(self.regs[PC])
+        if self.dhcsr & C_DEBUGEN and target is not None:
+            self.regs[PC] = target
+            self._halt(DFSR_BKPT)
+            return
+        self.halted = False
+        self.dhcsr &= ~C_HALT
+        if self.halt_after is not None:
+            self._halt_at = time() + self.halt_after
+
+    def _step(self):
+        pc = self.regs[PC] & ~1
+        if self.dhcsr & C_DEBUGEN and self._isFPBBreakpoint(pc):
+            # A comparator matching the pc fires again instead of stepping
+            self._halt(DFSR_BKPT)
+            return
+        if self._isFunction(pc):
+            self._callFunction()
+            self._halt(DFSR_HALTED)
+            return
+        try:
+            instr = self.read16(pc)
+        except _Fault:
+            instr = 0
+        if (instr & BX_MASK) == BX_INSTR:
+            self.regs[PC] = self.regs[(instr >> 3) & 0xf] & ~1
+        else:
+            self.regs[PC] = (pc + 2) & 0xffffffff
+        self._halt(DFSR_HALTED)
+
+    def _update(self):
+        # Let a running core hit its simulated breakpoint
+        if not self.halted and self._halt_at is not None and time() >= self._halt_at:
+            self._halt(DFSR_BKPT)
+
+    # Memory
+
+    def _findMemory(self, addr, size):
+        for region, data in self.memory:
+            if region.containsRange(addr, length=size):
+                return region, data
+        raise _Fault()
+
+    def readBytes(self, addr, size):
+        region, data = self._findMemory(addr, size)
+        offset = addr - region.start
+        return data[offset:offset + size]
+
+    def writeBytes(self, addr, data):
+        region, mem = self._findMemory(addr, len(data))
+        offset = addr - region.start
+        mem[offset:offset + len(data)] = data
+
+    def read16(self, addr):
+        return struct.unpack('<H', bytes(self.readBytes(addr, 2)))[0]
+
+    def read32(self, addr):
+        return self.readMemory(addr & ~3, 2)
+
+    def write32(self, addr, value):
+        self.writeMemory(addr & ~3, 2, value)
+
+    def readMemory(self, addr, size):
+        """
+        Read from the bus with a CSW size code and return the value in its
+        byte lanes, as the AHB-AP puts it in DRW.
+        """
+        nbytes = 1 << size
+        if self._isPeripheral(addr):
+            word = self._readPeripheral(addr & ~3)
+        else:
+            data = bytearray(4)
+            lane = addr & 3
+            data[lane:lane + nbytes] = self.readBytes(addr, nbytes)
+            word = struct.unpack('<I', bytes(data))[0]
+        return word
+
+    def writeMemory(self, addr, size, value):
+        nbytes = 1 << size
+        if self._isPeripheral(addr):
+            if nbytes != 4:
+                word = self._readPeripheral(addr & ~3)
+                mask = ((1 << (nbytes * 8)) - 1) << ((addr & 3) * 8)
+                value = (word & ~mask) | (value & mask)
+            self._writePeripheral(addr & ~3, value & 0xffffffff)
+            return
+        region, mem = self._findMemory(addr, nbytes)
+        if region.isFlash:
+            # Flash is not writable from the bus
+            raise _Fault()
+        lane = addr & 3
+        data = bytearray(struct.pack('<I', value & 0xffffffff))
+        offset = addr - region.start
+        mem[offset:offset + nbytes] = data[lane:lane + nbytes]
+
+    @staticmethod
+    def _isPeripheral(addr):
+        for start, end in PERIPHERAL_RANGES:
+            if start <= addr <= end:
+                return True
+        return False
+
+    def _readPeripheral(self, addr):
+        self._update()
+        if addr == DHCSR:
+            value = self.dhcsr | S_REGRDY
+            if self.halted:
+                value |= S_HALT
+            return value
+        elif addr == DCRDR:
+            return self.dcrdr
+        elif addr == DEMCR:
+            return self.demcr
+        elif addr == DFSR:
+            return self.dfsr
+        elif addr == CPUID:
+            return self.cpuid
+        elif addr == CPACR:
+            return self.cpacr
+        elif addr == AIRCR:
+            return 0xFA050000
+        elif addr == FP_CTRL:
+            return (self.fp_ctrl | ((FP_CODE_COUNT & 0x70) << 8) | (FP_LIT_COUNT << 8) |
+                    ((FP_CODE_COUNT & 0xf) << 4))
+        elif FP_COMP0 <= addr < FP_COMP0 + 4 * FP_CODE_COUNT:
+            return self.fp_comp[(addr - FP_COMP0) // 4]
+        elif addr == DWT_CTRL:
+            return DWT_COMP_COUNT << 28
+        elif DWT_CTRL < addr < DWT_CTRL + 0x1000:
+            return self.dwt.get(addr, 0)
+        return self.peripherals.get(addr, 0)
+
+    def _writePeripheral(self, addr, value):
+        self._update()
+        if addr == DHCSR:
+            if (value & 0xffff0000) == DBGKEY:
+                self._writeDHCSR(value & 0xffff)
+        elif addr == DCRSR:
+            reg = value & 0x7f
+            if value & REGWnR:
+                self.regs[reg] = self.dcrdr
+                if reg == SP:
+                    self.regs[MSP] = self.dcrdr
+                elif reg == MSP:
+                    self.regs[SP] = self.dcrdr
+            else:
+                self.dcrdr = self.regs[reg]
+        elif addr == DCRDR:
+            self.dcrdr = value
+        elif addr == DEMCR:
+            self.demcr = value
+        elif addr == DFSR:
+            self.dfsr &= ~value
+        elif addr == CPACR:
+            self.cpacr = value
+        elif addr == AIRCR:
+            if (value & 0xffff0000) == AIRCR_VECTKEY and value & (AIRCR_SYSRESETREQ | AIRCR_VECTRESET):
+                self.resetCore()
+        elif addr == FP_CTRL:
+            if value & FP_CTRL_KEY:
+                self.fp_ctrl = value & FP_CTRL_ENABLE
+        elif FP_COMP0 <= addr < FP_COMP0 + 4 * FP_CODE_COUNT:
+            self.fp_comp[(addr - FP_COMP0) // 4] = value
+        elif DWT_CTRL < addr < DWT_CTRL + 0x1000:
+            self.dwt[addr] = value
+        else:
+            self.peripherals[addr] = value
+
+    def _writeDHCSR(self, value):
+        was_halted = self.halted
+        self.dhcsr = value & (C_DEBUGEN | C_HALT | C_STEP | C_MASKINTS)
+        if not (value & C_DEBUGEN):
+            self.dhcsr = 0
+            if was_halted:
+                self._run()
+            return
+        if value & C_HALT:
+            if not was_halted:
+                self._halt(DFSR_HALTED)
+        elif was_halted:
+            if value & C_STEP:
+                self._step()
+            else:
+                self._run()
+
+    # SW-DP and access ports
+
+    def readDP(self, addr):
+        if addr == DP_IDCODE:
+            return self.idcode
+        elif addr == DP_CTRL_STAT:
+            return self.ctrl_stat | ((self.ctrl_stat & PWRUPREQ_MASK) << 1)
+        elif addr == DP_SELECT:
+            return self.select
+        return self.rdbuff
+
+    def writeDP(self, addr, value):
+        if addr == DP_ABORT:
+            if value & STKERRCLR:
+                self.ctrl_stat &= ~STICKYERR
+        elif addr == DP_CTRL_STAT:
+            self.ctrl_stat = (value & ~STICKYERR) | (self.ctrl_stat & STICKYERR)
+        elif addr == DP_SELECT:
+            self.select = value
+
+    def readAP(self, addr):
+        apsel = self.select >> 24
+        reg = (self.select & 0xf0) | addr
+        if apsel == MDM_APSEL and self.mdm_idr is not None:
+            if reg == MDM_STATUS:
+                status = self.mdm_status
+                if self.halted:
+                    status |= MDM_STATUS_CORE_HALTED
+                return status
+            elif reg == MDM_CTRL:
+                return self.mdm_ctrl
+            elif reg == AP_IDR:
+                return self.mdm_idr
+            return 0
+        if apsel != 0:
+            return 0
+        if reg == AP_CSW:
+            return self.csw
+        elif reg == AP_TAR:
+            return self.tar
+        elif reg == AP_DRW:
+            value = self.readMemory(self.tar, self.csw & CSW_SIZE_MASK)
+            self._incrementTAR()
+            return value
+        elif AP_BD0 <= reg < AP_BD0 + 0x10:
+            return self.read32((self.tar & ~0xf) | (reg - AP_BD0))
+        elif reg == AP_BASE:
+            return 0xE00FF003
+        elif reg == AP_IDR:
+            return self.ahb_idr
+        return 0
+
+    def writeAP(self, addr, value):
+        apsel = self.select >> 24
+        reg = (self.select & 0xf0) | addr
+        if apsel == MDM_APSEL and self.mdm_idr is not None:
+            if reg == MDM_CTRL:
+                self._writeMDMCtrl(value)
+            return
+        if apsel != 0:
+            return
+        if reg == AP_CSW:
+            self.csw = value
+        elif reg == AP_TAR:
+            self.tar = value
+        elif reg == AP_DRW:
+            self.writeMemory(self.tar, self.csw & CSW_SIZE_MASK, value)
+            self._incrementTAR()
+        elif AP_BD0 <= reg < AP_BD0 + 0x10:
+            self.write32((self.tar & ~0xf) | (reg - AP_BD0), value)
+
+    def _writeMDMCtrl(self, value):
+        if value & MDM_CTRL_FLASH_MASS_ERASE_IN_PROGRESS:
+            self._eraseAll()
+            self.mdm_status |= MDM_STATUS_FLASH_MASS_ERASE_ACKNOWLEDGE
+            value &= ~MDM_CTRL_FLASH_MASS_ERASE_IN_PROGRESS
+        self.mdm_ctrl = value
+        if value & MDM_CTRL_DEBUG_REQUEST and not self.halted:
+            self._halt(DFSR_HALTED)
+
+    def _incrementTAR(self):
+        if self.csw & CSW_ADDRINC_SINGLE:
+            size = 1 << (self.csw & CSW_SIZE_MASK)
+            wrap = self.tar_wrap - 1
+            self.tar = (self.tar & ~wrap) | ((self.tar + size) & wrap)
+
+    def transfer(self, request, value=0):
+        """
+        Perform one DAP_TRANSFER request and return the value read
+        """
+        addr = request & 0x0c
+        try:
+            if request & REQ_RnW:
+                if request & REQ_APnDP:
+                    value = self.readAP(addr)
+                    self.rdbuff = value
+                else:
+                    value = self.readDP(addr)
+                return value
+            if request & REQ_APnDP:
+                self.writeAP(addr, value)
+            else:
+                self.writeDP(addr, value)
+        except _Fault:
+            self.ctrl_stat |= STICKYERR
+            raise
+
+## @brief In-process CMSIS-DAP probe connected to a SimulatedDevice.
+#
+# Commands are executed when they are written. Each response becomes
+# readable latency seconds later, so with several packets in flight the
+# latency overlaps as it does on a real USB link. Writing more than
+# packet_count packets without reading their responses is an error, as it
+# would overflow a real probe's buffers.
+class SimulatedCMSISDAP(Interface):
+
+    isAvailable = isAvailable
+
+    def __init__(self, target=DEFAULT_SIM_TARGET, device=None, latency=0.0,
+                 packet_size=64, packet_count=4, serial=0):
+        super(SimulatedCMSISDAP, self).__init__()
+        self.vendor_name = "ARM"
+        self.product_name = "Simulated CMSIS-DAP"
+        self.packet_size = packet_size
+        self.packet_count = packet_count
+        self.latency = latency
+        self.unique_id = self.uniqueID(target, serial)
+        if device is None:
+            device = self.createDevice(target)
+        self.device = device
+        self.match_retry = 0
+        self.closed = False
+        self._responses = collections.deque()
+        self._last_ready = 0.0
+        self.resetStatistics()
+
+    @staticmethod
+    def createDevice(target):
+        """
+        Build a SimulatedDevice for a target in SIM_TARGETS, with the memory
+        map and flash algorithm pyOCD uses for it.
+        """
+        from ..target import TARGET
+        from ..flash import FLASH
+        profile = SIM_TARGETS[target]
+        # Some flash algos depend on the exact target class
+        flash_algo = FLASH[target](TARGET[target](None)).flash_algo
+        return SimulatedDevice(TARGET[target].memoryMap, flash_algo, cpuid=profile['cpuid'],
+                               ahb_idr=profile['ahb_idr'], mdm_idr=profile.get('mdm_idr'))
+
+    @staticmethod
+    def uniqueID(target, serial):
+        """
+        Return the unique id, also used as USB serial number, of the
+        simulated probe number serial.
+        """
+        profile = SIM_TARGETS.get(target, {})
+        return "%s0000%032x" % (profile.get('board_id', '0000'), serial)
+
+    @staticmethod
+    def getConnectedSerialNumbers(vid, pid):
+        """
+        Return the serial numbers of the probes getAllConnectedInterface()
+        would return.
+        """
+        target = os.getenv(SIM_TARGET_ENV, DEFAULT_SIM_TARGET)
+        count = int(os.getenv(SIM_COUNT_ENV, 1))
+        return [SimulatedCMSISDAP.uniqueID(target, i) for i in range(count)]
+
+    @staticmethod
+    def getAllConnectedInterface(vid, pid, exclude = ()):
+        """
+        Return PYOCD_SIM_COUNT simulated probes, one by default, except those
+        whose serial number is in exclude. The target is taken from
+        PYOCD_SIM_TARGET and the USB latency in seconds from PYOCD_SIM_LATENCY.
+        """
+        target = os.getenv(SIM_TARGET_ENV, DEFAULT_SIM_TARGET)
+        if target not in SIM_TARGETS:
+            logging.error("Unsupported simulated target %s", target)
+            return None
+        latency = float(os.getenv(SIM_LATENCY_ENV, 0))
+        count = int(os.getenv(SIM_COUNT_ENV, 1))
+        return [SimulatedCMSISDAP(target, latency=latency, serial=i) for i in range(count)
+                if SimulatedCMSISDAP.uniqueID(target, i) not in exclude]
+
+    def write(self, data):
+        if self.closed:
+            raise Exception("Interface closed")
+        data = bytearray(data)
+        if len(data) > self.packet_size:
+            raise Exception("Simulated probe: command of %d bytes exceeds packet size" % len(data))
+        if len(self._responses) >= self.packet_count:
+            raise Exception("Simulated probe: more than %d packets outstanding" % self.packet_count)
+        resp = self._execute(data)
+        if len(resp) > self.packet_size:
+            raise Exception("Simulated probe: response of %d bytes exceeds packet size" % len(resp))
+        resp.extend(bytearray(self.packet_size - len(resp)))
+        ready = max(time() + self.latency, self._last_ready)
+        self._last_ready = ready
+        self._responses.append((ready, resp))
+        self.write_count += 1
+        self.bytes_written += len(data)
+        self.max_outstanding = max(self.max_outstanding, len(self._responses))
+
+    def read(self, timeout=-1):
+        if not self._responses:
+            raise Exception("Simulated probe: read without a command outstanding")
+        ready, resp = self._responses.popleft()
+        delay = ready - time()
+        if delay > 0:
+            sleep(delay)
+        self.read_count += 1
+        self.bytes_read += len(resp)
+        return resp
+
+    def getStatistics(self):
+        return {
+            'write_count' : self.write_count,
+            'read_count' : self.read_count,
+            'bytes_written' : self.bytes_written,
+            'bytes_read' : self.bytes_read,
+            'max_outstanding' : self.max_outstanding,
+            }
+
+    def resetStatistics(self):
+        self.write_count = 0
+        self.read_count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.max_outstanding = 0
+
+    def setPacketCount(self, count):
+        self.packet_count = count
+
+    def setPacketSize(self, size):
+        self.packet_size = size
+
+    def close(self):
+        self.closed = True
+
+    def _execute(self, cmd):
+        command = cmd[0]
+        if command == COMMAND_ID['DAP_INFO']:
+            return self._info(cmd[1])
+        elif command == COMMAND_ID['DAP_CONNECT']:
+            # SWD only
+            return bytearray([command, 1 if cmd[1] in (0, 1) else 0])
+        elif command == COMMAND_ID['DAP_TRANSFER_CONFIGURE']:
+            self.match_retry = cmd[4] | (cmd[5] << 8)
+            return bytearray([command, DAP_OK])
+        elif command == COMMAND_ID['DAP_TRANSFER']:
+            return self._transfer(cmd)
+        elif command == COMMAND_ID['DAP_TRANSFER_BLOCK']:
+            return self._transferBlock(cmd)
+        elif command == COMMAND_ID['DAP_WRITE_ABORT']:
+            self.device.writeDP(DP_ABORT, struct.unpack_from('<I', bytes(cmd[2:6]))[0])
+            return bytearray([command, DAP_OK])
+        elif command == COMMAND_ID['DAP_RESET_TARGET']:
+            self.device.setReset(True)
+            self.device.setReset(False)
+            return bytearray([command, DAP_OK, 1])
+        elif command == COMMAND_ID['DAP_SWJ_PINS']:
+            output, select = cmd[1], cmd[2]
+            if select & 0x80:
+                self.device.setReset(not (output & 0x80))
+            return bytearray([command, 0x00 if self.device.in_reset else 0x80])
+        elif command in (COMMAND_ID['DAP_LED'], COMMAND_ID['DAP_DISCONNECT'],
+                         COMMAND_ID['DAP_DELAY'], COMMAND_ID['DAP_SWJ_CLOCK'],
+                         COMMAND_ID['DAP_SWJ_SEQUENCE'], COMMAND_ID['DAP_SWD_CONFIGURE']):
+            return bytearray([command, DAP_OK])
+        elif command == COMMAND_ID['DAP_VENDOR0']:
+            return bytearray([command, len(self.unique_id)]) + bytearray(self.unique_id)
+        elif command in (COMMAND_ID['DAP_JTAG_SEQUENCE'], COMMAND_ID['DAP_JTAG_CONFIGURE'],
+                         COMMAND_ID['DAP_JTAG_IDCODE']):
+            return bytearray([command, DAP_ERROR])
+        return bytearray([DAP_ERROR])
+
+    def _info(self, id_):
+        values = {
+            ID_INFO['VENDOR_ID'] : self.vendor_name,
+            ID_INFO['PRODUCT_ID'] : self.product_name,
+            ID_INFO['SERIAL_NUMBER'] : self.unique_id,
+            ID_INFO['CMSIS_DAP_FW_VERSION'] : "1.0",
+            }
+        if id_ == ID_INFO['CAPABILITIES']:
+            return bytearray([COMMAND_ID['DAP_INFO'], 1, 0x01])
+        elif id_ == ID_INFO['PACKET_COUNT']:
+            return bytearray([COMMAND_ID['DAP_INFO'], 1, self.packet_count])
+        elif id_ == ID_INFO['PACKET_SIZE']:
+            return bytearray([COMMAND_ID['DAP_INFO'], 2, self.packet_size & 0xff, self.packet_size >> 8])
+        value = values.get(id_, "")
+        return bytearray([COMMAND_ID['DAP_INFO'], len(value)]) + bytearray(value)
+
+    def _valueMatch(self, request, match, mask):
+        # Repeat the read as the probe would, for up to match_retry more reads
+        deadline = time() + (self.match_retry + 1) * self.device.match_read_time
+        for i in range(self.match_retry + 1):
+            if (self.device.transfer(request) & mask) == match:
+                return True
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            sleep(min(remaining, self.device.match_read_time))
+        return False
+
+    def _transfer(self, cmd):
+        count = cmd[2]
+        resp = bytearray([cmd[0], 0, DAP_TRANSFER_OK])
+        pos = 3
+        mask = 0xffffffff
+        for i in range(count):
+            request = cmd[pos]
+            pos += 1
+            value = 0
+            if not (request & REQ_RnW) or (request & REQ_VALUE_MATCH):
+                value = struct.unpack_from('<I', bytes(cmd[pos:pos + 4]))[0]
+                pos += 4
+            try:
+                if request & REQ_MATCH_MASK:
+                    mask = value
+                elif request & REQ_VALUE_MATCH:
+                    if not self._valueMatch(request & ~REQ_VALUE_MATCH, value, mask):
+                        resp[2] = DAP_TRANSFER_OK | DAP_TRANSFER_MISMATCH
+                        break
+                elif request & REQ_RnW:
+                    resp.extend(struct.pack('<I', self.device.transfer(request)))
+                else:
+                    self.device.transfer(request, value)
+            except _Fault:
+                resp[2] = DAP_TRANSFER_FAULT
+                break
+            resp[1] = i + 1
+        return resp
+
+    def _transferBlock(self, cmd):
+        count = cmd[2] | (cmd[3] << 8)
+        request = cmd[4]
+        resp = bytearray([cmd[0], 0, 0, DAP_TRANSFER_OK])
+        done = 0
+        try:
+            for i in range(count):
+                if request & REQ_RnW:
+                    resp.extend(struct.pack('<I', self.device.transfer(request)))
+                else:
+                    value = struct.unpack_from('<I', bytes(cmd[5 + i * 4:9 + i * 4]))[0]
+                    self.device.transfer(request, value)
+                done += 1
+        except _Fault:
+            resp[3] = DAP_TRANSFER_FAULT
+        resp[1] = done & 0xff
+        resp[2] = done >> 8
+        return resp
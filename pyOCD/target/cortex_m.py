@@ -17,15 +17,19 @@
 from xml.etree.ElementTree import (Element, SubElement, tostring)
 
 from .target import Target
+from .memory_cache import (MemoryCache, DEFAULT_LINE_SIZE)
+from .thumb import CodeRange
 from .target import (TARGET_RUNNING, TARGET_HALTED,
     BREAKPOINT_HW, BREAKPOINT_SW, BREAKPOINT_AUTO,
     WATCHPOINT_READ, WATCHPOINT_WRITE, WATCHPOINT_READ_WRITE)
 from ..transport.cmsis_dap import (DP_REG, AP_REG)
-from ..transport.transport import (READ_START, READ_NOW, READ_END)
+from ..transport.transport import (READ_START, READ_NOW, READ_END, TransferError)
 from ..gdbserver import signals
 from ..utility import conversion
+from ..utility.statistics import timed
 import logging
 import struct
+from time import time
 
 # Debug Fault Status Register
 DFSR = 0xE000ED30
@@ -225,6 +229,38 @@ CORE_REGISTER = {
                  's31': 0x5f,
                  }
 
+# Registers that are views of the same core state. Writing one changes
+# the value read back from the others.
+SP_REGISTERS = (13, 17, 18)
+CFBP_REGISTERS = (20, -1, -2, -3, -4)
+
+# Registers read together on the first register cache miss of a halt, so a
+# GDB stop is answered by a single batched read.
+CACHE_PREFETCH_REGISTERS = range(0, 17)
+
+# Range stepping single steps this many instructions before it decodes the
+# range and runs to hardware breakpoints on its exits instead.
+RANGE_STEP_RUN_AFTER = 8
+
+# Default time in seconds rangeStep() may take before returning to its caller.
+RANGE_STEP_TIMEOUT = 0.2
+
+# Reads of DHCSR made by the probe per round trip while waiting for the core
+# to reach a range step breakpoint.
+RANGE_STEP_MATCH_RETRY = 64
+
+# Debug events that end range stepping
+RANGE_STEP_STOP_EVENTS = DFSR_BKPT | DFSR_DWTTRAP
+
+# Thumb BKPT #0 instruction used for software breakpoints
+BKPT_INSTR = 0xbe00
+
+# struct formats used to update the memory cache on writes
+CACHE_WRITE_FORMAT = {8: '<B',
+                      16: '<H',
+                      32: '<I',
+                      }
+
 class Breakpoint(object):
     def __init__(self, comp_register_addr):
         self.type = BREAKPOINT_HW
@@ -234,6 +270,236 @@ class Breakpoint(object):
         self.original_instr = 0
 
 
+def _comparatorValue(addr):
+    """
+    Return the FPB comparator register value that breaks on the
+    instruction at addr.
+    """
+    bp_match = (1 << 30)
+    if addr & 0x2:
+        bp_match = (2 << 30)
+    return addr & 0x1ffffffc | bp_match | 1
+
+## @brief Applies the breakpoints set on a CortexM to the target lazily.
+#
+# The core's breakpoints dict and FPB comparator objects hold the breakpoints the
+# debugger wants. Setting or removing one only records the change; apply() writes
+# the net difference with what is installed on the target, in one batch of deferred
+# transfers, before the core runs. GDB removes every breakpoint when the core stops
+# and inserts them again before it resumes, so most of these changes cancel out.
+#
+# Software breakpoints live in target memory, so accesses to it call syncMemory()
+# first. The original instruction of each software breakpoint is kept, and used
+# again when the breakpoint is reinstalled, until the debugger writes over it.
+class BreakpointManager(object):
+    def __init__(self, core):
+        self.core = core
+        self._comp_installed = {}       # comparator register address -> value written
+        self._fpb_installed = False
+        self._sw_installed = {}         # address -> original instruction replaced by BKPT
+        self._originals = {}            # address -> original instruction known
+        self._sw_dirty = set()          # addresses of software breakpoints changed since apply
+        self._hw_dirty = False
+
+    def hardwareInstalled(self):
+        """
+        Record that the FPB and every comparator of the core were just
+        written with their current settings.
+        """
+        core = self.core
+        self._comp_installed = dict((bp.comp_register_addr, _comparatorValue(bp.addr) if bp.enabled else 0)
+                                    for bp in core.hw_breakpoints)
+        self._fpb_installed = core.fpb_enabled
+        self._hw_dirty = False
+
+    def hardwareChanged(self):
+        self._hw_dirty = True
+
+    def softwareChanged(self, addr):
+        self._sw_dirty.add(addr)
+
+    def originalInstruction(self, addr):
+        """
+        Return the instruction at addr without a breakpoint, reading it
+        from the target if it is not known yet. Raises TransferError if
+        the read fails.
+        """
+        if addr not in self._originals:
+            self._originals[addr] = self.core.readMemory(addr, 16)
+        return self._originals[addr]
+
+    def installedComparator(self, addr):
+        """
+        Return the register address of the comparator installed on the
+        target to break on the instruction at addr, or None.
+        """
+        value = _comparatorValue(addr)
+        for comp_addr, installed in self._comp_installed.items():
+            if installed == value:
+                return comp_addr
+        return None
+
+    def chooseComparator(self, free, addr):
+        """
+        Pick the comparator to use for a breakpoint at addr among the free
+        ones, preferring one already installed with that address.
+        """
+        value = _comparatorValue(addr)
+        for bp in free:
+            if self._comp_installed.get(bp.comp_register_addr) == value:
+                return bp
+        return free[0]
+
+    def apply(self):
+        """
+        Write the breakpoint changes made since the last call to the target.
+        Software breakpoint writes are flushed to check that they succeeded,
+        FPB writes are only queued.
+        """
+        if self._sw_dirty:
+            self._applySoftware(set(self._sw_dirty))
+        if self._hw_dirty:
+            self._applyHardware()
+
+    def syncMemory(self, addr, size, write = False):
+        """
+        Bring the software breakpoints in the size bytes at addr up to date
+        before they are accessed. For a write, also forget the breakpoints
+        installed there and the original instructions known there, as the
+        write replaces them.
+        """
+        if not self._sw_dirty and not (write and self._originals):
+            return
+        end = addr + size
+        pending = set(bp_addr for bp_addr in self._sw_dirty if bp_addr < end and bp_addr + 2 > addr)
+        if pending:
+            self._applySoftware(pending)
+        if not write:
+            return
+        for bp_addr in [bp_addr for bp_addr in self._sw_installed if bp_addr < end and bp_addr + 2 > addr]:
+            original = self._sw_installed.pop(bp_addr)
+            if bp_addr < addr or bp_addr + 2 > end:
+                # Half of the BKPT survives the write, so restore the original first
+                self.core._writeMemory(bp_addr, original, 16)
+            self._sw_dirty.add(bp_addr)
+        for bp_addr in [bp_addr for bp_addr in self._originals if bp_addr < end and bp_addr + 2 > addr]:
+            del self._originals[bp_addr]
+
+    def _applyHardware(self):
+        core = self.core
+        for bp in core.hw_breakpoints:
+            value = _comparatorValue(bp.addr) if bp.enabled else 0
+            if self._comp_installed.get(bp.comp_register_addr) != value:
+                core._writeMemory(bp.comp_register_addr, value)
+                self._comp_installed[bp.comp_register_addr] = value
+        if core.fpb_enabled != self._fpb_installed:
+            core._writeMemory(FP_CTRL, FP_CTRL_KEY | int(core.fpb_enabled))
+            self._fpb_installed = core.fpb_enabled
+        self._hw_dirty = False
+
+    def _wanted(self, addr):
+        bp = self.core.breakpoints.get(addr)
+        if bp is not None and bp.type == BREAKPOINT_SW:
+            return bp
+        return None
+
+    def _applySoftware(self, addrs):
+        core = self.core
+        self._sw_dirty -= addrs
+
+        # Read the original instructions not known yet in one batch
+        reads = {}
+        for addr in addrs:
+            if self._wanted(addr) and addr not in self._sw_installed and addr not in self._originals:
+                reads[addr] = core.transport.readMemAsync(addr, 16)
+        for addr, future in reads.items():
+            try:
+                self._originals[addr] = future.result()
+            except TransferError:
+                logging.error("Failed to set sw bp at 0x%x", addr)
+                del core.breakpoints[addr]
+
+        writes = []
+        for addr in sorted(addrs):
+            bp = self._wanted(addr)
+            if bp is not None:
+                if addr in self._sw_installed:
+                    continue
+                bp.original_instr = self._originals[addr]
+                writes.append((addr, bp, core._writeMemoryAsync(addr, BKPT_INSTR, 16)))
+                self._sw_installed[addr] = bp.original_instr
+            elif addr in self._sw_installed:
+                writes.append((addr, None, core._writeMemoryAsync(addr, self._sw_installed[addr], 16)))
+        if not writes:
+            return
+
+        # Check the writes here so a failure doesn't escape from resume
+        try:
+            core.flush()
+        except TransferError:
+            pass
+        failed = []
+        for addr, bp, future in writes:
+            try:
+                future.result()
+            except TransferError:
+                failed.append((addr, bp))
+            else:
+                if bp is None:
+                    del self._sw_installed[addr]
+        if failed:
+            self._checkFailedWrites(failed)
+
+    def _checkFailedWrites(self, failed):
+        # Transfers aborted after an error may still have been done by the
+        # probe, so read back what is in memory
+        core = self.core
+        core.invalidateMemoryCache()
+        reads = [(addr, bp, core.transport.readMemAsync(addr, 16)) for addr, bp in failed]
+        try:
+            core.flush()
+        except TransferError:
+            pass
+        for addr, bp, future in reads:
+            try:
+                value = future.result()
+            except TransferError:
+                value = None
+            if bp is not None:
+                if value == BKPT_INSTR or value is None:
+                    # Installed, or unknown, so a removal still restores it
+                    continue
+                logging.error("Failed to set sw bp at 0x%x", addr)
+                del self._sw_installed[addr]
+                if core.breakpoints.get(addr) is bp:
+                    del core.breakpoints[addr]
+            elif value == self._sw_installed[addr]:
+                del self._sw_installed[addr]
+            else:
+                # Try again when the breakpoints are next applied
+                logging.error("Failed to remove sw bp at 0x%x", addr)
+                self._sw_dirty.add(addr)
+
+
+## @brief Result of an asynchronous memory access made of several transfers.
+#
+# result() waits for every underlying transfer and combines their results.
+class MemoryFuture(object):
+    def __init__(self, futures, combine=None):
+        self._futures = futures
+        self._combine = combine
+
+    @property
+    def done(self):
+        return all(future.done for future in self._futures)
+
+    def result(self):
+        results = [future.result() for future in self._futures]
+        if self._combine is None:
+            return None
+        return self._combine(results)
+
+
 class Watchpoint():
     def __init__(self, comp_register_addr):
         self.comp_register_addr = comp_register_addr
@@ -341,6 +607,7 @@ class CortexM(Target):
         self.num_hw_breakpoint_used = 0
         self.nb_lit = 0
         self.fpb_enabled = False
+        self.breakpoint_manager = BreakpointManager(self)
         self.watchpoints = []
         self.watchpoint_used = 0
         self.dwt_configured = False
@@ -348,6 +615,12 @@ class CortexM(Target):
         self.core_type = 0
         self.has_fpu = False
         self.part_number = self.__class__.__name__
+        self.memory_cache = None
+        # Incremented each time the core may run. Cached register values
+        # belong to the current epoch only.
+        self.halt_epoch = 0
+        self._core_halted = False
+        self._reg_cache = {}
 
     def init(self, initial_setup=True, bus_accessible=True):
         """
@@ -461,6 +734,7 @@ class CortexM(Target):
         self.disableFPB()
         for bp in self.hw_breakpoints:
             self.writeMemory(bp.comp_register_addr, 0)
+        self.breakpoint_manager.hardwareInstalled()
 
     def setupDWT(self):
         """
@@ -498,9 +772,83 @@ class CortexM(Target):
         write a memory location.
         By default the transfer size is a word
         """
-        self.transport.writeMem(addr, value, transfer_size)
+        self.breakpoint_manager.syncMemory(addr, transfer_size // 8, True)
+        self._writeMemory(addr, value, transfer_size)
+
+    def _writeMemory(self, addr, value, transfer_size = 32):
+        self._writeMemoryAsync(addr, value, transfer_size)
+        if not self.transport.deferred_transfer:
+            self.flush()
         return
 
+    def _writeMemoryAsync(self, addr, value, transfer_size = 32):
+        future = self.transport.writeMemAsync(addr, value, transfer_size)
+        if self.memory_cache is not None:
+            self.memory_cache.write(addr, struct.pack(CACHE_WRITE_FORMAT[transfer_size],
+                                                      value & ((1 << transfer_size) - 1)))
+        return future
+
+    def enableMemoryCache(self, enable = True, line_size = DEFAULT_LINE_SIZE):
+        """
+        Enable or disable the host side cache of target memory.
+
+        While the core is halted, reads of RAM, ROM and flash are served
+        from the cache in lines of line_size bytes.
+        """
+        if enable:
+            self.memory_cache = MemoryCache(self.memory_map, line_size)
+        else:
+            self.memory_cache = None
+
+    def invalidateMemoryCache(self):
+        """
+        Drop cached memory contents, for example after memory was changed
+        without going through this target.
+        """
+        if self.memory_cache is not None:
+            self.memory_cache.invalidate()
+
+    def invalidateRegisterCache(self):
+        """
+        Drop cached core register values, for example after registers were
+        changed without going through this target.
+        """
+        self._reg_cache = {}
+
+    def getMemoryCacheStatistics(self):
+        if self.memory_cache is None:
+            return {}
+        return self.memory_cache.getStatistics()
+
+    def getStatistics(self):
+        """
+        Return the API latency histograms, in microseconds, with the memory
+        cache counters under 'memory_cache'.
+        """
+        stats = super(CortexM, self).getStatistics()
+        stats['memory_cache'] = self.getMemoryCacheStatistics()
+        return stats
+
+    def _coreHalted(self):
+        """
+        Record that the core is known to be halted, allowing memory and
+        registers to be cached until it may run again.
+        """
+        self._core_halted = True
+        if self.memory_cache is not None:
+            self.memory_cache.activate()
+
+    def _coreMayRun(self):
+        """
+        Start a new halt epoch. Called before anything that lets the core
+        run, which makes all cached core state stale.
+        """
+        self.breakpoint_manager.apply()
+        self.halt_epoch += 1
+        self._core_halted = False
+        self._reg_cache = {}
+        self.invalidateMemoryCache()
+
     def write32(self, addr, value):
         """
         Shorthand to write a 32-bit word.
@@ -524,6 +872,8 @@ class CortexM(Target):
         read a memory location. By default, a word will
         be read
         """
+        if mode != READ_END:
+            self.breakpoint_manager.syncMemory(addr, transfer_size // 8)
         return self.transport.readMem(addr, transfer_size, mode)
 
     def read32(self, addr):
@@ -549,70 +899,125 @@ class CortexM(Target):
         read a block of unaligned bytes in memory. Returns
         an array of byte values
         """
-        res = []
+        return list(self.readMemoryBytes(addr, size))
+
+    def readMemoryBytes(self, addr, size):
+        """
+        read a block of unaligned bytes in memory. Returns
+        a bytearray
+        """
+        return self.readMemoryAsync(addr, size).result()
+
+    def readMemoryAsync(self, addr, size):
+        """
+        start reading a block of unaligned bytes in memory. Returns
+        a future whose result is a bytearray.
+
+        Aligned words are requested from the probe immediately, so the
+        caller can do other work while they are transferred.
+        """
+        self.breakpoint_manager.syncMemory(addr, size)
+        cache = self.memory_cache
+        if cache is not None and cache.active and cache.isCacheable(addr, size):
+            data = cache.read(addr, size, self._readMemoryBytesUncached)
+            return MemoryFuture([], lambda results: data)
+        return self._readMemoryAsyncUncached(addr, size)
+
+    def _readMemoryBytesUncached(self, addr, size):
+        return self._readMemoryAsyncUncached(addr, size).result()
+
+    def _readMemoryAsyncUncached(self, addr, size):
+        futures = []
+        widths = []
 
         # try to read 8bits data
         if (size > 0) and (addr & 0x01):
-            mem = self.readMemory(addr, 8)
-#             logging.debug("get 1 byte at %s: 0x%X", hex(addr), mem)
-            res.append(mem)
+            futures.append(self.transport.readMemAsync(addr, 8))
+            widths.append(8)
             size -= 1
             addr += 1
 
         # try to read 16bits data
         if (size > 1) and (addr & 0x02):
-            mem = self.readMemory(addr, 16)
-#             logging.debug("get 2 bytes at %s: 0x%X", hex(addr), mem)
-            res.append(mem & 0xff)
-            res.append((mem >> 8) & 0xff)
+            futures.append(self.transport.readMemAsync(addr, 16))
+            widths.append(16)
             size -= 2
             addr += 2
 
         # try to read aligned block of 32bits
         if (size >= 4):
             #logging.debug("read blocks aligned at 0x%X, size: 0x%X", addr, (size/4)*4)
-            mem = self.readBlockMemoryAligned32(addr, size/4)
-            res += conversion.u32leListToByteList(mem)
-            size -= 4*len(mem)
-            addr += 4*len(mem)
+            pages = self._readPagesAsync(addr, size/4)
+            futures += pages
+            widths += [32] * len(pages)
+            addr += size & ~0x03
+            size -= size & ~0x03
 
         if (size > 1):
-            mem = self.readMemory(addr, 16)
-#             logging.debug("get 2 bytes at %s: 0x%X", hex(addr), mem)
-            res.append(mem & 0xff)
-            res.append((mem >> 8) & 0xff)
+            futures.append(self.transport.readMemAsync(addr, 16))
+            widths.append(16)
             size -= 2
             addr += 2
 
         if (size > 0):
-            mem = self.readMemory(addr, 8)
-#             logging.debug("get 1 byte remaining at %s: 0x%X", hex(addr), mem)
-            res.append(mem)
+            futures.append(self.transport.readMemAsync(addr, 8))
+            widths.append(8)
             size -= 1
             addr += 1
 
-        return res
+        def combine(results):
+            res = bytearray()
+            for width, mem in zip(widths, results):
+                if width == 8:
+                    res.append(mem)
+                elif width == 16:
+                    res += struct.pack('<H', mem)
+                else:
+                    res += mem
+            return res
 
+        return MemoryFuture(futures, combine)
 
     def writeBlockMemoryUnaligned8(self, addr, data):
         """
         write a block of unaligned bytes in memory.
         """
+        self.writeMemoryBytes(addr, data)
+
+    def writeMemoryBytes(self, addr, data):
+        """
+        write a block of unaligned bytes in memory. data can be
+        a bytearray, str, memoryview or list of byte values.
+        """
+        future = self.writeMemoryAsync(addr, data)
+        if not self.transport.deferred_transfer:
+            future.result()
+
+    def writeMemoryAsync(self, addr, data):
+        """
+        start writing a block of unaligned bytes in memory. Returns
+        a future that completes once the probe has acknowledged
+        every write.
+        """
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        self.breakpoint_manager.syncMemory(addr, len(data), True)
+        if self.memory_cache is not None:
+            self.memory_cache.write(addr, data)
         size = len(data)
         idx = 0
+        futures = []
 
         #try to write 8 bits data
         if (size > 0) and (addr & 0x01):
-#             logging.debug("write 1 byte at 0x%X: 0x%X", addr, data[idx])
-            self.writeMemory(addr, data[idx], 8)
+            futures.append(self.transport.writeMemAsync(addr, data[idx], 8))
             size -= 1
             addr += 1
             idx += 1
 
         # try to write 16 bits data
         if (size > 1) and (addr & 0x02):
-#             logging.debug("write 2 bytes at 0x%X: 0x%X", addr, data[idx] | (data[idx+1] << 8))
-            self.writeMemory(addr, data[idx] | (data[idx+1] << 8), 16)
+            futures.append(self.transport.writeMemAsync(addr, data[idx] | (data[idx+1] << 8), 16))
             size -= 2
             addr += 2
             idx += 2
@@ -620,59 +1025,97 @@ class CortexM(Target):
         # write aligned block of 32 bits
         if (size >= 4):
             #logging.debug("write blocks aligned at 0x%X, size: 0x%X", addr, (size/4)*4)
-            data32 = conversion.byteListToU32leList(data[idx:idx + (size & ~0x03)])
-            self.writeBlockMemoryAligned32(addr, data32)
+            futures += self._writePagesAsync(addr, data[idx:idx + (size & ~0x03)])
             addr += size & ~0x03
             idx += size & ~0x03
             size -= size & ~0x03
 
         # try to write 16 bits data
         if (size > 1):
-#             logging.debug("write 2 bytes at 0x%X: 0x%X", addr, data[idx] | (data[idx+1] << 8))
-            self.writeMemory(addr, data[idx] | (data[idx+1] << 8), 16)
+            futures.append(self.transport.writeMemAsync(addr, data[idx] | (data[idx+1] << 8), 16))
             size -= 2
             addr += 2
             idx += 2
 
         #try to write 8 bits data
         if (size > 0):
-#             logging.debug("write 1 byte at 0x%X: 0x%X", addr, data[idx])
-            self.writeMemory(addr, data[idx], 8)
+            futures.append(self.transport.writeMemAsync(addr, data[idx], 8))
             size -= 1
             addr += 1
             idx += 1
 
-        return
+        return MemoryFuture(futures)
 
     def writeBlockMemoryAligned32(self, addr, data):
         """
         write a block of aligned words in memory.
         """
-        size = len(data)
-        while size > 0:
-            n = self.auto_increment_page_size - (addr & (self.auto_increment_page_size - 1))
-            if size*4 < n:
-                n = (size*4) & 0xfffffffc
-            self.transport.writeBlock32(addr, data[:n/4])
-            data = data[n/4:]
-            size -= n/4
-            addr += n
-        return
+        future = self.writeBlockMemoryAligned32Async(addr, data)
+        if not self.transport.deferred_transfer:
+            future.result()
+
+    def writeBlockMemoryAligned32Async(self, addr, data):
+        """
+        start writing a block of aligned words in memory. Every
+        auto-increment page is sent without waiting for the previous
+        one to be acknowledged.  Returns a future that completes once
+        all pages have been written.
+        """
+        data = conversion.u32leListToBytes(data)
+        self.breakpoint_manager.syncMemory(addr, len(data), True)
+        if self.memory_cache is not None:
+            self.memory_cache.write(addr, data)
+        return MemoryFuture(self._writePagesAsync(addr, data))
 
+    @timed('readBlockMemoryAligned32')
     def readBlockMemoryAligned32(self, addr, size):
         """
         read a block of aligned words in memory. Returns
         an array of word values
         """
-        resp = []
+        return self.readBlockMemoryAligned32Async(addr, size).result()
+
+    def readBlockMemoryAligned32Async(self, addr, size):
+        """
+        start reading a block of aligned words in memory. Every
+        auto-increment page is requested without waiting for the data
+        of the previous one.  Returns a future whose result is an array
+        of word values.
+        """
+        self.breakpoint_manager.syncMemory(addr, size * 4)
+        return MemoryFuture(self._readPagesAsync(addr, size),
+                            lambda results: conversion.bytesToU32leList(bytearray().join(results)))
+
+    def _readPagesAsync(self, addr, size):
+        """
+        queue reads of size aligned words, one block per auto-increment
+        page. Returns the transport futures, each giving a bytearray.
+        """
+        futures = []
         while size > 0:
             n = self.auto_increment_page_size - (addr & (self.auto_increment_page_size - 1))
             if size*4 < n:
                 n = (size*4) & 0xfffffffc
-            resp += self.transport.readBlock32(addr, n/4)
+            futures.append(self.transport.readBlock32Async(addr, n/4, as_bytes=True))
             size -= n/4
             addr += n
-        return resp
+        return futures
+
+    def _writePagesAsync(self, addr, data):
+        """
+        queue writes of a bytearray of aligned words, one block per
+        auto-increment page. Returns the transport futures.
+        """
+        futures = []
+        offset = 0
+        size = len(data)
+        while offset < size:
+            n = self.auto_increment_page_size - (addr & (self.auto_increment_page_size - 1))
+            n = min(n, size - offset)
+            futures.append(self.transport.writeBlock32Async(addr, data[offset:offset + n]))
+            offset += n
+            addr += n
+        return futures
 
     def halt(self):
         """
@@ -680,8 +1123,10 @@ class CortexM(Target):
         """
         self.writeMemory(DHCSR, DBGKEY | C_DEBUGEN | C_HALT)
         self.flush()
+        self._coreHalted()
         return
 
+    @timed('step')
     def step(self, disable_interrupts = True):
         """
         perform an instruction level step.  This function preserves the previous
@@ -694,6 +1139,7 @@ class CortexM(Target):
             logging.error('cannot step: target not halted')
             return
 
+        self._coreMayRun()
         self.clearDebugCauseBits()
 
         # Save previous interrupt mask state
@@ -719,8 +1165,146 @@ class CortexM(Target):
             self.writeMemory(DHCSR, DBGKEY | C_DEBUGEN | C_HALT )
 
         self.flush()
+        self._coreHalted()
         return
 
+    @timed('rangeStep')
+    def rangeStep(self, start, end, disable_interrupts = True, timeout = RANGE_STEP_TIMEOUT):
+        """
+        Step once, then keep stepping while the pc stays in [start, end).
+
+        Each step is a single batch of transfers that also reads back the
+        pc, so a step costs one USB round trip.  If the pc is still in the
+        range after RANGE_STEP_RUN_AFTER steps, the code in the range is
+        decoded and the core runs to hardware breakpoints set on every exit
+        of the range, stepping only instructions whose target is unknown.
+
+        Stepping also ends at a breakpoint or watchpoint.  Return True
+        when stepping ended, or False if it is not finished after timeout
+        seconds.  The core is halted in both cases.
+        """
+        dhcsr = self.readMemory(DHCSR)
+        if not (dhcsr & (C_STEP | C_HALT)):
+            logging.error('cannot step: target not halted')
+            return True
+
+        # Mask interrupts for the whole operation rather than for each step
+        interrupts_masked = (C_MASKINTS & dhcsr) != 0
+        control = DBGKEY | C_DEBUGEN
+        if disable_interrupts or interrupts_masked:
+            control |= C_MASKINTS
+
+        self._coreMayRun()
+        if not interrupts_masked and disable_interrupts:
+            self.writeMemory(DHCSR, DBGKEY | C_DEBUGEN | C_HALT | C_MASKINTS)
+
+        deadline = time() + timeout
+        code = None
+        decoded = False
+        temporary = []
+        steps = 0
+        try:
+            self.clearDebugCauseBits()
+            pc, dfsr = self._controlAndReadPC(control | C_STEP, deadline)
+            while True:
+                if not (start <= pc < end):
+                    return True
+                if self.findBreakpoint(pc) is not None and pc not in temporary:
+                    return True
+                if (dfsr & RANGE_STEP_STOP_EVENTS) and pc not in temporary:
+                    return True
+                if time() >= deadline:
+                    return False
+
+                if not decoded and steps >= RANGE_STEP_RUN_AFTER:
+                    decoded = True
+                    code = self._rangeStepBreakpoints(start, end, temporary)
+
+                if code is not None and pc in code.boundaries and pc not in code.step_points:
+                    pc, dfsr = self._runToBreakpoint(control, deadline)
+                else:
+                    pc, dfsr = self._stepFrom(pc, control, deadline)
+                    steps += 1
+        finally:
+            for addr in temporary:
+                self.removeBreakpoint(addr)
+
+            # Restore interrupt mask state
+            if not interrupts_masked and disable_interrupts:
+                self.writeMemory(DHCSR, DBGKEY | C_DEBUGEN | C_HALT)
+
+            self.flush()
+            self._coreHalted()
+
+    def _stepFrom(self, pc, control, deadline):
+        """
+        Single step the instruction at pc and return the new pc and DFSR.
+        A comparator installed at pc would match again instead of letting
+        the core step, so it is turned off for the step.
+        """
+        comp_addr = self.breakpoint_manager.installedComparator(pc)
+        if comp_addr is not None:
+            self._writeMemory(comp_addr, 0)
+        self.clearDebugCauseBits()
+        result = self._controlAndReadPC(control | C_STEP, deadline)
+        if comp_addr is not None:
+            self._writeMemory(comp_addr, _comparatorValue(pc))
+        return result
+
+    def _controlAndReadPC(self, dhcsr, deadline):
+        """
+        Write DHCSR to step or halt the core and read back the pc and DFSR
+        in the same batch of transfers.  A core still not halted when the
+        deadline passes is halted with C_HALT.
+        """
+        self.writeMemory(DHCSR, dhcsr)
+        # The core has long finished a step or halted by the time the probe
+        # gets to the next transfer, so DCRSR can be written without polling.
+        self.writeMemory(DCRSR, CORE_REGISTER['pc'])
+        status = self.transport.readMemAsync(DHCSR)
+        pc = self.transport.readMemAsync(DCRDR)
+        dfsr = self.transport.readMemAsync(DFSR)
+        if (status.result() & (S_HALT | S_REGRDY)) == (S_HALT | S_REGRDY):
+            return pc.result(), dfsr.result()
+
+        # The core was slow to halt, for example because it is sleeping
+        while not self.readMemory(DHCSR) & S_HALT:
+            if time() >= deadline:
+                self.writeMemory(DHCSR, (dhcsr & ~C_STEP) | C_HALT)
+                self.transport.waitForMatch(DHCSR, S_HALT, S_HALT, RANGE_STEP_MATCH_RETRY)
+                break
+        return self._readCoreRegistersRaw([CORE_REGISTER['pc']])[0], self.readMemory(DFSR)
+
+    def _rangeStepBreakpoints(self, start, end, temporary):
+        """
+        Decode the code in the range and set hardware breakpoints on its
+        exits and on the instructions that must be stepped.  The addresses
+        of the breakpoints set are appended to temporary.  Returns the
+        CodeRange, or None if the breakpoints can't be set.
+        """
+        code = CodeRange(start, end, self._readMemoryBytesUncached(start, end - start))
+        addrs = [addr for addr in sorted(code.breakpoints()) if self.findBreakpoint(addr) is None]
+        if any(addr >= 0x20000000 for addr in addrs) or len(addrs) > self.availableBreakpoint():
+            return None
+        for addr in addrs:
+            if not self.setBreakpoint(addr, BREAKPOINT_HW):
+                return None
+            temporary.append(addr)
+        return code
+
+    def _runToBreakpoint(self, control, deadline):
+        """
+        Let the core run until it halts or the deadline passes, and return
+        the pc and DFSR.
+        """
+        self.breakpoint_manager.apply()
+        self.clearDebugCauseBits()
+        self.writeMemory(DHCSR, control)
+        while not self.transport.waitForMatch(DHCSR, S_HALT, S_HALT, RANGE_STEP_MATCH_RETRY):
+            if time() >= deadline:
+                break
+        return self._controlAndReadPC(control | C_HALT, deadline)
+
     def clearDebugCauseBits(self):
         self.writeMemory(DFSR, DFSR_DWTTRAP | DFSR_BKPT | DFSR_HALTED)
 
@@ -733,6 +1317,8 @@ class CortexM(Target):
             # Default to software reset if nothing is specified
             software_reset = True
 
+        self._coreMayRun()
+
         if software_reset:
             self.writeMemory(NVIC_AIRCR, NVIC_AIRCR_VECTKEY | NVIC_AIRCR_SYSRESETREQ)
             # Without a flush a transfer error can occur
@@ -771,12 +1357,24 @@ class CortexM(Target):
             # points to an ARM address
             self.writeCoreRegister('xpsr', 0x1000000)
 
+    @timed('getState')
     def getState(self):
         dhcsr = self.readMemory(DHCSR)
         if dhcsr & (C_STEP | C_HALT):
+            self._coreHalted()
             return TARGET_HALTED
         return TARGET_RUNNING
 
+    def waitForHalt(self, retry = 0):
+        """
+        Return True if the core is halted.  The probe rereads DHCSR up to
+        retry times waiting for S_HALT when the transport supports value
+        match, so a running core costs one USB round trip per call.
+        """
+        if not self.transport.waitForMatch(DHCSR, S_HALT, S_HALT, retry):
+            return False
+        return self.getState() == TARGET_HALTED
+
     def resume(self):
         """
         resume the execution
@@ -784,6 +1382,7 @@ class CortexM(Target):
         if self.getState() != TARGET_HALTED:
             logging.debug('cannot resume: target not halted')
             return
+        self._coreMayRun()
         self.clearDebugCauseBits()
         self.writeMemory(DHCSR, DBGKEY | C_DEBUGEN)
         self.flush()
@@ -827,6 +1426,7 @@ class CortexM(Target):
         vals = self.readCoreRegistersRaw([reg])
         return vals[0]
 
+    @timed('readCoreRegistersRaw')
     def readCoreRegistersRaw(self, reg_list):
         """
         Read one or more core registers
@@ -835,6 +1435,45 @@ class CortexM(Target):
         If any register in reg_list is a string, find the number
         associated to this register in the lookup table CORE_REGISTER.
         """
+        reg_list = self._checkRegisterList(reg_list)
+
+        # Registers can only be cached while the core is halted
+        if not self._core_halted:
+            return self._readCoreRegistersRaw(reg_list)
+
+        cache = self._reg_cache
+        missing = self._uncachedRegisters(reg_list)
+        if missing:
+            cache.update(zip(missing, self._readCoreRegistersRaw(missing)))
+        return [cache[reg] for reg in reg_list]
+
+    def readCoreRegistersAsync(self, reg_list):
+        """
+        Start reading one or more core registers
+
+        Return a MemoryFuture whose result is the list of values of the
+        registers in reg_list.  The transfers are queued without waiting
+        for the probe, so they can share packets with other reads.  If
+        every register is cached the future is already done.  Unlike
+        readCoreRegistersRaw() no other registers are prefetched.
+        """
+        reg_list = self._checkRegisterList(reg_list)
+
+        if not self._core_halted:
+            return self._readCoreRegistersAsync(reg_list)
+
+        cache = self._reg_cache
+        missing = self._uncachedRegisters(reg_list, prefetch = False)
+        if not missing:
+            values = [cache[reg] for reg in reg_list]
+            return MemoryFuture([], lambda results: values)
+
+        def combine(results):
+            cache.update(zip(missing, results[0]))
+            return [cache[reg] for reg in reg_list]
+        return MemoryFuture([self._readCoreRegistersAsync(missing)], combine)
+
+    def _checkRegisterList(self, reg_list, access = "read"):
         # convert to index only
         reg_list = [self.registerNameToIndex(reg) for reg in reg_list]
 
@@ -843,9 +1482,30 @@ class CortexM(Target):
             if reg not in CORE_REGISTER.values():
                 raise ValueError("unknown reg: %d" % reg)
             elif ((reg >= 128) or (reg == 33)) and (not self.has_fpu):
-                raise ValueError("attempt to read FPU register without FPU")
+                raise ValueError("attempt to %s FPU register without FPU" % access)
+        return reg_list
 
-        # Begin all reads and writes
+    def _uncachedRegisters(self, reg_list, prefetch = True):
+        """
+        Return the registers of reg_list missing from the register cache,
+        plus the prefetched registers if any register is missing.
+        """
+        cache = self._reg_cache
+        missing = []
+        for reg in reg_list:
+            if reg not in cache and reg not in missing:
+                missing.append(reg)
+        if missing and prefetch:
+            missing += [reg for reg in CACHE_PREFETCH_REGISTERS
+                        if reg not in cache and reg not in missing]
+        return missing
+
+    def _readCoreRegistersRaw(self, reg_list):
+        return self._readCoreRegistersAsync(reg_list).result()
+
+    def _readCoreRegistersAsync(self, reg_list):
+        # Begin all reads
+        futures = []
         for reg in reg_list:
             if (reg < 0) and (reg >= -4):
                 reg = CORE_REGISTER['cfbp']
@@ -856,25 +1516,22 @@ class CortexM(Target):
             # Technically, we need to poll S_REGRDY in DHCSR here before reading DCRDR. But
             # we're running so slow compared to the target that it's not necessary.
             # Read it and assert that S_REGRDY is set
+            futures.append(self.transport.readMemAsync(DHCSR))
+            futures.append(self.transport.readMemAsync(DCRDR))
 
-            self.readMemory(DHCSR, mode=READ_START)
-            self.readMemory(DCRDR, mode=READ_START)
-
-        # Read all results
-        reg_vals = []
-        for reg in reg_list:
-            dhcsr_val = self.readMemory(DHCSR, mode=READ_END)
-            assert dhcsr_val & S_REGRDY
-            # read DCRDR
-            val = self.readMemory(DCRDR, mode=READ_END)
-
-            # Special handling for registers that are combined into a single DCRSR number.
-            if (reg < 0) and (reg >= -4):
-                val = (val >> ((-reg - 1) * 8)) & 0xff
+        def combine(results):
+            reg_vals = []
+            for i, reg in enumerate(reg_list):
+                dhcsr_val, val = results[2 * i], results[2 * i + 1]
+                assert dhcsr_val & S_REGRDY
 
-            reg_vals.append(val)
+                # Special handling for registers that are combined into a single DCRSR number.
+                if (reg < 0) and (reg >= -4):
+                    val = (val >> ((-reg - 1) * 8)) & 0xff
 
-        return reg_vals
+                reg_vals.append(val)
+            return reg_vals
+        return MemoryFuture(futures, combine)
 
     def writeCoreRegister(self, reg, data):
         """
@@ -904,15 +1561,7 @@ class CortexM(Target):
         associated to this register in the lookup table CORE_REGISTER.
         """
         assert len(reg_list) == len(data_list)
-        # convert to index only
-        reg_list = [self.registerNameToIndex(reg) for reg in reg_list]
-
-        # Sanity check register values
-        for reg in reg_list:
-            if reg not in CORE_REGISTER.values():
-                raise ValueError("unknown reg: %d" % reg)
-            elif ((reg >= 128) or (reg == 33)) and (not self.has_fpu):
-                raise ValueError("attempt to write FPU register without FPU")
+        reg_list = self._checkRegisterList(reg_list, "write")
 
         # Read special register if it is present in the list
         for reg in reg_list:
@@ -946,6 +1595,26 @@ class CortexM(Target):
             dhcsr_val = self.readMemory(DHCSR, mode=READ_END)
             assert dhcsr_val & S_REGRDY
 
+        if self._core_halted:
+            self._updateRegisterCache(reg_list, data_list)
+
+    def _updateRegisterCache(self, reg_list, data_list):
+        """
+        Keep the register cache coherent with registers just written
+        """
+        cache = self._reg_cache
+        for reg, data in zip(reg_list, data_list):
+            if reg in CFBP_REGISTERS:
+                # CONTROL may also select a different stack pointer
+                for alias in CFBP_REGISTERS + SP_REGISTERS:
+                    cache.pop(alias, None)
+            elif reg in SP_REGISTERS:
+                for alias in SP_REGISTERS:
+                    cache.pop(alias, None)
+                cache[reg] = data
+            else:
+                cache[reg] = data
+
     ## @brief Set a hardware or software breakpoint at a specific location in memory.
     #
     # @retval True Breakpoint was set.
@@ -1027,44 +1696,40 @@ class CortexM(Target):
         return bp.type if (bp is not None) else None
 
     def setSoftwareBreakpoint(self, addr):
+        """
+        set a software breakpoint. The BKPT instruction is written
+        to memory when the core next runs or the address is accessed.
+        """
         assert self.memory_map.getRegionForAddress(addr).isRam
         assert (addr & 1) == 0
 
+        # Create bp object.
+        bp = Breakpoint(0)
+        bp.type = BREAKPOINT_SW
+        bp.enabled = True
+        bp.addr = addr
         try:
-            # Read original instruction.
-            instr = self.read16(addr)
-
-            # Insert BKPT #0 instruction.
-            self.write16(addr, 0xbe00)
-
-            # Create bp object.
-            bp = Breakpoint(0)
-            bp.type = BREAKPOINT_SW
-            bp.enabled = True
-            bp.addr = addr
-            bp.original_instr = instr
-
-            self.breakpoints[addr] = bp
-            return True
+            bp.original_instr = self.breakpoint_manager.originalInstruction(addr)
         except TransferError:
-            logging.debug("Failed to set sw bp at 0x%x" % addr)
+            logging.error("Failed to set sw bp at 0x%x", addr)
             return False
 
+        self.breakpoints[addr] = bp
+        self.breakpoint_manager.softwareChanged(addr)
+        return True
+
     def removeSoftwareBreakpoint(self, bp):
         assert bp is not None and isinstance(bp, Breakpoint)
 
-        try:
-            # Restore original instruction.
-            self.write16(bp.addr, bp.original_instr)
-        except TransferError:
-            logging.debug("Failed to set sw bp at 0x%x" % addr)
+        # The original instruction is restored when the core next runs
+        # or the address is accessed.
+        self.breakpoint_manager.softwareChanged(bp.addr)
 
     def setHardwareBreakpoint(self, addr):
         """
-        set a hardware breakpoint at a specific location in flash
+        set a hardware breakpoint at a specific location in flash.
+        The FPB is updated when the core next runs.
         """
-        if self.fpb_enabled is False:
-            self.enableFPB()
 
         if addr >= 0x20000000:
             # Hardware breakpoints are only supported in the range
@@ -1076,22 +1741,29 @@ class CortexM(Target):
             logging.error('No more available breakpoint!!, dropped bp at 0x%X', addr)
             return False
 
-        for bp in self.hw_breakpoints:
-            if not bp.enabled:
-                bp.enabled = True
-                bp_match = (1 << 30)
-                if addr & 0x2:
-                    bp_match = (2 << 30)
-                self.writeMemory(bp.comp_register_addr, addr & 0x1ffffffc | bp_match | 1)
-                bp.addr = addr
-                self.num_hw_breakpoint_used += 1
-                self.breakpoints[addr] = bp
-                return True
-        return False
+        free = [bp for bp in self.hw_breakpoints if not bp.enabled]
+        if not free:
+            return False
+        bp = self.breakpoint_manager.chooseComparator(free, addr)
+        bp.enabled = True
+        bp.addr = addr
+        self.num_hw_breakpoint_used += 1
+        self.breakpoints[addr] = bp
+        self.fpb_enabled = True
+        self.breakpoint_manager.hardwareChanged()
+        return True
 
     def availableBreakpoint(self):
         return len(self.hw_breakpoints) - self.num_hw_breakpoint_used
 
+    def flushBreakpoints(self):
+        """
+        Write the breakpoint changes not applied yet to the target now,
+        for example to change breakpoints while the core runs.
+        """
+        self.breakpoint_manager.apply()
+        self.flush()
+
     def enableFPB(self):
         self.writeMemory(FP_CTRL, FP_CTRL_KEY | 1)
         self.fpb_enabled = True
@@ -1111,9 +1783,8 @@ class CortexM(Target):
         for bp in self.hw_breakpoints:
             if bp.enabled and bp.addr == addr:
                 bp.enabled = False
-                self.writeMemory(bp.comp_register_addr, 0)
-                bp.addr = addr
                 self.num_hw_breakpoint_used -= 1
+                self.breakpoint_manager.hardwareChanged()
                 return
         return
 
@@ -0,0 +1,145 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+# Default number of bytes fetched from the target for each cache miss.
+DEFAULT_LINE_SIZE = 64
+
+## @brief Write-through cache of target memory for a halted core.
+#
+# Memory is cached in aligned lines of line_size bytes and only for RAM, ROM
+# and flash regions of the memory map, never for peripheral space. Accesses
+# that are not fully inside one cacheable region bypass the cache.
+#
+# The cache only serves reads while it is active. The target activates it
+# once the core is known to be halted and invalidates it whenever the core
+# may change memory: resume, step, reset and flash programming.
+class MemoryCache(object):
+    def __init__(self, memoryMap, line_size=DEFAULT_LINE_SIZE):
+        assert line_size >= 4 and (line_size & (line_size - 1)) == 0, "line size must be a power of 2"
+        self._memory_map = memoryMap
+        self._line_size = line_size
+        self._lines = {}
+        self._active = False
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.invalidations = 0
+
+    @property
+    def line_size(self):
+        return self._line_size
+
+    @property
+    def active(self):
+        return self._active
+
+    def activate(self):
+        """
+        Start serving reads from the cache. Call only while the core is halted.
+        """
+        self._active = True
+
+    def invalidate(self):
+        """
+        Drop all cached lines and stop serving reads until activated again.
+        """
+        if self._lines:
+            self.invalidations += 1
+        self._lines = {}
+        self._active = False
+
+    def isCacheable(self, addr, size):
+        """
+        Return True if the range is inside a single RAM, ROM or flash region
+        whose line aligned bounds are also inside the region.
+        """
+        if self._memory_map is None or size <= 0:
+            return False
+        region = self._memory_map.getRegionForAddress(addr)
+        if region is None or not (region.isRam or region.isRom or region.isFlash):
+            return False
+        first = addr & ~(self._line_size - 1)
+        last = ((addr + size - 1) | (self._line_size - 1))
+        return region.containsRange(first, last)
+
+    def read(self, addr, size, reader):
+        """
+        Read size bytes at addr through the cache and return a bytearray.
+
+        reader(addr, size) must read line aligned memory from the target and
+        return a bytearray. Missing lines that are adjacent are fetched with
+        a single call.
+        """
+        if not self._active or not self.isCacheable(addr, size):
+            self.bypasses += 1
+            return reader(addr, size)
+
+        line_size = self._line_size
+        first = addr & ~(line_size - 1)
+        end = (addr + size + line_size - 1) & ~(line_size - 1)
+
+        # Fetch runs of missing lines
+        run_start = None
+        for line_addr in range(first, end + line_size, line_size):
+            missing = line_addr < end and line_addr not in self._lines
+            if missing:
+                self.misses += 1
+                if run_start is None:
+                    run_start = line_addr
+            else:
+                if line_addr < end:
+                    self.hits += 1
+                if run_start is not None:
+                    self._fill(run_start, reader(run_start, line_addr - run_start))
+                    run_start = None
+
+        data = bytearray()
+        for line_addr in range(first, end, line_size):
+            data += self._lines[line_addr]
+        offset = addr - first
+        return data[offset:offset + size]
+
+    def write(self, addr, data):
+        """
+        Update cached lines with data just written to the target.
+        """
+        if not self._lines:
+            return
+        line_size = self._line_size
+        size = len(data)
+        line_addr = addr & ~(line_size - 1)
+        while line_addr < addr + size:
+            line = self._lines.get(line_addr)
+            if line is not None:
+                start = max(addr, line_addr)
+                stop = min(addr + size, line_addr + line_size)
+                line[start - line_addr:stop - line_addr] = data[start - addr:stop - addr]
+            line_addr += line_size
+
+    def getStatistics(self):
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'bypasses' : self.bypasses,
+            'invalidations' : self.invalidations,
+            'lines' : len(self._lines),
+            }
+
+    def _fill(self, addr, data):
+        line_size = self._line_size
+        for offset in range(0, len(data), line_size):
+            self._lines[addr + offset] = bytearray(data[offset:offset + line_size])
@@ -25,6 +25,7 @@ import threading
 import socket
 import traceback
 import pyOCD
+from ..transport.transport import TransferError
 from ..gdbserver.gdb_socket import GDBSocket
 from ..gdbserver.gdb_websocket import GDBWebSocket
 
@@ -73,18 +74,64 @@ STDERR_FD = 3
 # @see SemihostAgent::_get_string()
 MAX_STRING_LENGTH = 2048
 
+## Console output is buffered on the host until this many bytes are pending.
+CONSOLE_BUFFER_SIZE = 4096
+
+## Maximum time in seconds console output is kept buffered before it is written out.
+CONSOLE_FLUSH_INTERVAL = 0.1
+
 ##
 # @brief Interface for semihosting file I/O handlers.
 #
 # This class is also used as the default I/O handler if none is provided to SemihostAgent.
 # In this case, all file I/O requests are rejected.
+#
+# Subclasses may buffer standard output and standard error with _buffer_console(). Consecutive
+# writes to the same console file are coalesced and passed to _write_console() once enough
+# data is pending, once the oldest data is #CONSOLE_FLUSH_INTERVAL seconds old, or when
+# flush() is called.
 class SemihostIOHandler(object):
     def __init__(self):
         self.agent = None
         self._errno = 0
+        self._console_fd = None
+        self._console_data = []
+        self._console_size = 0
+        self._console_time = 0
 
     def cleanup(self):
-        pass
+        self.flush()
+
+    ## @brief Write out buffered console output.
+    #
+    # @param force If False, the output is only written if it has been buffered for at
+    #   least #CONSOLE_FLUSH_INTERVAL seconds.
+    def flush(self, force=True):
+        if not self._console_data:
+            return
+        if not force and (time.time() - self._console_time) < CONSOLE_FLUSH_INTERVAL:
+            return
+        fd = self._console_fd
+        data = ''.join(self._console_data)
+        self._console_fd = None
+        self._console_data = []
+        self._console_size = 0
+        self._write_console(fd, data)
+
+    ## @brief Add data written to a console file to the output buffer.
+    def _buffer_console(self, fd, data):
+        # Keep the order of output to different files.
+        if fd != self._console_fd:
+            self.flush()
+            self._console_fd = fd
+            self._console_time = time.time()
+        self._console_data.append(data)
+        self._console_size += len(data)
+        self.flush(self._console_size >= CONSOLE_BUFFER_SIZE)
+
+    ## @brief Write coalesced console output to its destination.
+    def _write_console(self, fd, data):
+        raise NotImplementedError()
 
     @property
     def errno(self):
@@ -173,6 +220,7 @@ class InternalSemihostIOHandler(SemihostIOHandler):
          return self.open_files.has_key(fd) and self.open_files[fd] is not None
 
     def cleanup(self):
+        super(InternalSemihostIOHandler, self).cleanup()
         for f in (self.open_files[k] for k in self.open_files if k > STDERR_FD):
             f.close()
 
@@ -213,22 +261,37 @@ class InternalSemihostIOHandler(SemihostIOHandler):
             # Return byte count not written.
             return length
         data = self.agent._get_string(ptr, length)
+        if fd in (STDOUT_FD, STDERR_FD):
+            self._buffer_console(fd, data)
+            return 0
         try:
-            f = self.open_files[fd]
-            if 'b' not in f.mode:
-                data = unicode(data)
-            f.write(data)
-            f.flush()
+            self._write_file(self.open_files[fd], data)
             return 0
         except IOError as e:
             self._errno = e.errno
             logging.debug("Semihost: exception: %s", e)
             return -1
 
+    def _write_file(self, f, data):
+        if 'b' not in f.mode:
+            data = unicode(data)
+        f.write(data)
+        f.flush()
+
+    def _write_console(self, fd, data):
+        # Errors can no longer be returned to the request that wrote the data.
+        try:
+            self._write_file(self.open_files[fd], data)
+        except IOError as e:
+            self._errno = e.errno
+            logging.debug("Semihost: exception: %s", e)
+
     def read(self, fd, ptr, length):
         if not self._is_valid_fd(fd):
             # Return byte count not read.
             return length
+        # Show pending output, such as a prompt, before waiting for input.
+        self.flush()
         try:
             f = self.open_files[fd]
             data = f.read(length)
@@ -243,6 +306,7 @@ class InternalSemihostIOHandler(SemihostIOHandler):
         return length - len(data)
 
     def readc(self):
+        self.flush()
         try:
             f = self.open_files[STDIN_FD]
             if f is not None:
@@ -358,14 +422,18 @@ class TelnetSemihostIOHandler(SemihostIOHandler):
         # If nobody is connected, act like all data was written anyway.
         if self.connected is None:
             return 0
-        data = self.agent._get_string(ptr, length)
+        self._buffer_console(fd, self.agent._get_string(ptr, length))
+        return 0
+
+    def _write_console(self, fd, data):
+        if self.connected is None:
+            return
         remaining = len(data)
         while remaining:
             count = self._abstract_socket.write(data)
             remaining -= count
             if remaining:
                 data = data[count:]
-        return 0
 
     ## @brief Extract requested amount of data from the read buffer.
     def _get_input(self, length):
@@ -384,6 +452,7 @@ class TelnetSemihostIOHandler(SemihostIOHandler):
     def read(self, fd, ptr, length):
         if self.connected is None:
             return -1
+        self.flush()
 
         # Extract requested amount of data from the read buffer.
         data = self._get_input(length)
@@ -401,6 +470,7 @@ class TelnetSemihostIOHandler(SemihostIOHandler):
     def readc(self):
         if self.connected is None:
             return -1
+        self.flush()
 
         data = self._get_input(1)
 
@@ -459,6 +529,9 @@ class SemihostAgent(object):
         self.console = console or self.io_handler
         self.console.agent = self
 
+        # PC of the last request, where the next request is most likely made from.
+        self._request_pc = None
+
         self.request_map = {
                 TARGET_SYS_OPEN        : self.handle_sys_open,
                 TARGET_SYS_CLOSE       : self.handle_sys_close,
@@ -490,40 +563,54 @@ class SemihostAgent(object):
     # This method should be called after the target has halted, to check if the halt was
     # due to a semihosting request. It first checks to see if the target halted because
     # of a breakpoint. If so, it reads the instruction at PC to make sure it is a 'bkpt #0xAB'
-    # instruction. If so, the target is making a semihosting request. If not, nothing more is done.
+    # instruction. If so, the target is making a semihosting request. If not, nothing more is done
+    # other than writing out buffered console output.
     #
     # After the request is handled, the PC is advanced to the next instruction after the 'bkpt'.
     # A boolean is return indicating whether a semihosting request was handled. If True, the
     # caller should resume the target immediately.
     #
+    # DFSR, PC, R0, R1 and the instruction are read in a single group of transfers. The
+    # instruction is read at the PC of the previous request, since firmware usually makes its
+    # requests from the same 'bkpt', and only read again if the PC is different. The PC and
+    # the return value in R0 are written in a single group of transfers.
+    #
     # @retval True A semihosting request was handled.
     # @retval False The target halted for a reason other than semihosting, i.e. a user-installed
     #   debugging breakpoint.
     def check_and_handle_semihost_request(self):
+        transport = self.target.transport
+
+        # Queue all reads before waiting for any of them.
+        dfsr = transport.readMemAsync(pyOCD.target.cortex_m.DFSR)
+        regs = self.target.readCoreRegistersAsync(['pc', 'r0', 'r1'])
+        instr = None
+        if self._request_pc is not None:
+            instr = transport.readMemAsync(self._request_pc, 16)
+        transport.flush()
+
         # Nothing to do if this is not a bkpt.
-        if (self.target.read32(pyOCD.target.cortex_m.DFSR) & pyOCD.target.cortex_m.DFSR_BKPT) == 0:
+        if (dfsr.result() & pyOCD.target.cortex_m.DFSR_BKPT) == 0:
+            self.flush()
             return False
 
-        pc = self.target.readCoreRegister('pc')
+        pc, op, args = regs.result()
 
         # Are we stopped due to one of our own breakpoints?
         bp = self.target.findBreakpoint(pc)
         if bp:
+            self.flush()
             return False
 
         # Get the instruction at the breakpoint.
-        instr = self.target.read16(pc)
+        if pc != self._request_pc:
+            instr = transport.readMemAsync(pc, 16)
 
         # Check for semihost bkpt.
-        if instr != BKPT_INSTR:
+        if instr.result() != BKPT_INSTR:
+            self.flush()
             return False
-
-        # Advance PC beyond the bkpt instruction.
-        self.target.writeCoreRegister('pc', pc + 2)
-
-        # Get args
-        op = self.target.readCoreRegister('r0')
-        args = self.target.readCoreRegister('r1')
+        self._request_pc = pc
 
         # Handle request
         handler = self.request_map.get(op, None)
@@ -540,11 +627,20 @@ class SemihostAgent(object):
         else:
             result = -1
 
-        # Set return value.
-        self.target.writeCoreRegister('r0', result)
+        # Advance PC beyond the bkpt instruction and set the return value.
+        self.target.writeCoreRegistersRaw(['pc', 'r0'], [pc + 2, result & 0xffffffff])
 
         return True
 
+    ## @brief Write out console output buffered by the I/O handlers.
+    #
+    # @param force If False, only output buffered for at least #CONSOLE_FLUSH_INTERVAL
+    #   seconds is written. This is intended to be called periodically while the target runs.
+    def flush(self, force=True):
+        self.io_handler.flush(force)
+        if self.console is not self.io_handler:
+            self.console.flush(force)
+
     ## @brief Clean up any resources allocated by semihost requests.
     #
     # @note May be called more than once.
@@ -562,8 +658,7 @@ class SemihostAgent(object):
 
     def _get_string(self, ptr, length=None):
         if length is not None:
-            data = self.target.readBlockMemoryUnaligned8(ptr, length)
-            return str(bytearray(data))
+            return str(self.target.readMemoryBytes(ptr, length))
 
         target_str = ''
         # TODO - use memory map to make sure we don't try to read off the end of memory
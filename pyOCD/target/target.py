@@ -15,6 +15,8 @@
  limitations under the License.
 """
 
+from ..utility.statistics import Statistics
+
 TARGET_RUNNING = (1 << 0)
 TARGET_HALTED = (1 << 1)
 
@@ -37,6 +39,7 @@ class Target(object):
         self.part_number = ""
         self.memory_map = memoryMap
         self.halt_on_connect = True
+        self.stats = Statistics()
 
     def setAutoUnlock(self, doAutoUnlock):
         pass
@@ -53,6 +56,12 @@ class Target(object):
     def init(self):
         return
 
+    def getStatistics(self):
+        return self.stats.getStatistics()
+
+    def resetStatistics(self):
+        self.stats.reset()
+
     def info(self, request):
         return
 
@@ -65,6 +74,9 @@ class Target(object):
     def step(self):
         return
 
+    def rangeStep(self, start, end):
+        return
+
     def resume(self):
         return
 
@@ -86,6 +98,27 @@ class Target(object):
     def readBlockMemoryAligned32(self, addr, size):
         return
 
+    def writeMemoryBytes(self, addr, data):
+        return
+
+    def readMemoryBytes(self, addr, size):
+        return
+
+    def writeMemoryAsync(self, addr, data):
+        return
+
+    def readMemoryAsync(self, addr, size):
+        return
+
+    def enableMemoryCache(self, enable = True):
+        return
+
+    def invalidateMemoryCache(self):
+        return
+
+    def getMemoryCacheStatistics(self):
+        return {}
+
     def readCoreRegister(self, id):
         return
 
@@ -101,6 +134,9 @@ class Target(object):
     def removeBreakpoint(self, addr):
         return
 
+    def flushBreakpoints(self):
+        return
+
     def setWatchpoint(addr, size, type):
         return
 
@@ -113,6 +149,9 @@ class Target(object):
     def getState(self):
         return
 
+    def waitForHalt(self, retry = 0):
+        return
+
     def getMemoryMap(self):
         return self.memory_map
 
@@ -0,0 +1,137 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import struct
+
+## Instruction that only continues with the next instruction.
+SEQUENTIAL = 0
+## Direct branch to a known target, conditional or not, including BL.
+BRANCH = 1
+## Instruction whose next pc is unknown, such as BX, POP {pc}, LDR pc or BKPT.
+INDIRECT = 2
+
+def _signExtend(value, bits):
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+def isWide(hw1):
+    """
+    Return True if hw1 is the first halfword of a 32-bit instruction.
+    """
+    return (hw1 & 0xe000) == 0xe000 and (hw1 & 0x1800) != 0
+
+def classify(addr, hw1, hw2 = 0):
+    """
+    Classify the Thumb instruction at addr made of halfwords hw1 and,
+    for 32-bit instructions, hw2.
+
+    Return a tuple (kind, target), where target is the branch target for
+    BRANCH instructions and None otherwise.  Instructions that may write
+    the pc in a way not decoded here are reported as INDIRECT.
+    """
+    if not isWide(hw1):
+        if (hw1 & 0xf000) == 0xd000:
+            # B<c> T1, or UDF and SVC
+            if (hw1 & 0x0e00) == 0x0e00:
+                return INDIRECT, None
+            return BRANCH, addr + 4 + _signExtend((hw1 & 0xff) << 1, 9)
+        if (hw1 & 0xf800) == 0xe000:
+            # B T2
+            return BRANCH, addr + 4 + _signExtend((hw1 & 0x7ff) << 1, 12)
+        if (hw1 & 0xf500) == 0xb100:
+            # CBZ, CBNZ
+            return BRANCH, addr + 4 + (((hw1 >> 9) & 1) << 6) + (((hw1 >> 3) & 0x1f) << 1)
+        if (hw1 & 0xff00) in (0x4700, 0xbd00, 0xbe00):
+            # BX, BLX, POP {..., pc}, BKPT
+            return INDIRECT, None
+        if (hw1 & 0xfc00) == 0x4400 and (hw1 & 0x0300) != 0x0100:
+            # ADD or MOV of a high register into the pc
+            if ((hw1 >> 4) & 0x8) | (hw1 & 0x7) == 15:
+                return INDIRECT, None
+        return SEQUENTIAL, None
+
+    if (hw1 & 0xf800) == 0xf000 and (hw2 & 0x8000):
+        op1 = (hw2 >> 12) & 0x5
+        s = (hw1 >> 10) & 1
+        j1 = (hw2 >> 13) & 1
+        j2 = (hw2 >> 11) & 1
+        if op1 == 0x0:
+            if (hw1 & 0x0380) != 0x0380:
+                # B<c>.W T3
+                offset = (s << 20) | (j2 << 19) | (j1 << 18) | ((hw1 & 0x3f) << 12) | ((hw2 & 0x7ff) << 1)
+                return BRANCH, addr + 4 + _signExtend(offset, 21)
+            if (hw2 & 0x7000) == 0x2000:
+                # UDF.W
+                return INDIRECT, None
+            # MSR, MRS, hints and barriers
+            return SEQUENTIAL, None
+        if op1 in (0x1, 0x5):
+            # B.W T4, BL
+            i1 = (j1 ^ s) ^ 1
+            i2 = (j2 ^ s) ^ 1
+            offset = (s << 24) | (i1 << 23) | (i2 << 22) | ((hw1 & 0x3ff) << 12) | ((hw2 & 0x7ff) << 1)
+            return BRANCH, addr + 4 + _signExtend(offset, 25)
+        # BLX to ARM state
+        return INDIRECT, None
+    if (hw1 & 0xff70) == 0xf850 and (hw2 >> 12) == 15:
+        # LDR pc
+        return INDIRECT, None
+    if (hw1 & 0xfe10) == 0xe810 and (hw2 & 0x8000):
+        # LDM, POP.W and TBB/TBH that may load the pc. Also catches
+        # LDRD and LDREX with high registers, which is harmless.
+        return INDIRECT, None
+    return SEQUENTIAL, None
+
+## @brief Control flow of the Thumb code in an address range.
+#
+# The code is decoded linearly from the start of the range. Execution can only leave
+# the range through one of the #exits, or from one of the #step_points, instructions
+# whose next pc is not known. #boundaries holds the address of every instruction decoded.
+class CodeRange(object):
+    def __init__(self, start, end, code):
+        self.start = start
+        self.end = end
+        self.boundaries = set()
+        self.step_points = set()
+        self.exits = set([end])
+
+        halfwords = struct.unpack('<%dH' % (len(code) // 2), str(code[:len(code) & ~1]))
+        index = 0
+        while index < len(halfwords):
+            addr = start + index * 2
+            hw1 = halfwords[index]
+            if isWide(hw1):
+                if index + 1 >= len(halfwords):
+                    # Instruction straddling the end of the range
+                    self.boundaries.add(addr)
+                    self.step_points.add(addr)
+                    break
+                kind, target = classify(addr, hw1, halfwords[index + 1])
+                index += 2
+            else:
+                kind, target = classify(addr, hw1)
+                index += 1
+            self.boundaries.add(addr)
+            if kind == INDIRECT:
+                self.step_points.add(addr)
+            elif kind == BRANCH and not (start <= target < end):
+                self.exits.add(target)
+
+    ## @brief Addresses that need a breakpoint to stop when execution leaves the range.
+    def breakpoints(self):
+        return self.exits | self.step_points
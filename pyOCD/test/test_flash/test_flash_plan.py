@@ -0,0 +1,99 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+from pyOCD.flash.flash_builder import FlashBuilder, FlashPlan, FlashPlanCache
+
+PAGE_SIZE = 0x400
+
+class PageInfo(object):
+    def __init__(self, addr):
+        self.base_addr = addr - addr % PAGE_SIZE
+        self.size = PAGE_SIZE
+        self.erase_weight = 0.1
+        self.program_weight = 0.2
+
+class MockTarget(object):
+    pass
+
+class MockFlash(object):
+    def __init__(self):
+        self.target = MockTarget()
+        self.page_info_count = 0
+
+    def getPageInfo(self, addr):
+        self.page_info_count += 1
+        return PageInfo(addr)
+
+@pytest.fixture
+def flash():
+    return MockFlash()
+
+def makeBuilder(flash, cache):
+    builder = FlashBuilder(flash)
+    builder.setPlanCache(cache)
+    builder.addData(0x1000, bytearray([1] * 0x500))
+    builder.addData(0x0, bytearray([2] * 0x10))
+    builder.addData(0x1600, bytearray([0xff] * 0x100))
+    return builder
+
+class TestFlashPlan:
+    def test_addData(self, flash):
+        builder = makeBuilder(flash, None)
+        assert [op.addr for op in builder.flash_operation_list] == [0x0, 0x1000, 0x1600]
+        with pytest.raises(ValueError):
+            builder.addData(0x14ff, [0])
+        with pytest.raises(ValueError):
+            builder.addData(0xff8, [0] * 9)
+        builder.addData(0x1500, [0])
+        assert [op.addr for op in builder.flash_operation_list] == [0x0, 0x1000, 0x1500, 0x1600]
+
+    def test_pages(self, flash):
+        plan = makeBuilder(flash, None).getPlan()
+        assert [page.addr for page in plan.pages] == [0x0, 0x1000, 0x1400]
+        assert plan.pages[0].crc is not None
+        assert not plan.pages[0].erased
+        # The gap between 0x1500 and 0x1600 keeps the current flash contents
+        assert plan.pages[2].holes == [(0x100, 0x100)]
+        assert plan.pages[2].crc is None
+
+    def test_serialize(self, flash):
+        plan = makeBuilder(flash, None).getPlan()
+        copy = FlashPlan.fromDict(plan.toDict())
+        for page, copied in zip(plan.pages, copy.pages):
+            assert copied.__dict__ == page.__dict__
+
+    def test_cache(self, flash, tmpdir):
+        cache = FlashPlanCache(str(tmpdir))
+        plan = makeBuilder(flash, cache).getPlan()
+        count = flash.page_info_count
+        assert makeBuilder(flash, cache).getPlan() is plan
+        assert flash.page_info_count == count
+        assert cache.hits == 1
+
+        # A new process loads the plan from disk
+        cache = FlashPlanCache(str(tmpdir))
+        loaded = makeBuilder(flash, cache).getPlan()
+        assert flash.page_info_count == count
+        assert loaded.key == plan.key
+        assert [page.crc for page in loaded.pages] == [page.crc for page in plan.pages]
+
+        # Different data has a different key
+        builder = makeBuilder(flash, cache)
+        builder.addData(0x2000, [0])
+        assert builder.getPlan().key != plan.key
+        assert cache.misses == 1
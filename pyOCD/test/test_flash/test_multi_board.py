@@ -0,0 +1,78 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+from pyOCD.interface.sim_backend import SimulatedCMSISDAP
+from pyOCD.board.mbed_board import MbedBoard
+from pyOCD.flash.multi_board import MultiBoardProgrammer
+from pyOCD.tools import flash_tool
+
+DATA = [(i * 13) & 0xff for i in range(0x1800)]
+ADDR = 0x8000
+
+def makeBoards(count):
+    boards = []
+    for serial in range(count):
+        interface = SimulatedCMSISDAP(serial=serial)
+        boards.append(MbedBoard(interface, '0240', interface.unique_id))
+    return boards
+
+class TestMultiBoardProgrammer:
+    def test_program(self):
+        boards = makeBoards(3)
+        fractions = {}
+        def progress(board, fraction):
+            fractions[board.getUniqueID()] = fraction
+        programmer = MultiBoardProgrammer(boards, progress_cb=progress)
+        programmer.addData(ADDR, DATA)
+        results = programmer.program()
+
+        assert [result.unique_id for result in results] == [board.getUniqueID() for board in boards]
+        assert len(set(result.unique_id for result in results)) == 3
+        for board, result in zip(boards, results):
+            assert result.passed
+            assert result.perf.program_time is not None
+            assert fractions[board.getUniqueID()] == 1.0
+            assert list(board.interface.device.readBytes(ADDR, len(DATA))) == DATA
+        # The image was split into pages once for all boards
+        assert len(programmer._plans) == 1
+
+    def test_failure(self):
+        boards = makeBoards(2)
+        programmer = MultiBoardProgrammer(boards)
+        programmer.addData(ADDR, DATA)
+        # Data outside of flash fails on every board without stopping the others
+        programmer.addData(0x30000000, [0])
+        results = programmer.program()
+        assert not any(result.passed for result in results)
+        assert all(result.error is not None for result in results)
+        assert all(result.total_time is not None for result in results)
+
+class TestFlashTool:
+    def test_binary_on_mixed_rom_start(self, monkeypatch, tmpdir, capsys):
+        boards = makeBoards(2)
+        info = boards[1].flash.getFlashInfo()
+        info.rom_start = 0x08000000
+        monkeypatch.setattr(boards[1].flash, 'getFlashInfo', lambda: info)
+        monkeypatch.setattr(MbedBoard, 'chooseBoards', staticmethod(lambda **kwargs: boards))
+        image = tmpdir.join('image.bin')
+        image.write('\x00' * 0x10, 'wb')
+        # Without an address a binary file can't go to the start of ROM of both boards
+        args = flash_tool.parser.parse_args([str(image), '--all'])
+        assert flash_tool.program_boards(args, None) == 1
+        assert '--address' in capsys.readouterr()[0]
+        assert all(board.interface.closed for board in boards)
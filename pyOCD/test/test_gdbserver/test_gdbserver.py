@@ -0,0 +1,285 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import threading
+import socket
+import time
+from pyOCD.interface import sim_backend
+from pyOCD.interface.sim_backend import SimulatedCMSISDAP
+from pyOCD.board import mbed_board
+from pyOCD.board.mbed_board import MbedBoard
+from pyOCD.gdbserver.multi_board import MultiBoardGDBServer
+from pyOCD.gdbserver import rsp
+from pyOCD.gdbserver.gdbserver import (GDBServer, MIN_PACKET_SIZE,
+    MAX_PACKET_SIZE)
+from pyOCD.gdbserver.halt_watch import BackoffHaltWatch, MatchHaltWatch
+from pyOCD.transport.transport import TransferError
+
+## @brief Target whose memory holds the low byte of each address.
+class MemoryTarget(object):
+    def readMemoryBytes(self, addr, size):
+        if addr >= 0xe0000000:
+            raise TransferError()
+        return bytearray((addr + i) & 0xff for i in range(size))
+
+    def flush(self):
+        pass
+
+class BurstTransport(object):
+    def __init__(self, burst):
+        self.burst = burst
+
+    def getMemoryBurstSize(self):
+        return self.burst
+
+def make_server(packet_size=MIN_PACKET_SIZE):
+    # Build the server without starting its thread or opening a socket.
+    server = GDBServer.__new__(GDBServer)
+    server._initConnections()
+    server.target = MemoryTarget()
+    server.packet_size = packet_size
+    return server
+
+def unpack_reply(packet):
+    assert packet[0] == '$'
+    data, cksum = packet[1:-3], packet[-2:]
+    assert packet[-3] == '#' and rsp.checksum(data) == cksum
+    return data
+
+class TestPacketSize:
+    def test_multiple_of_burst(self):
+        size = GDBServer.getPacketSize(BurstTransport(240))
+        assert size >= MIN_PACKET_SIZE
+        assert size % 240 == 0
+        assert size - 240 < MIN_PACKET_SIZE
+
+    def test_bounds(self):
+        assert GDBServer.getPacketSize(BurstTransport(0)) == MIN_PACKET_SIZE
+        assert GDBServer.getPacketSize(BurstTransport(MAX_PACKET_SIZE * 2)) == MAX_PACKET_SIZE
+
+class TestBinaryRead:
+    def test_read(self):
+        server = make_server()
+        reply, detach = server.handleMsg('$x20000000,100#00')
+        data = unpack_reply(reply)
+        assert data[0] == 'b'
+        assert rsp.unescape(data[1:]) == bytearray(range(256))
+
+    def test_short_reply(self):
+        server = make_server(packet_size=64)
+        data = unpack_reply(server.getMemoryBinary('20000000,100'))
+        assert len(data) <= 64 - 4
+        mem = rsp.unescape(data[1:])
+        assert 0 < len(mem) < 256
+        assert mem == bytearray(range(len(mem)))
+
+    def test_error(self):
+        server = make_server()
+        assert unpack_reply(server.getMemoryBinary('e0000000,4')) == 'E01'
+
+    def test_hex_read(self):
+        server = make_server()
+        assert unpack_reply(server.getMemory('2000007e,4')) == '7e7f8081'
+
+class TestHaltWatch:
+    def test_backoff(self):
+        watch = BackoffHaltWatch(None, min_interval=0.001, max_interval=0.004)
+        watch.start()
+        assert [watch.nextInterval() for i in range(4)] == [0.001, 0.002, 0.004, 0.004]
+        watch.start()
+        assert watch.nextInterval() == 0.001
+
+    def test_match_retry_grows(self):
+        class HaltTarget(object):
+            def __init__(self):
+                self.retries = []
+            def waitForHalt(self, retry):
+                self.retries.append(retry)
+                return len(self.retries) == 3
+        target = HaltTarget()
+        watch = MatchHaltWatch(target, min_retry=8, max_retry=16)
+        watch.start()
+        assert [watch.isHalted() for i in range(3)] == [False, False, True]
+        assert target.retries == [8, 16, 16]
+
+class TestVCont:
+    def test_query(self):
+        server = make_server()
+        reply, detach = server.handleMsg('$vCont?#49')
+        assert 'r' in unpack_reply(reply).split(';')
+
+    def test_range_step(self):
+        class StepTarget(object):
+            def __init__(self):
+                self.calls = []
+            def rangeStep(self, start, end, disable_interrupts):
+                self.calls.append((start, end))
+                # Not finished on the first call
+                return len(self.calls) == 2
+            def getTResponse(self, gdbInterrupt = False):
+                return 'T05'
+        class PacketIO(object):
+            interrupt_event = threading.Event()
+        server = make_server()
+        server.target = StepTarget()
+        server.step_into_interrupt = False
+        server.shutdown_event = threading.Event()
+        server.packet_io = PacketIO()
+        reply, detach = server.handleMsg('$vCont;r8000100,8000108:1;c#00')
+        assert unpack_reply(reply) == 'T05'
+        assert server.target.calls == [(0x8000100, 0x8000108)] * 2
+
+## @brief Minimal RSP client for a GDBServer listening on a local port.
+class Client(object):
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(5)
+        self.data = ''
+        self.notifications = []
+
+    def _read(self):
+        self.data += self.sock.recv(4096)
+        # Set complete notifications aside
+        while True:
+            start = self.data.find('%')
+            end = self.data.find('#', start) + 3
+            if start < 0 or end < 3 or len(self.data) < end:
+                break
+            notification, self.data = self.data[start:end], self.data[:start] + self.data[end:]
+            assert rsp.checksum(notification[1:-3]) == notification[-2:]
+            self.notifications.append(notification[1:-3])
+
+    def request(self, data):
+        self.sock.sendall(rsp.createPacket(data))
+        while True:
+            start = self.data.find('$')
+            if start >= 0 and '#' in self.data[start:]:
+                end = self.data.index('#', start) + 3
+                if len(self.data) >= end:
+                    assert self.data[:start] == '+'
+                    reply, self.data = self.data[start:end], self.data[end:]
+                    self.sock.sendall('+')
+                    return unpack_reply(reply)
+            self._read()
+
+    def notification(self):
+        while not self.notifications:
+            self._read()
+        return self.notifications.pop(0)
+
+def make_sim_server():
+    interface = SimulatedCMSISDAP()
+    board = MbedBoard(interface, '0240', interface.unique_id)
+    board.init()
+    listening = threading.Event()
+    server = GDBServer(board, 0, {'telnet_port' : 0,
+                                  'server_listening_callback' : lambda server: listening.set()})
+    assert listening.wait(5)
+    return server, server.listener.s.getsockname()[1]
+
+class TestMultiClient:
+    def test_read_only_client(self):
+        server, port = make_sim_server()
+        try:
+            gdb = Client(port)
+            monitor = Client(port)
+            assert gdb.request('M20000100,4:78563412') == 'OK'
+            assert monitor.request('m20000100,4') == '78563412'
+            # Only the first client may change the target
+            assert monitor.request('M20000100,4:00000000') == 'E01'
+            assert monitor.request('c') == 'E01'
+            assert gdb.request('m20000100,4') == '78563412'
+            assert gdb.request('D') == 'OK'
+            server.join(5)
+            assert not server.isAlive()
+        finally:
+            server.stop()
+
+class TestNonStop:
+    def test_read_while_running(self):
+        server, port = make_sim_server()
+        device = server.board.interface.device
+        try:
+            gdb = Client(port)
+            assert 'QNonStop+' in gdb.request('qSupported:multiprocess+').split(';')
+            assert gdb.request('QNonStop:1') == 'OK'
+            assert gdb.request('M20000100,4:78563412') == 'OK'
+            # The core halts on its own after a while
+            device.halt_after = 0.2
+            assert gdb.request('vCont;c') == 'OK'
+            assert gdb.request('m20000100,4') == '78563412'
+            assert gdb.request('g') == 'E01'
+            assert gdb.notification().startswith('Stop:T')
+            assert gdb.request('vStopped') == 'OK'
+            assert gdb.request('g') != 'E01'
+            # Stopped by the debugger
+            device.halt_after = None
+            assert gdb.request('c') == 'OK'
+            assert gdb.request('?') == 'OK'
+            assert gdb.request('vCont;t') == 'OK'
+            assert gdb.notification().startswith('Stop:T00')
+            assert gdb.request('vStopped') == 'OK'
+            assert gdb.request('?').startswith('T')
+            assert gdb.request('vStopped') == 'OK'
+        finally:
+            server.stop()
+
+    def test_read_only_halt_reason(self):
+        class HaltedTarget(object):
+            def getTResponse(self, forceSignal=None):
+                return 'T05'
+        server = make_server()
+        server.target = HaltedTarget()
+        server.non_stop = True
+        server.controller = object()
+        server._queueStop('T02')
+        # A read-only client's '?' leaves the controller's pending stop alone
+        server.packet_io = object()
+        assert unpack_reply(server.haltReason()) == 'T05'
+        assert list(server._stop_queue) == ['T02']
+        assert server._notify_stop
+
+class TestMultiBoard:
+    def test_hot_plug(self, monkeypatch):
+        monkeypatch.setattr(mbed_board, 'usb_backend', 'sim')
+        monkeypatch.setenv(sim_backend.SIM_COUNT_ENV, '2')
+        first, second = [SimulatedCMSISDAP.uniqueID('k64f', i) for i in range(2)]
+
+        def wait_for(ids):
+            deadline = time.time() + 10
+            while set(multi.servers) != set(ids):
+                assert time.time() < deadline
+                time.sleep(0.01)
+
+        multi = MultiBoardGDBServer(0, {'telnet_port' : 0}, scan_interval=0.01)
+        try:
+            wait_for([first, second])
+            server = multi.servers[first]
+            gdb = Client(server.listener.s.getsockname()[1])
+            assert gdb.request('m20000100,4') == '00000000'
+            # Unplugging a probe stops its server only
+            monkeypatch.setenv(sim_backend.SIM_COUNT_ENV, '1')
+            wait_for([first])
+            assert multi.servers[first] is server
+            # It is served at the same index when plugged in again
+            monkeypatch.setenv(sim_backend.SIM_COUNT_ENV, '2')
+            wait_for([first, second])
+            assert multi._indexes == {first : 0, second : 1}
+        finally:
+            multi.stop()
+        assert multi.servers == {}
@@ -0,0 +1,96 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import socket
+from pyOCD.gdbserver import rsp
+from pyOCD.gdbserver.gdbserver import GDBServerConnection
+
+## @brief Socket that never receives data and records everything written.
+class RecordingSocket(object):
+    def __init__(self):
+        self.written = []
+
+    def read(self):
+        raise socket.error()
+
+    def write(self, data):
+        self.written.append(data)
+        return len(data)
+
+def make_packet_io():
+    sock = RecordingSocket()
+    packet_io = GDBServerConnection(sock)
+    return packet_io, sock
+
+class TestRSP:
+    def test_checksum(self):
+        assert rsp.checksum('') == '00'
+        assert rsp.checksum('OK') == '9a'
+        assert rsp.checksum(bytearray([0xff, 0x02])) == '01'
+
+    def test_escape_roundtrip(self):
+        data = bytearray(range(256)) * 4
+        escaped = rsp.escape(data)
+        for c in '#$*':
+            assert c not in escaped
+        assert rsp.unescape(escaped) == data
+
+    def test_unescape(self):
+        assert rsp.unescape('a}]b}\x03') == bytearray('a}b#')
+        assert rsp.unescape('abc}') == bytearray('abc}')
+        assert rsp.unescape('') == bytearray()
+
+    def test_create_packet(self):
+        assert rsp.createPacket('OK') == '$OK#9a'
+
+class TestPacketIO:
+    def test_split_packets(self):
+        packet_io, sock = make_packet_io()
+        packet_io._buffer += '$OK#9a$g#6'
+        packet_io._process_data()
+        assert packet_io.receive() == '$OK#9a'
+        assert packet_io.receive() is None
+        assert packet_io._buffer == bytearray('$g#6')
+        packet_io._buffer += '7'
+        packet_io._process_data()
+        assert packet_io.receive() == '$g#67'
+        assert packet_io._buffer == bytearray()
+        assert sock.written == ['+', '+']
+
+    def test_bad_checksum(self):
+        packet_io, sock = make_packet_io()
+        packet_io._buffer += '$OK#00'
+        packet_io._process_data()
+        assert packet_io.receive() is None
+        assert sock.written == ['-']
+
+    def test_ack_and_interrupt(self):
+        packet_io, sock = make_packet_io()
+        packet_io.send('$OK#9a')
+        packet_io._buffer += '+\x03$?#3f'
+        packet_io._process_data()
+        assert packet_io.interrupt_event.is_set()
+        assert packet_io.receive() == '$?#3f'
+        assert sock.written == ['$OK#9a', '+']
+
+    def test_nack_resends(self):
+        packet_io, sock = make_packet_io()
+        packet_io.send('$OK#9a')
+        packet_io._buffer += '-'
+        packet_io._process_data()
+        assert sock.written == ['$OK#9a', '$OK#9a']
+        assert packet_io._buffer == bytearray()
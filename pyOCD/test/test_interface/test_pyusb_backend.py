@@ -0,0 +1,73 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+import threading
+from pyOCD.interface.pyusb_backend import PyUSB, DEFAULT_READ_TIMEOUT
+
+## @brief IN and OUT endpoints of a probe that echoes each report.
+class EchoEndpoints(object):
+    def __init__(self):
+        self.reports = []
+        self.ready = threading.Semaphore(0)
+
+    def write(self, data):
+        self.reports.append(bytearray(data))
+        self.ready.release()
+
+    def read(self, size, timeout):
+        self.ready.acquire()
+        return self.reports.pop(0)[:size]
+
+@pytest.fixture
+def interface():
+    interface = PyUSB()
+    endpoints = EchoEndpoints()
+    interface.ep_out = interface.ep_in = endpoints
+    interface.packet_size = 4
+    interface.start_rx()
+    yield interface
+    # Stop the receive thread without releasing USB resources
+    interface.closed = True
+    interface.read_sem.release()
+    endpoints.ready.release()
+    interface.thread.join()
+
+class TestPyUSB:
+    def test_default_timeout(self):
+        assert PyUSB().read_timeout == DEFAULT_READ_TIMEOUT
+
+    def test_read(self, interface):
+        for i in range(3):
+            interface.write(bytearray([i]))
+        assert [interface.read() for i in range(3)] == [bytearray([i, 0, 0, 0]) for i in range(3)]
+        stats = interface.getStatistics()
+        assert stats['read_count'] == 3
+        assert stats['queue_depth'] == 0
+        assert 1 <= stats['max_queue_depth'] <= 3
+        assert stats['max_read_wait_time'] <= stats['read_wait_time']
+        interface.resetStatistics()
+        assert interface.getStatistics()['read_count'] == 0
+
+    def test_read_timeout(self, interface):
+        with pytest.raises(Exception) as error:
+            interface.read(timeout=0.01)
+        assert 'timed out' in str(error.value)
+        interface.setReadTimeout(0.01)
+        with pytest.raises(Exception):
+            interface.read()
+        assert interface.getStatistics()['read_count'] == 0
@@ -0,0 +1,386 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+import struct
+from pyOCD.interface import INTERFACE
+from pyOCD.interface import sim_backend
+from pyOCD.interface.sim_backend import SimulatedCMSISDAP
+from pyOCD.board.mbed_board import MbedBoard
+from pyOCD.target.target import TARGET_HALTED, TARGET_RUNNING
+from pyOCD.transport.transport import TransferError
+from pyOCD.flash.flash import FlashTimeoutError
+from pyOCD.target import semihost
+
+RAM = 0x20000000
+
+@pytest.fixture
+def board():
+    interface = SimulatedCMSISDAP()
+    board = MbedBoard(interface, '0240', interface.unique_id)
+    board.init()
+    yield board
+    board.uninit(False)
+
+class TestSimulatedCMSISDAP:
+    def test_registered(self):
+        assert INTERFACE['sim'] is SimulatedCMSISDAP
+        interfaces = SimulatedCMSISDAP.getAllConnectedInterface(0xd28, 0x204)
+        assert len(interfaces) == 1
+        assert interfaces[0].unique_id.startswith('0240')
+
+    def test_init(self, board):
+        assert board.target.getState() == TARGET_HALTED
+        assert board.transport.info('PACKET_COUNT') == 4
+        assert board.transport.info('PACKET_SIZE') == 64
+
+    def test_memory(self, board):
+        target = board.target
+        target.writeMemory(RAM, 0x12345678)
+        assert target.readMemory(RAM) == 0x12345678
+        assert target.readMemory(RAM + 1, 8) == 0x56
+        assert target.readMemory(RAM + 2, 16) == 0x1234
+        data = [i & 0xff for i in range(0x1100)]
+        target.writeBlockMemoryUnaligned8(RAM + 3, data)
+        assert target.readBlockMemoryUnaligned8(RAM + 3, len(data)) == data
+
+    def test_fault(self, board):
+        with pytest.raises(TransferError):
+            board.target.readMemory(0x30000000)
+        # The sticky error is cleared and the link still works
+        assert board.target.readMemory(RAM, 8) == 0
+
+    def test_core(self, board):
+        target = board.target
+        target.writeCoreRegister('r0', 55)
+        target.writeCoreRegister('pc', RAM)
+        assert target.readCoreRegister('r0') == 55
+        target.step()
+        assert target.readCoreRegister('pc') == RAM + 2
+        target.resume()
+        assert target.getState() == TARGET_RUNNING
+        target.halt()
+        assert target.getState() == TARGET_HALTED
+
+    def test_breakpoint(self, board):
+        target = board.target
+        target.writeCoreRegister('pc', RAM)
+        assert target.setBreakpoint(RAM + 0x10)
+        board.interface.device.halt_after = 0
+        target.resume()
+        assert target.waitForHalt()
+        target.removeBreakpoint(RAM + 0x10)
+
+    def test_lazy_breakpoints(self, board):
+        target = board.target
+        device = board.interface.device
+        device.writeBytes(RAM + 0x1000, bytearray(b'\x00\xbf' * 8))
+        device.halt_after = 0
+
+        def resume_bytes():
+            board.interface.resetStatistics()
+            target.resume()
+            assert target.waitForHalt()
+            return board.interface.getStatistics()['bytes_written']
+
+        baseline = resume_bytes()
+        # Breakpoints reach the target when it runs
+        assert target.setBreakpoint(RAM + 0x1000)
+        assert target.setBreakpoint(0x1000)
+        assert device.read16(RAM + 0x1000) == 0xbf00
+        assert device.fp_comp == [0] * len(device.fp_comp)
+        resume_bytes()
+        assert device.read16(RAM + 0x1000) == 0xbe00
+        assert device.fp_comp[0] != 0
+        # Removing and inserting them again around a stop writes nothing
+        for addr in (RAM + 0x1000, 0x1000):
+            target.removeBreakpoint(addr)
+        for addr in (0x1000, RAM + 0x1000):
+            assert target.setBreakpoint(addr)
+        assert resume_bytes() == baseline
+        # Memory accesses see removed breakpoints gone
+        target.removeBreakpoint(RAM + 0x1000)
+        assert target.read16(RAM + 0x1000) == 0xbf00
+        # The original instruction is known without reading it again
+        assert target.setBreakpoint(RAM + 0x1000)
+        assert target.findBreakpoint(RAM + 0x1000).original_instr == 0xbf00
+        assert target.read16(RAM + 0x1000) == 0xbe00
+        # Writing over a breakpoint replaces its original instruction
+        target.writeMemoryBytes(RAM + 0x1000, bytearray(b'\x01\xbf'))
+        target.removeBreakpoint(RAM + 0x1000)
+        target.removeBreakpoint(0x1000)
+        resume_bytes()
+        assert device.read16(RAM + 0x1000) == 0xbf01
+        assert device.fp_comp == [0] * len(device.fp_comp)
+
+    def test_breakpoint_after_load(self, board):
+        target = board.target
+        addr = RAM + 0x1100
+        board.interface.device.halt_after = 0
+
+        def run_with_breakpoint():
+            assert target.setBreakpoint(addr)
+            target.resume()
+            assert target.waitForHalt()
+            target.removeBreakpoint(addr)
+
+        target.writeMemory(addr, 0xaaaa, 16)
+        run_with_breakpoint()
+        # New code loaded over a removed breakpoint is not restored to the old code
+        target.writeMemory(addr, 0xbbbb, 16)
+        run_with_breakpoint()
+        assert target.read16(addr) == 0xbbbb
+        assert board.interface.device.read16(addr) == 0xbbbb
+
+    def test_breakpoint_fault(self, board, monkeypatch):
+        target = board.target
+        device = board.interface.device
+        addr = RAM + 0x1100
+        device.writeBytes(addr, bytearray(b'\x00\xbf'))
+        device.halt_after = 0
+
+        def fault(access, done = False):
+            def faulting(bus_addr, *args):
+                if bus_addr & ~3 == addr:
+                    if done:
+                        access(bus_addr, *args)
+                    raise sim_backend._Fault()
+                return access(bus_addr, *args)
+            return faulting
+
+        def resume():
+            target.resume()
+            assert target.waitForHalt()
+
+        monkeypatch.setattr(device, 'readMemory', fault(device.readMemory))
+        assert not target.setBreakpoint(addr)
+        assert target.findBreakpoint(addr) is None
+        monkeypatch.undo()
+        # The BKPT can't be written when the core runs
+        assert target.setBreakpoint(addr)
+        monkeypatch.setattr(device, 'writeMemory', fault(device.writeMemory))
+        resume()
+        assert target.findBreakpoint(addr) is None
+        monkeypatch.undo()
+        # A write reported as failed may still have been done
+        assert target.setBreakpoint(addr)
+        monkeypatch.setattr(device, 'writeMemory', fault(device.writeMemory, done=True))
+        resume()
+        assert target.findBreakpoint(addr) is not None
+        assert device.read16(addr) == 0xbe00
+        monkeypatch.undo()
+        # The original instruction is restored once it can be written
+        target.removeBreakpoint(addr)
+        monkeypatch.setattr(device, 'writeMemory', fault(device.writeMemory))
+        resume()
+        assert device.read16(addr) == 0xbe00
+        monkeypatch.undo()
+        resume()
+        assert device.read16(addr) == 0xbf00
+
+    def test_reset(self, board):
+        target = board.target
+        vectors = bytearray(struct.pack('<II', RAM + 0x1000, 0x411))
+        board.interface.device.writeBytes(0, vectors)
+        target.resetStopOnReset()
+        assert target.getState() == TARGET_HALTED
+        assert target.readCoreRegister('pc') == 0x410
+        assert target.readCoreRegister('sp') == RAM + 0x1000
+
+    def test_flash(self, board):
+        data = [(i * 7) & 0xff for i in range(0x2100)]
+        writes = board.interface.write_count
+        info = board.flash.flashBlock(0x4000, data)
+        assert board.target.readBlockMemoryUnaligned8(0x4000, len(data)) == data
+        first = board.interface.write_count - writes
+        # Pages are erased, loaded and programmed by the pipeline
+        assert info.stage_time['erase'] > 0
+        assert info.stage_time['program'] > 0
+        assert 0 < info.stage_utilization['load'] <= 1
+        assert sum(info.stage_utilization[stage] for stage in ('erase', 'load', 'program')) <= 1
+        # Unchanged pages are skipped
+        writes = board.interface.write_count
+        board.flash.flashBlock(0x4000, data)
+        assert board.interface.write_count - writes < first
+
+    def test_kl25z_smart_flash(self):
+        interface = SimulatedCMSISDAP('kl25z')
+        board = MbedBoard(interface, '0200', interface.unique_id)
+        board.init()
+        try:
+            # Unchanged pages are found with the CRC analyzer
+            assert board.flash.getFlashInfo().crc_supported
+            data = [(i * 7) & 0xff for i in range(0x1100)]
+            board.flash.flashBlock(0x4000, data)
+            assert board.target.readBlockMemoryUnaligned8(0x4000, len(data)) == data
+            erased = board.interface.device.erase_range_count
+            board.flash.flashBlock(0x4000, data)
+            assert board.interface.device.erase_range_count == erased
+        finally:
+            board.uninit(False)
+
+    @pytest.mark.parametrize("double_buffer", [True, False])
+    def test_erase_range(self, board, double_buffer):
+        flash = board.flash
+        flash.setFlashAlgoDebug(True)
+        data = [(i * 5) & 0xff for i in range(0x3000)]
+        builder = flash.getFlashBuilder()
+        builder.enableDoubleBuffer(double_buffer)
+        builder.addData(0x8000, data)
+        builder.program(chip_erase=False)
+        assert board.target.readBlockMemoryUnaligned8(0x8000, len(data)) == data
+        # The three changed sectors are erased with one call
+        assert board.interface.device.erase_range_count == 1
+
+    def test_erase_range_even_entry(self, board):
+        # Some algos, such as LPC800's, give function addresses without the Thumb bit
+        flash = board.flash
+        flash.flash_algo = dict(flash.flash_algo, pc_erase_sector=flash.flash_algo['pc_erase_sector'] & ~1)
+        flash.setTimeout(0.5)
+        flash.init()
+        board.interface.device.writeBytes(0x8000, bytearray(0x10))
+        flash.startEraseRange(0x8000, 0xb000)
+        assert flash.waitForCompletion() == 0
+        assert board.target.readBlockMemoryUnaligned8(0x8000, 0x10) == [0xff] * 0x10
+        assert board.interface.device.erase_range_count == 1
+
+    def test_flash_timeout(self, board):
+        flash = board.flash
+        flash.init()
+        # The erase function never returns to its breakpoint
+        def hang(device):
+            device.regs[14] = 0x20000101
+            return 0
+        board.interface.device.functions[flash.flash_algo['pc_erase_sector'] & ~1] = hang
+        flash.setTimeout(0.05)
+        with pytest.raises(FlashTimeoutError):
+            flash.erasePage(0x4000)
+        assert board.target.getState() == TARGET_HALTED
+
+        # An overall timeout applies to the whole programming operation
+        flash.setTimeout(None)
+        builder = flash.getFlashBuilder()
+        builder.addData(0x4000, [1] * 0x10)
+        with pytest.raises(FlashTimeoutError):
+            builder.program(timeout=0.05)
+        assert flash.deadline is None
+
+    def test_delta_flash(self, board):
+        def program(data):
+            builder = board.flash.getFlashBuilder()
+            builder.enableDeltaProgramming(True)
+            builder.addData(0x4000, data)
+            info = builder.program()
+            assert board.target.readBlockMemoryUnaligned8(0x4000, len(data)) == data
+            return info
+        data = [(i * 3) & 0xff for i in range(0x1800)]
+        program(data)
+        # Data appended to erased flash is programmed without an erase
+        info = program(data + [1] * 0x100)
+        assert info.delta_page_count == 1
+        assert info.program_byte_count == 0x100
+        assert info.skipped_byte_count == len(data)
+        # Changing programmed data needs the page to be erased
+        data[0x10] ^= 0xff
+        info = program(data + [1] * 0x100)
+        assert info.delta_page_count == 0
+        assert info.program_byte_count == 0x1000
+
+    def test_range_step(self, board):
+        target = board.target
+        free = target.availableBreakpoint()
+        # Straight-line code in flash is run to a breakpoint at the end of the range
+        board.interface.device.writeBytes(0x1000, bytearray(b'\x00\xbf' * 0x400))
+        target.setBreakpoint(0x1400)
+        target.writeCoreRegister('pc', 0x1000)
+        assert target.rangeStep(0x1000, 0x1800)
+        assert target.readCoreRegister('pc') == 0x1400
+        target.removeBreakpoint(0x1400)
+        assert target.rangeStep(0x1000, 0x1800)
+        assert target.readCoreRegister('pc') == 0x1800
+        assert target.availableBreakpoint() == free
+        assert target.breakpoints == {}
+        # Code in RAM above the FPB range is single stepped
+        target.writeCoreRegister('pc', RAM + 0x1000)
+        assert target.rangeStep(RAM + 0x1000, RAM + 0x1020)
+        assert target.readCoreRegister('pc') == RAM + 0x1020
+
+    def test_range_step_branch(self, board):
+        target = board.target
+        # A return that leaves the range is stepped from its temporary breakpoint
+        code = b'\x00\xbf' * 0x20 + b'\x70\x47' + b'\x00\xbf' * 0x1f
+        board.interface.device.writeBytes(0x2000, bytearray(code))
+        target.writeCoreRegister('pc', 0x2000)
+        target.writeCoreRegister('lr', 0x3001)
+        assert target.rangeStep(0x2000, 0x2080)
+        assert target.readCoreRegister('pc') == 0x3000
+        assert target.breakpoints == {}
+
+    def test_range_step_timeout(self, board, monkeypatch):
+        target = board.target
+        device = board.interface.device
+        # A sleeping core doesn't halt after a step
+        def sleep_step():
+            device.halted = False
+            device.dhcsr &= ~sim_backend.C_HALT
+        monkeypatch.setattr(device, '_step', sleep_step)
+        target.writeCoreRegister('pc', RAM + 0x1000)
+        assert not target.rangeStep(RAM + 0x1000, RAM + 0x1020, timeout=0.05)
+        assert target.getState() == TARGET_HALTED
+
+    def test_semihosting(self, board, tmpdir):
+        target = board.target
+        device = board.interface.device
+        board.transport.setDeferredTransfer(True)
+        # SYS_WRITE of a string to stdout, followed by a debugger breakpoint
+        device.writeBytes(RAM, bytearray(struct.pack('<HH', semihost.BKPT_INSTR, 0xbe00)))
+        device.writeBytes(RAM + 0x100, bytearray(struct.pack('<III', semihost.STDOUT_FD, RAM + 0x200, 6)))
+        device.writeBytes(RAM + 0x200, bytearray(b'hello\n'))
+        io_handler = semihost.InternalSemihostIOHandler()
+        io_handler.open_files[semihost.STDOUT_FD] = tmpdir.join('stdout').open('w')
+        agent = semihost.SemihostAgent(target, io_handler)
+        for i in range(2):
+            target.writeCoreRegistersRaw(['pc', 'r0', 'r1'], [RAM, semihost.TARGET_SYS_WRITE, RAM + 0x100])
+            target.resume()
+            assert target.waitForHalt()
+            assert agent.check_and_handle_semihost_request()
+            assert target.readCoreRegistersRaw(['pc', 'r0']) == [RAM + 2, 0]
+        # Console output is coalesced until flushed
+        assert tmpdir.join('stdout').read() == ''
+        assert not agent.check_and_handle_semihost_request()
+        assert tmpdir.join('stdout').read() == 'hello\n' * 2
+        agent.cleanup()
+
+    def test_statistics(self, board):
+        board.interface.latency = 0.001
+        board.target.readBlockMemoryUnaligned8(RAM, 0x400)
+        stats = board.interface.getStatistics()
+        assert stats['write_count'] == stats['read_count']
+        assert stats['max_outstanding'] == 4
+
+    def test_board_statistics(self, board):
+        board.resetStatistics()
+        board.target.readBlockMemoryAligned32(RAM, 0x100)
+        board.target.getState()
+        stats = board.getStatistics()
+        protocol = stats['transport']['protocol']
+        assert protocol['packets_written'] == stats['interface']['write_count']
+        assert protocol['packets_read'] == stats['interface']['read_count']
+        assert protocol['DAP_TRANSFER_BLOCK'] == 0x100 // 15 + 1
+        assert stats['transport']['histograms']['block_words']['total'] == 0x100
+        assert stats['target']['histograms']['readBlockMemoryAligned32']['count'] == 1
+        assert stats['target']['histograms']['getState']['count'] == 1
@@ -0,0 +1,87 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+from pyOCD.target.memory_cache import MemoryCache
+from pyOCD.target.memory_map import (MemoryMap, RamRegion, FlashRegion,
+    MemoryRegion)
+
+## @brief Backing memory that records the reads made through the cache.
+class FakeMemory(object):
+    def __init__(self):
+        self.reads = []
+
+    def read(self, addr, size):
+        self.reads.append((addr, size))
+        return bytearray((addr + i) & 0xff for i in range(size))
+
+@pytest.fixture
+def memory():
+    return FakeMemory()
+
+@pytest.fixture
+def cache():
+    memory_map = MemoryMap(
+        FlashRegion(start=0, length=0x1000, blocksize=0x400),
+        RamRegion(start=0x20000000, length=0x1000),
+        MemoryRegion(type='device', start=0x40000000, length=0x1000),
+        )
+    cache = MemoryCache(memory_map, line_size=16)
+    cache.activate()
+    return cache
+
+class TestMemoryCache:
+    def test_hit(self, cache, memory):
+        data = cache.read(0x20000005, 20, memory.read)
+        assert data == memory.read(0x20000005, 20)
+        assert memory.reads[0] == (0x20000000, 32)
+        assert cache.read(0x20000008, 8, memory.read) == memory.read(0x20000008, 8)
+        assert len(memory.reads) == 3
+        assert cache.misses == 2
+        assert cache.hits == 1
+
+    def test_missing_runs(self, cache, memory):
+        cache.read(0x20000010, 16, memory.read)
+        cache.read(0x20000000, 64, memory.read)
+        assert memory.reads == [(0x20000010, 16), (0x20000000, 16), (0x20000020, 32)]
+
+    def test_peripheral_bypass(self, cache, memory):
+        assert not cache.isCacheable(0x40000000, 4)
+        assert not cache.isCacheable(0x20000ff0, 0x20)
+        cache.read(0x40000000, 4, memory.read)
+        cache.read(0x40000000, 4, memory.read)
+        assert len(memory.reads) == 2
+        assert cache.bypasses == 2
+
+    def test_write_through(self, cache, memory):
+        cache.read(0x100, 32, memory.read)
+        cache.write(0x10e, bytearray([0xaa] * 4))
+        data = cache.read(0x100, 32, memory.read)
+        assert data[0xe:0x12] == bytearray([0xaa] * 4)
+        assert data[0xd] == 0x0d and data[0x12] == 0x12
+        assert len(memory.reads) == 1
+
+    def test_invalidate(self, cache, memory):
+        cache.read(0x100, 4, memory.read)
+        cache.invalidate()
+        assert not cache.active
+        cache.read(0x100, 4, memory.read)
+        assert cache.bypasses == 1
+        cache.activate()
+        cache.read(0x100, 4, memory.read)
+        assert len(memory.reads) == 3
+        assert cache.invalidations == 1
@@ -0,0 +1,72 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+from pyOCD.target.cortex_m import (CortexM, CORE_REGISTER,
+    CACHE_PREFETCH_REGISTERS)
+
+## @brief CortexM whose core registers are read from a list of batches.
+class RecordingCortexM(CortexM):
+    def __init__(self):
+        super(RecordingCortexM, self).__init__(None)
+        self.batches = []
+
+    def _readCoreRegistersRaw(self, reg_list):
+        self.batches.append(list(reg_list))
+        return [0x100 + reg for reg in reg_list]
+
+@pytest.fixture
+def core():
+    core = RecordingCortexM()
+    core._coreHalted()
+    return core
+
+class TestRegisterCache:
+    def test_single_batch_per_halt(self, core):
+        assert core.readCoreRegistersRaw(['pc', 'sp']) == [0x10f, 0x10d]
+        assert core.readCoreRegisterRaw('xpsr') == 0x110
+        assert core.readCoreRegistersRaw([7, 13, 14, 15]) == [0x107, 0x10d, 0x10e, 0x10f]
+        assert len(core.batches) == 1
+        assert set(core.batches[0]) == set(CACHE_PREFETCH_REGISTERS)
+
+    def test_epoch(self, core):
+        core.readCoreRegisterRaw('pc')
+        epoch = core.halt_epoch
+        core._coreMayRun()
+        assert core.halt_epoch == epoch + 1
+        # Not known to be halted, so nothing is cached
+        core.readCoreRegisterRaw('pc')
+        core.readCoreRegisterRaw('pc')
+        assert len(core.batches) == 3
+        core._coreHalted()
+        core.readCoreRegisterRaw('pc')
+        core.readCoreRegisterRaw('pc')
+        assert len(core.batches) == 4
+
+    def test_write_coherence(self, core):
+        core.readCoreRegistersRaw(['r0', 'msp', 'psp', 'primask'])
+        core._updateRegisterCache([CORE_REGISTER['r0'], CORE_REGISTER['sp']], [5, 0x20001000])
+        assert core.readCoreRegisterRaw('r0') == 5
+        assert core.readCoreRegisterRaw('sp') == 0x20001000
+        assert len(core.batches) == 1
+        # The stack pointers alias sp
+        core.readCoreRegisterRaw('msp')
+        assert core.batches[-1] == [CORE_REGISTER['msp']]
+        # CONTROL shares the cfbp register with primask
+        core._updateRegisterCache([CORE_REGISTER['control']], [2])
+        core.readCoreRegisterRaw('primask')
+        assert core.batches[-1] == [CORE_REGISTER['primask'], CORE_REGISTER['sp']]
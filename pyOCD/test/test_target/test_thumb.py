@@ -0,0 +1,50 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import binascii
+from pyOCD.target.thumb import CodeRange, classify, SEQUENTIAL, BRANCH, INDIRECT
+
+# Assembled at 0x1000, with 'far' at 0x1136:
+#   start: bne start; b start; cbz r1, fwd; beq.w far; b.w far; bl far
+#   bx lr; pop {r4, pc}; mov pc, r1; add pc, r2; ldr pc, [sp], #4
+#   ldr.w pc, [r0, #8]; pop.w {r4-r11, pc}; tbb [pc, r0]; bkpt #0xab
+#   mov r8, r9; ldr.w r0, [r1, #4]; nop; fwd: nop
+CODE = bytearray(binascii.unhexlify(
+    'fed1fde7b1b100f0968000f094b800f092f870'
+    '4710bd8f4697445df804fbd0f808f0bde8f08f'
+    'dfe800f0abbec846d1f8040000bf00bf'))
+
+class TestThumb:
+    def test_classify(self):
+        assert classify(0x1000, 0xd1fe) == (BRANCH, 0x1000)
+        assert classify(0x1006, 0xf000, 0x8096) == (BRANCH, 0x1136)
+        assert classify(0x100e, 0xf000, 0xf892) == (BRANCH, 0x1136)
+        assert classify(0x1000, 0xdfab) == (INDIRECT, None)
+        assert classify(0x1000, 0x46c8) == (SEQUENTIAL, None)
+        assert classify(0x1000, 0xf3bf, 0x8f4f) == (SEQUENTIAL, None)
+
+    def test_code_range(self):
+        code = CodeRange(0x1000, 0x1000 + len(CODE), CODE)
+        assert code.exits == set([0x1000 + len(CODE), 0x1136])
+        assert code.step_points == set([0x1012, 0x1014, 0x1016, 0x1018, 0x101a,
+                                        0x101e, 0x1022, 0x1026, 0x102a])
+        assert 0x102c in code.boundaries and 0x1030 not in code.boundaries
+        assert code.breakpoints() == code.exits | code.step_points
+
+    def test_straddling_end(self):
+        code = CodeRange(0x1000, 0x1002, bytearray(b'\xd1\xf8'))
+        assert code.step_points == set([0x1000])
@@ -0,0 +1,206 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import pytest
+from pyOCD.interface.interface import Interface
+from pyOCD.transport.cmsis_dap_core import (COMMAND_ID, DAP_TRANSFER_OK,
+    DAP_TRANSFER_FAULT, DAP_TRANSFER_MISMATCH, DAP_OK)
+from pyOCD.transport.cmsis_dap import (CMSIS_DAP, DAP_MODE_SWD, DP_REG,
+    READ, VALUE_MATCH, MATCH_MASK)
+from pyOCD.transport.transport import (READ_START, READ_END, TransferError)
+
+## @brief Interface that answers DAP_TRANSFER and DAP_TRANSFER_BLOCK commands.
+#
+# Every read returns the number of reads performed so far.  Responses are
+# queued so several packets can be outstanding at once.  Value-match reads
+# compare match_value against the match mask and value sent.
+class TransferInterface(Interface):
+    def __init__(self, packet_count=1):
+        super(TransferInterface, self).__init__()
+        self.packet_count = packet_count
+        self.packets = []
+        self.max_outstanding = 0
+        self.fault_on_packet = None
+        self.match_value = 0
+        self.match_retry = 0
+        self.configure_count = 0
+        self._match_mask = 0xffffffff
+        self._responses = []
+        self._reads = 0
+
+    def write(self, data):
+        assert len(data) <= self.packet_size
+        if data[0] == COMMAND_ID['DAP_TRANSFER_BLOCK']:
+            self._writeBlock(data)
+            return
+        if data[0] == COMMAND_ID['DAP_TRANSFER_CONFIGURE']:
+            self.match_retry = data[4] | (data[5] << 8)
+            self.configure_count += 1
+            self._responses.append([data[0], DAP_OK])
+            return
+        assert data[0] == COMMAND_ID['DAP_TRANSFER']
+        self.packets.append(list(data))
+        count = data[2]
+        status = DAP_TRANSFER_OK
+        if self.fault_on_packet == len(self.packets):
+            status = DAP_TRANSFER_FAULT
+        resp = [data[0], count, status]
+        pos = 3
+        for i in range(count):
+            request = data[pos]
+            pos += 1
+            if (request & READ) and not (request & VALUE_MATCH):
+                resp.extend([self._reads & 0xff, 0, 0, 0])
+                self._reads += 1
+            else:
+                value = data[pos] | (data[pos + 1] << 8) | (data[pos + 2] << 16) | (data[pos + 3] << 24)
+                pos += 4
+                if request & MATCH_MASK:
+                    self._match_mask = value
+                elif request & VALUE_MATCH:
+                    if (self.match_value & self._match_mask) != value:
+                        resp[1] = i
+                        resp[2] = DAP_TRANSFER_OK | DAP_TRANSFER_MISMATCH
+                        break
+        assert len(resp) <= self.packet_size
+        self._responses.append(resp)
+        self.max_outstanding = max(self.max_outstanding, len(self._responses))
+
+    def _writeBlock(self, data):
+        self.packets.append(list(data))
+        count = data[2] | (data[3] << 8)
+        resp = [data[0], data[2], data[3], DAP_TRANSFER_OK]
+        if data[4] & READ:
+            for i in range(count):
+                resp.extend([self._reads & 0xff, 0, 0, 0])
+                self._reads += 1
+        assert len(resp) <= self.packet_size
+        self._responses.append(resp)
+        self.max_outstanding = max(self.max_outstanding, len(self._responses))
+
+    def read(self):
+        return self._responses.pop(0)
+
+def make_transport(interface, deferred=True):
+    transport = CMSIS_DAP(interface)
+    transport.mode = DAP_MODE_SWD
+    transport.setDeferredTransfer(deferred)
+    return transport
+
+class TestCommandQueue:
+    def test_packets_filled(self):
+        interface = TransferInterface()
+        transport = make_transport(interface)
+        for i in range(30):
+            transport.readDP(DP_REG['CTRL_STAT'], mode=READ_START)
+        values = [transport.readDP(DP_REG['CTRL_STAT'], mode=READ_END) for i in range(30)]
+        assert values == range(30)
+        # 15 reads fit in the response of a 64 byte packet.
+        assert [p[2] for p in interface.packets] == [15, 15]
+
+    def test_writes_filled(self):
+        interface = TransferInterface()
+        transport = make_transport(interface)
+        for i in range(24):
+            transport.writeDP(DP_REG['CTRL_STAT'], i)
+        transport.flush()
+        # 12 writes fit in the command of a 64 byte packet.
+        assert [p[2] for p in interface.packets] == [12, 12]
+
+    def test_pipelined(self):
+        interface = TransferInterface(packet_count=2)
+        transport = make_transport(interface)
+        futures = [transport.readDP(DP_REG['CTRL_STAT'], mode=READ_START) for i in range(100)]
+        transport.flush()
+        assert [f.result() for f in futures] == range(100)
+        assert interface.max_outstanding == 2
+        assert len(interface.packets) == 7
+
+    def test_read_now_with_pending_reads(self):
+        interface = TransferInterface()
+        transport = make_transport(interface)
+        transport.readDP(DP_REG['CTRL_STAT'], mode=READ_START)
+        assert transport.readDP(DP_REG['CTRL_STAT']) == 1
+        assert transport.readDP(DP_REG['CTRL_STAT'], mode=READ_END) == 0
+
+    def test_not_deferred(self):
+        interface = TransferInterface()
+        transport = make_transport(interface, deferred=False)
+        transport.writeDP(DP_REG['CTRL_STAT'], 0)
+        assert len(interface.packets) == 1
+        assert transport.readDP(DP_REG['CTRL_STAT']) == 0
+        assert len(interface.packets) == 2
+
+    def test_fault(self):
+        interface = TransferInterface(packet_count=4)
+        interface.fault_on_packet = 1
+        transport = make_transport(interface)
+        futures = [transport.readDP(DP_REG['CTRL_STAT'], mode=READ_START) for i in range(40)]
+        with pytest.raises(TransferError):
+            transport.flush()
+        for f in futures:
+            with pytest.raises(TransferError):
+                f.result()
+        # All outstanding responses were drained.
+        assert interface._responses == []
+
+class TestAsyncBlock:
+    def test_block_reads_overlap(self):
+        interface = TransferInterface(packet_count=3)
+        transport = make_transport(interface, deferred=False)
+        first = transport.readBlock32Async(0x20000000, 30)
+        second = transport.readBlock32Async(0x20000400, 30)
+        # The second block is still in flight
+        assert not second.done
+        assert second.result() == range(30, 60)
+        assert first.done
+        assert first.result() == range(30)
+        assert interface.max_outstanding == 3
+
+    def test_block_write_future(self):
+        interface = TransferInterface(packet_count=4)
+        transport = make_transport(interface)
+        future = transport.writeBlock32Async(0x20000000, range(30))
+        assert not future.done
+        transport.flush()
+        assert future.done
+        assert future.result() is None
+        blocks = [p for p in interface.packets if p[0] == COMMAND_ID['DAP_TRANSFER_BLOCK']]
+        assert [p[2] for p in blocks] == [14, 14, 2]
+
+    def test_empty_block(self):
+        transport = make_transport(TransferInterface())
+        assert transport.readBlock32Async(0x20000000, 0).result() == []
+
+class TestValueMatch:
+    def test_match(self):
+        interface = TransferInterface()
+        transport = make_transport(interface)
+        interface.match_value = 0x00030003
+        assert transport.waitForMatch(0xE000EDF0, 0x00020000, 0x00020000, 16)
+        assert interface.match_retry == 16
+
+    def test_mismatch(self):
+        interface = TransferInterface()
+        transport = make_transport(interface)
+        interface.match_value = 0x00010003
+        assert not transport.waitForMatch(0xE000EDF0, 0x00020000, 0x00020000, 16)
+        # The transport is still usable after a mismatch
+        assert transport.readDP(DP_REG['CTRL_STAT']) == 0
+        # The retry count is only configured when it changes
+        transport.waitForMatch(0xE000EDF0, 0x00020000, 0x00020000, 16)
+        assert interface.configure_count == 1
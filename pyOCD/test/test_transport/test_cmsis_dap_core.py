@@ -0,0 +1,74 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from pyOCD.interface.interface import Interface
+from pyOCD.transport.cmsis_dap_core import (CMSIS_DAP_Protocol, COMMAND_ID,
+    DAP_TRANSFER_OK)
+from pyOCD.transport.cmsis_dap import READ, WRITE, AP_ACC, AP_REG
+
+## @brief Interface that answers DAP_TRANSFER_BLOCK commands with dummy data.
+class BlockInterface(Interface):
+    def __init__(self, packet_size):
+        super(BlockInterface, self).__init__()
+        self.packet_size = packet_size
+        self.packet_count = 4
+        self.commands = []
+        self._responses = []
+
+    def write(self, data):
+        assert len(data) <= self.packet_size
+        self.commands.append(list(data))
+        count = data[2] | (data[3] << 8)
+        resp = [COMMAND_ID['DAP_TRANSFER_BLOCK'], data[2], data[3], DAP_TRANSFER_OK]
+        if data[4] & READ:
+            for i in range(count):
+                resp.extend([i & 0xff, 0, 0, 0])
+        assert len(resp) <= self.packet_size
+        self._responses.append(resp)
+
+    def read(self):
+        return self._responses.pop(0)
+
+READ_DRW = READ | AP_ACC | AP_REG['DRW']
+WRITE_DRW = WRITE | AP_ACC | AP_REG['DRW']
+
+class TestTransferBlock:
+    def test_word_count(self):
+        protocol = CMSIS_DAP_Protocol(BlockInterface(64))
+        assert protocol.getTransferBlockWordCount(READ_DRW) == 15
+        assert protocol.getTransferBlockWordCount(WRITE_DRW) == 14
+        protocol = CMSIS_DAP_Protocol(BlockInterface(512))
+        assert protocol.getTransferBlockWordCount(READ_DRW) == 127
+        assert protocol.getTransferBlockWordCount(WRITE_DRW) == 126
+
+    def test_read_split(self):
+        interface = BlockInterface(512)
+        protocol = CMSIS_DAP_Protocol(interface)
+        resp = protocol.transferBlock(300, READ_DRW)
+        assert len(resp) == 300 * 4
+        assert [c[2] | (c[3] << 8) for c in interface.commands] == [127, 127, 46]
+
+    def test_write_split(self):
+        interface = BlockInterface(64)
+        protocol = CMSIS_DAP_Protocol(interface)
+        data = range(30)
+        protocol.transferBlock(len(data), WRITE_DRW, data)
+        assert [c[2] for c in interface.commands] == [14, 14, 2]
+        written = []
+        for c in interface.commands:
+            written.extend(c[5::4])
+        assert written == data
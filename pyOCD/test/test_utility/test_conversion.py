@@ -15,7 +15,7 @@
 import unittest
 from pyOCD.utility.conversion import byteListToU32leList, u32leListToByteList, u16leListToByteList, \
     byteListToU16leList, u32BEToFloat32BE, float32beToU32be, u32beToHex8le, hex8leToU32be, byteToHex2, hexToByteList, \
-    hexDecode, hexEncode
+    hexDecode, hexEncode, bytesToU32leList, u32leListToBytes
 
 
 class TestConversionUtilities(unittest.TestCase):
@@ -45,6 +45,15 @@ class TestConversionUtilities(unittest.TestCase):
         ]
         self.assertEqual(u32leListToByteList(data), range(32))
 
+    def test_bytesToU32leList(self):
+        data = bytearray(range(8))
+        self.assertEqual(bytesToU32leList(data), [0x03020100, 0x07060504])
+        self.assertEqual(bytesToU32leList(memoryview(data)[4:]), [0x07060504])
+
+    def test_u32leListToBytes(self):
+        self.assertEqual(u32leListToBytes([0x03020100, 0x07060504]),
+                         bytearray(range(8)))
+
     def test_u16leListToByteList(self):
         data = [0x3412, 0xFEAB]
         self.assertEqual(u16leListToByteList(data), [
@@ -87,3 +96,5 @@ class TestConversionUtilities(unittest.TestCase):
     def test_hexEncode(self):
         self.assertEqual(hexEncode('\xab\xcd\xef\x12\x34'),
                          'abcdef1234')
+        self.assertEqual(hexEncode(bytearray([0, 0x1f, 0xff])),
+                         '001fff')
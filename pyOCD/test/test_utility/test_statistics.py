@@ -0,0 +1,73 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+
+from pyOCD.utility.statistics import (Histogram, Statistics, timed,
+    formatStatistics)
+
+class Timed(object):
+    def __init__(self):
+        self.stats = Statistics()
+
+    @timed('run')
+    def run(self, value):
+        if value is None:
+            raise ValueError()
+        return value
+
+class TestStatistics:
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in (0, 1, 3, 4, 1000):
+            histogram.add(value)
+        stats = histogram.getStatistics()
+        assert stats['count'] == 5
+        assert stats['min'] == 0
+        assert stats['max'] == 1000
+        assert stats['mean'] == 201.6
+        assert stats['buckets'] == {1 : 1, 2 : 1, 4 : 1, 8 : 1, 1024 : 1}
+
+    def test_counters(self):
+        stats = Statistics()
+        stats.increment('packets')
+        stats.increment('bytes', 64)
+        stats.record('size', 3)
+        result = stats.getStatistics()
+        assert result['packets'] == 1
+        assert result['bytes'] == 64
+        assert result['histograms']['size']['count'] == 1
+        stats.reset()
+        assert stats.getStatistics() == {'histograms' : {}}
+
+    def test_timed(self):
+        obj = Timed()
+        assert obj.run(5) == 5
+        try:
+            obj.run(None)
+        except ValueError:
+            pass
+        assert obj.stats.getStatistics()['histograms']['run']['count'] == 2
+        assert Timed.run.__name__ == 'run'
+
+    def test_format(self):
+        stats = Statistics()
+        stats.increment('packets', 2)
+        stats.record('size', 3)
+        lines = formatStatistics({'layer' : stats.getStatistics(), 'empty' : {}})
+        assert lines[0] == 'layer:'
+        assert '  packets: 2' in lines
+        assert any(line.startswith('    size: count=1') for line in lines)
@@ -21,7 +21,7 @@ import os
 import sys
 import logging
 import itertools
-from struct import unpack
+import threading
 
 try:
     from intelhex import IntelHex
@@ -32,6 +32,8 @@ except ImportError:
 import pyOCD
 from pyOCD import __version__
 from pyOCD.board import MbedBoard
+from pyOCD.flash.multi_board import MultiBoardProgrammer
+from pyOCD.flash.flash_builder import plan_cache
 
 LEVELS = {
     'debug': logging.DEBUG,
@@ -68,8 +70,11 @@ parser.add_argument("format", nargs='?', choices=supported_formats, default=None
 parser.add_argument('--version', action='version', version=__version__)
 # reserved: "-p", "--port"
 # reserved: "-c", "--cmd-port"
-parser.add_argument("-b", "--board", dest="board_id", default=None,
-                    help="Connect to board by board id.  Use -l to list all connected boards.")
+parser.add_argument("-b", "--board", dest="board_id", action="append", default=None,
+                    help="Connect to board by board id.  Use -l to list all connected boards. "
+                    "Give more than once to program several boards concurrently.")
+parser.add_argument("-A", "--all", action="store_true", dest="all_boards", default=False,
+                    help="Program every connected board concurrently.")
 parser.add_argument("-l", "--list", action="store_true", dest="list_all", default=False,
                     help="List all connected boards.")
 parser.add_argument("-d", "--debug", dest="debug_level", choices=debug_levels, default='info',
@@ -98,6 +103,11 @@ parser.add_argument("-s", "--skip", default=0, type=int_base_0,
 parser.add_argument("-hp", "--hide_progress", action="store_true", help="Don't display programming progress.")
 parser.add_argument("-fp", "--fast_program", action="store_true",
                     help="Use only the CRC of each page to determine if it already has the same data.")
+parser.add_argument("--delta", action="store_true",
+                    help="Program only the changed parts of pages that are already erased, without erasing the page.")
+parser.add_argument("--plan-cache", dest="plan_cache", default=None, metavar="DIR",
+                    help="Save the page layout and CRCs of programmed images in DIR so that "
+                    "programming the same image again skips that work.")
 
 # Notes
 # -Currently "--unlock" does nothing since kinetis parts will automatically get unlocked
@@ -133,6 +143,119 @@ def print_progress(progress):
             sys.stdout.write("\n")
 
 
+class MultiProgress(object):
+    """
+    Combine the progress of several boards into a single progress bar.
+    """
+    def __init__(self, boards):
+        self.progress = dict((board.getUniqueID(), 0.0) for board in boards)
+        self.lock = threading.Lock()
+        self.done = False
+
+    def __call__(self, board, progress):
+        with self.lock:
+            self.progress[board.getUniqueID()] = progress
+            if self.done:
+                return
+            done = len([p for p in self.progress.values() if p >= 1.0])
+            total = sum(self.progress.values()) / len(self.progress)
+            sys.stdout.write('\r')
+            i = int(total * 20.0)
+            sys.stdout.write("[%-20s] %3d%% (%d/%d boards)" % ('=' * i, round(total * 100), done, len(self.progress)))
+            if done == len(self.progress):
+                self.done = True
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+
+
+def read_image(args, rom_start):
+    """
+    Read the file given on the command line and return a list of
+    (address, data) blocks to program.
+    """
+    # If no format provided, use the file's extension.
+    if not args.format:
+        args.format = os.path.splitext(args.file)[1][1:]
+
+    # Binary file format
+    if args.format == 'bin':
+        # If no address is specified use the start of rom
+        address = args.address
+        if address is None:
+            address = rom_start
+
+        with open(args.file, "rb") as f:
+            f.seek(args.skip, 0)
+            data = bytearray(f.read())
+        return [(address + args.skip, data)]
+
+    # Intel hex file format
+    elif args.format == 'hex':
+        hex = IntelHex(args.file)
+        addresses = hex.addresses()
+        addresses.sort()
+
+        blocks = []
+        for start, end in ranges(addresses):
+            size = end - start + 1
+            blocks.append((start, bytearray(hex.tobinarray(start=start, size=size))))
+        return blocks
+
+    else:
+        print("Unknown file format '%s'" % args.format)
+        return None
+
+
+def program_boards(args, chip_erase):
+    """
+    Program the file into several boards at once and return the process
+    exit code: 0 if every board passed, 1 otherwise.
+    """
+    board_ids = None if args.all_boards else args.board_id
+    boards = MbedBoard.chooseBoards(board_ids=board_ids, target_override=args.target_override,
+                                    frequency=args.frequency)
+    if not boards:
+        print("No boards to program")
+        return 1
+    missing = board_ids is not None and len(boards) != len(board_ids)
+
+    # The file is read once and shared by all of the boards. A binary file
+    # without an address goes to the start of ROM, which must be the same
+    # on every board.
+    rom_starts = set(board.flash.getFlashInfo().rom_start for board in boards)
+    blocks = read_image(args, min(rom_starts))
+    if blocks is not None and args.format == 'bin' and args.address is None and len(rom_starts) > 1:
+        print("The boards' ROM start differs, give the address of the binary file with --address")
+        blocks = None
+    if blocks is None:
+        for board in boards:
+            board.interface.close()
+        return 1
+
+    progress = None
+    if not args.hide_progress:
+        progress = MultiProgress(boards)
+    programmer = MultiBoardProgrammer(boards, chip_erase=chip_erase, fast_verify=args.fast_program,
+                                      progress_cb=progress, delta=args.delta)
+    for address, data in blocks:
+        programmer.addData(address, data)
+    print("Programming %i boards" % len(boards))
+    results = programmer.program()
+
+    print("")
+    print("{:<52}{:<14}{:<8}{:<12}{:<12}".format("Board", "Target", "Result", "Connect", "Total"))
+    for result in results:
+        status = "Pass" if result.passed else "Fail"
+        connect = "%.3fs" % result.connect_time if result.connect_time is not None else "-"
+        print("{:<52}{:<14}{:<8}{:<12}{:<12}".format(result.unique_id, result.target_type, status,
+                                                      connect, "%.3fs" % result.total_time))
+        if result.error is not None:
+            print("    %s" % result.error)
+    failed = len([result for result in results if not result.passed])
+    print("%i of %i boards programmed" % (len(results) - failed, len(results)))
+    return 1 if failed or missing else 0
+
+
 def main():
     args = parser.parse_args()
     setup_logging(args)
@@ -143,10 +266,24 @@ def main():
         print("Module 'intelhex' must be installed first")
         exit()
 
+    if args.plan_cache is not None:
+        plan_cache.directory = args.plan_cache
+
     if args.list_all:
         MbedBoard.listConnectedBoards()
+    elif args.all_boards or (args.board_id and len(args.board_id) > 1):
+        if args.file is None:
+            print("A file is required to program several boards")
+            sys.exit(1)
+        chip_erase = None
+        if args.chip_erase:
+            chip_erase = True
+        elif args.sector_erase:
+            chip_erase = False
+        sys.exit(program_boards(args, chip_erase))
     else:
-        board_selected = MbedBoard.chooseBoard(board_id=args.board_id, target_override=args.target_override,
+        board_id = args.board_id[0] if args.board_id else None
+        board_selected = MbedBoard.chooseBoard(board_id=board_id, target_override=args.target_override,
                                                frequency=args.frequency)
         with board_selected as board:
             flash = board.flash
@@ -193,41 +330,18 @@ def main():
                     print("No operation performed")
                 return
 
-            # If no format provided, use the file's extension.
-            if not args.format:
-                args.format = os.path.splitext(args.file)[1][1:]
-
-            # Binary file format
-            if args.format == 'bin':
-                # If no address is specified use the start of rom
-                if args.address is None:
-                    args.address = board.flash.getFlashInfo().rom_start
-
-                with open(args.file, "rb") as f:
-                    f.seek(args.skip, 0)
-                    data = f.read()
-                args.address += args.skip
-                data = unpack(str(len(data)) + 'B', data)
-                flash.flashBlock(args.address, data, chip_erase=chip_erase, progress_cb=progress,
-                                 fast_verify=args.fast_program)
-
-            # Intel hex file format
-            elif args.format == 'hex':
-                hex = IntelHex(args.file)
-                addresses = hex.addresses()
-                addresses.sort()
-
-                flash_builder = flash.getFlashBuilder()
-
-                data_list = list(ranges(addresses))
-                for start, end in data_list:
-                    size = end - start + 1
-                    data = list(hex.tobinarray(start=start, size=size))
-                    flash_builder.addData(start, data)
-                flash_builder.program(chip_erase=chip_erase, progress_cb=progress, fast_verify=args.fast_program)
-
-            else:
-                print("Unknown file format '%s'" % args.format)
+            blocks = read_image(args, flash.getFlashInfo().rom_start)
+            if blocks is None:
+                return
+
+            flash_builder = flash.getFlashBuilder()
+            flash_builder.enableDeltaProgramming(args.delta)
+            for address, data in blocks:
+                flash_builder.addData(address, data)
+            perf = flash_builder.program(chip_erase=chip_erase, progress_cb=progress, fast_verify=args.fast_program)
+            if perf is not None:
+                print("Programmed %i bytes, %i bytes were already the same" %
+                      (perf.program_byte_count, perf.skipped_byte_count))
 
 if __name__ == '__main__':
     main()
@@ -24,6 +24,8 @@ import argparse
 import pyOCD.board.mbed_board
 from pyOCD import __version__
 from pyOCD.gdbserver import GDBServer
+from pyOCD.gdbserver.multi_board import MultiBoardGDBServer
+from pyOCD.gdbserver.halt_watch import HALT_WATCH, DEFAULT_HALT_WATCH
 from pyOCD.board import MbedBoard
 from pyOCD.utility.cmdline import split_command_line
 import pyOCD.board.mbed_board
@@ -51,7 +53,8 @@ class GDBServerTool(object):
         parser.add_argument('--version', action='version', version=__version__)
         parser.add_argument("-p", "--port", dest = "port_number", type=int, default = 3333, help = "Write the port number that GDB server will open.")
         parser.add_argument("-T", "--telnet-port", dest="telnet_port", type=int, default=4444, help="Specify the telnet port for semihosting.")
-        parser.add_argument("-b", "--board", dest = "board_id", default = None, help="Connect to board by board id.  Use -l to list all connected boards.")
+        parser.add_argument("-b", "--board", dest = "board_id", action = "append", default = None, help="Connect to board by board id.  Use -l to list all connected boards.  Give more than once to serve several boards, each on its own port.")
+        parser.add_argument("-A", "--all", dest = "all_boards", action = "store_true", default = False, help = "Serve every connected board, each on its own port counting up from the GDB and telnet ports. Boards are picked up and dropped as probes are plugged in and removed.")
         parser.add_argument("-l", "--list", action = "store_true", dest = "list_all", default = False, help = "List all connected boards.")
         parser.add_argument("-d", "--debug", dest = "debug_level", choices = debug_levels, default = 'info', help = "Set the level of system logging output. Supported choices are: "+", ".join(debug_levels), metavar="LEVEL")
         parser.add_argument("-t", "--target", dest = "target_override", choices=supported_targets, default = None, help = "Override target to debug.  Supported targets are: "+", ".join(supported_targets), metavar="TARGET")
@@ -72,6 +75,8 @@ class GDBServerTool(object):
         parser.add_argument("-fp", "--fast_program", action="store_true", help = "Use only the CRC of each page to determine if it already has the same data.")
         parser.add_argument("-S", "--semihosting", dest="enable_semihosting", action="store_true", help="Enable semihosting.")
         parser.add_argument("-G", "--gdb-syscall", dest="semihost_use_syscalls", action="store_true", help="Use GDB syscalls for semihosting file I/O.")
+        parser.add_argument("-mc", "--memory-cache", dest="enable_memory_cache", action="store_true", help="Cache target memory on the host while the target is halted.")
+        parser.add_argument("-hw", "--halt-watch", dest="halt_watch", choices=sorted(HALT_WATCH.keys()), default=DEFAULT_HALT_WATCH, help="How to detect the target halting while it runs: poll every 10 ms, poll with backoff, or have the probe wait for a halt with value match. Default is %s." % DEFAULT_HALT_WATCH)
         parser.add_argument("-c", "--command", dest="commands", metavar="CMD", action='append', nargs='+', help="Run command (OpenOCD compatibility).")
         return parser
 
@@ -100,6 +105,8 @@ class GDBServerTool(object):
             'enable_semihosting' : args.enable_semihosting,
             'telnet_port' : args.telnet_port,
             'semihost_use_syscalls' : args.semihost_use_syscalls,
+            'enable_memory_cache' : args.enable_memory_cache,
+            'halt_watch' : args.halt_watch,
         }
 
 
@@ -146,10 +153,12 @@ class GDBServerTool(object):
         gdb = None
         if self.args.list_all == True:
             MbedBoard.listConnectedBoards()
+        elif self.args.all_boards or len(self.args.board_id or []) > 1:
+            return self.serve_boards()
         else:
             try:
                 board_selected = MbedBoard.chooseBoard(
-                    board_id=self.args.board_id,
+                    board_id=self.args.board_id[0] if self.args.board_id else None,
                     target_override=self.args.target_override,
                     frequency=self.args.frequency)
                 with board_selected as board:
@@ -171,6 +180,17 @@ class GDBServerTool(object):
         # Successful exit.
         return 0
 
+    def serve_boards(self):
+        board_ids = None if self.args.all_boards else self.args.board_id
+        gdb = MultiBoardGDBServer(self.args.port_number, self.gdb_server_settings, board_ids=board_ids,
+                                  target_override=self.args.target_override, frequency=self.args.frequency)
+        try:
+            while gdb.isAlive():
+                gdb.join(timeout=0.5)
+        except KeyboardInterrupt:
+            gdb.stop()
+        return 0
+
 def main():
     sys.exit(GDBServerTool().run())
 
@@ -28,6 +28,7 @@ import pyOCD
 from pyOCD import __version__
 from pyOCD.board import MbedBoard
 from pyOCD.target import target_kinetis
+from pyOCD.utility.statistics import formatStatistics
 
 # Make disasm optional.
 try:
@@ -159,6 +160,11 @@ COMMAND_INFO = {
             'args' : "KHZ",
             'help' : "Set SWD or JTAG clock frequency"
             },
+        'stats' : {
+            'aliases' : [],
+            'args' : "[reset]",
+            'help' : "Show USB round trip, transfer and API latency statistics"
+            },
         'exit' : {
             'aliases' : ['quit'],
             'args' : "",
@@ -325,6 +331,7 @@ class PyOCDTool(object):
                 'map' :     self.handle_memory_map,
                 'log' :     self.handle_log,
                 'clock' :   self.handle_clock,
+                'stats' :   self.handle_stats,
                 'exit' :    self.handle_exit,
                 'quit' :    self.handle_exit
             }
@@ -648,6 +655,13 @@ class PyOCDTool(object):
 
         print "Changed %s frequency to %s" % (swd_jtag, nice_freq)
 
+    def handle_stats(self, args):
+        if args and args[0] == 'reset':
+            self.board.resetStatistics()
+            return
+        for line in formatStatistics(self.board.getStatistics()):
+            print line
+
     def handle_exit(self, args):
         raise ToolExitException()
 
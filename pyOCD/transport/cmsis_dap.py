@@ -15,9 +15,14 @@
  limitations under the License.
 """
 
-from cmsis_dap_core import CMSIS_DAP_Protocol
-from transport import Transport, TransferError, READ_START, READ_NOW, READ_END
+from cmsis_dap_core import (CMSIS_DAP_Protocol, TRANSFER_COMMAND_HEADER_SIZE,
+    TRANSFER_RESPONSE_HEADER_SIZE, MAX_TRANSFER_COUNT)
+from transport import (Transport, TransferError, ValueMismatchError,
+    READ_START, READ_NOW, READ_END)
+from ..utility.statistics import Statistics
 import logging
+import collections
+import struct
 from time import sleep
 
 # !! This value are A[2:3] and not A[3:2]
@@ -75,7 +80,169 @@ CTRLSTAT_STICKYORUN = 0x00000002
 CTRLSTAT_STICKYCMP = 0x00000010
 CTRLSTAT_STICKYERR = 0x00000020
 
-COMMANDS_PER_DAP_TRANSFER = 12
+## @brief Result of a read or write queued on the transport.
+#
+# The value becomes available once the DAP_TRANSFER packet carrying the
+# command has been answered by the probe. Calling result() sends any queued
+# commands and waits for the response if necessary.  Writes have a result
+# of None.
+class DAPFuture(object):
+    def __init__(self, transport, convert=None):
+        self._transport = transport
+        self._convert = convert
+        self._value = None
+        self._error = None
+        self._callbacks = []
+        self._packet = None
+        self.done = False
+
+    def addCallback(self, callback):
+        """
+        Call callback(future) once the result is available
+        """
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self):
+        if not self.done:
+            self._transport._waitFor(self)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _setResult(self, data):
+        value = (data[0] << 0)  | \
+                (data[1] << 8)  | \
+                (data[2] << 16) | \
+                (data[3] << 24)
+        if self._convert is not None:
+            value = self._convert(value)
+        self._setValue(value)
+
+    def _setValue(self, value):
+        self._value = value
+        self._complete()
+
+    def _setError(self, error):
+        if self.done:
+            return
+        self._error = error
+        self._complete()
+
+    def _complete(self):
+        self.done = True
+        for callback in self._callbacks:
+            callback(self)
+        self._callbacks = []
+
+## @brief Result of a block transfer split over DAP_TRANSFER_BLOCK packets.
+#
+# Completes once the response to the last packet has been read.  The result
+# of a read is the list of words read, or a bytearray if raw bytes were
+# requested.  The result of a write is None.
+class DAPBlockFuture(DAPFuture):
+    def __init__(self, transport, packet_count, is_read, as_bytes=False):
+        super(DAPBlockFuture, self).__init__(transport)
+        self._packets_pending = packet_count
+        self._data = bytearray() if is_read else None
+        self._as_bytes = as_bytes
+        if packet_count == 0:
+            self._finish()
+
+    def _addData(self, data):
+        if self.done:
+            return
+        if self._data is not None:
+            self._data.extend(data)
+        self._packets_pending -= 1
+        if self._packets_pending == 0:
+            self._finish()
+
+    def _finish(self):
+        data = self._data
+        self._data = None
+        if data is not None and not self._as_bytes:
+            data = list(struct.unpack_from('<%dI' % (len(data) // 4), data))
+        self._setValue(data)
+
+## @brief A DAP_TRANSFER packet being assembled by the transport.
+#
+# Requests are added until either the command or its response would no
+# longer fit in a single packet of the negotiated size.
+class _TransferPacket(object):
+    def __init__(self, packet_size):
+        self._packet_size = packet_size
+        self._request_list = []
+        self._data_list = []
+        self._futures = []
+        self._write_futures = []
+        self._command_size = TRANSFER_COMMAND_HEADER_SIZE
+        self._response_size = TRANSFER_RESPONSE_HEADER_SIZE
+
+    def __len__(self):
+        return len(self._request_list)
+
+    @staticmethod
+    def _getSizes(request):
+        # Return the number of command and response bytes used by a request
+        if (request & READ) and not (request & VALUE_MATCH):
+            return 1, 4
+        return 5, 0
+
+    def canAdd(self, request):
+        if len(self._request_list) >= MAX_TRANSFER_COUNT:
+            return False
+        command_size, response_size = self._getSizes(request)
+        return (self._command_size + command_size <= self._packet_size and
+                self._response_size + response_size <= self._packet_size)
+
+    def add(self, request, data, future):
+        command_size, response_size = self._getSizes(request)
+        self._command_size += command_size
+        self._response_size += response_size
+        self._request_list.append(request)
+        self._data_list.append(data)
+        if response_size:
+            self._futures.append(future)
+        elif future is not None:
+            self._write_futures.append(future)
+        if future is not None:
+            future._packet = self
+
+    def send(self, protocol):
+        protocol.transferSend(len(self._request_list), self._request_list, self._data_list)
+
+    def receive(self, protocol):
+        data = protocol.transferReceive(len(self._request_list), self._request_list)
+        for i, future in enumerate(self._futures):
+            if future is not None:
+                future._setResult(data[i*4:i*4+4])
+        for future in self._write_futures:
+            future._setValue(None)
+
+    def fail(self, error):
+        for future in self._futures + self._write_futures:
+            if future is not None:
+                future._setError(error)
+
+## @brief A single DAP_TRANSFER_BLOCK packet of a block transfer.
+class _TransferBlockPacket(object):
+    def __init__(self, count, request, data, future):
+        self._count = count
+        self._request = request
+        self._data = data
+        self._future = future
+
+    def send(self, protocol):
+        protocol.transferBlockSend(self._count, self._request, self._data)
+
+    def receive(self, protocol):
+        self._future._addData(protocol.transferBlockReceive(self._count, self._request))
+
+    def fail(self, error):
+        self._future._setError(error)
 
 class CMSIS_DAP(Transport):
     """
@@ -89,9 +256,15 @@ class CMSIS_DAP(Transport):
         self.csw = -1
         self.dp_select = -1
         self.deferred_transfer = False
-        self.request_list = []
-        self.data_list = []
-        self.data_read_list = []
+        # Match retry count last sent with DAP_TRANSFER_CONFIGURE
+        self._match_retry = 0
+        # DAP_TRANSFER packet currently being filled
+        self._crnt_packet = None
+        # Packets sent to the probe whose response has not been read yet
+        self._packets_in_flight = collections.deque()
+        # Futures for reads started with READ_START, in order
+        self._read_futures = collections.deque()
+        self.stats = Statistics()
 
     def init(self, frequency = 1000000):
         # Flush to be safe
@@ -102,6 +275,7 @@ class CMSIS_DAP(Transport):
         self.protocol.setSWJClock(frequency)
         # configure transfer
         self.protocol.transferConfigure()
+        self._match_retry = 0
         if (self.mode == DAP_MODE_SWD):
             # configure swd protocol
             self.protocol.swdConfigure()
@@ -156,157 +330,208 @@ class CMSIS_DAP(Transport):
             self.writeDP(DP_REG['CTRL_STAT'], CTRLSTAT_STICKYERR)
 
     def writeMem(self, addr, data, transfer_size = 32):
-        self.writeAP(AP_REG['CSW'], CSW_VALUE | TRANSFER_SIZE[transfer_size])
+        self.writeMemAsync(addr, data, transfer_size)
+
+        # If not in deferred mode flush after calls to _read or _write
+        if not self.deferred_transfer:
+            self.flush()
+
+    def writeMemAsync(self, addr, data, transfer_size = 32):
+        """
+        Queue a memory write and return a DAPFuture that completes once
+        the probe has acknowledged it.  Nothing is flushed.
+        """
+        self._writeAP(AP_REG['CSW'], CSW_VALUE | TRANSFER_SIZE[transfer_size])
 
         if transfer_size == 8:
             data = data << ((addr & 0x03) << 3)
         elif transfer_size == 16:
             data = data << ((addr & 0x02) << 3)
 
+        future = DAPFuture(self)
         self._write(WRITE | AP_ACC | AP_REG['TAR'], addr)
-        self._write(WRITE | AP_ACC | AP_REG['DRW'], data)
-
-        # If not in deferred mode flush after calls to _read or _write
-        if not self.deferred_transfer:
-            self.flush()
+        self._write(WRITE | AP_ACC | AP_REG['DRW'], data, future)
+        return future
 
     def readMem(self, addr, transfer_size = 32, mode = READ_NOW):
-        res = None
+        future = None
         if mode in (READ_START, READ_NOW):
-            self.writeAP(AP_REG['CSW'], CSW_VALUE | TRANSFER_SIZE[transfer_size])
-            self._write(WRITE | AP_ACC | AP_REG['TAR'], addr)
-            self._write(READ | AP_ACC | AP_REG['DRW'])
-
-        if mode in (READ_NOW, READ_END):
-            resp = self._read()
-            res =   (resp[0] << 0)  | \
-                    (resp[1] << 8)  | \
-                    (resp[2] << 16) | \
-                    (resp[3] << 24)
-
-            # All READ_STARTs must have been finished with READ_END before using READ_NOW
-            assert (mode != READ_NOW) or (len(self.data_read_list) == 0)
-
-            if transfer_size == 8:
-                res = (res >> ((addr & 0x03) << 3) & 0xff)
-            elif transfer_size == 16:
-                res = (res >> ((addr & 0x02) << 3) & 0xffff)
+            future = self.readMemAsync(addr, transfer_size)
 
         # If not in deferred mode flush after calls to _read or _write
         if not self.deferred_transfer:
             self.flush()
-        return res
+        return self._readResult(future, mode)
+
+    def readMemAsync(self, addr, transfer_size = 32):
+        """
+        Queue a memory read and return a DAPFuture for its value.  The
+        read is sent once its packet is full or the result is needed.
+        """
+        self._writeAP(AP_REG['CSW'], CSW_VALUE | TRANSFER_SIZE[transfer_size])
+        self._write(WRITE | AP_ACC | AP_REG['TAR'], addr)
+
+        convert = None
+        if transfer_size == 8:
+            convert = lambda res: (res >> ((addr & 0x03) << 3) & 0xff)
+        elif transfer_size == 16:
+            convert = lambda res: (res >> ((addr & 0x02) << 3) & 0xffff)
+        return self._read(READ | AP_ACC | AP_REG['DRW'], convert)
 
     # write aligned word ("data" are words)
     def writeBlock32(self, addr, data):
-        # put address in TAR
-        self.writeAP(AP_REG['CSW'], CSW_VALUE | CSW_SIZE32)
-        self.writeAP(AP_REG['TAR'], addr)
-        try:
-            self._transferBlock(len(data), WRITE | AP_ACC | AP_REG['DRW'], data)
-        except TransferError:
-            self.clearStickyErr()
-            raise
+        self.writeBlock32Async(addr, data)
+
         # If not in deferred mode flush after calls to _read or _write
         if not self.deferred_transfer:
             self.flush()
 
+    def writeBlock32Async(self, addr, data):
+        """
+        Send a block of aligned words without waiting for the probe to
+        acknowledge them.  data is a list of words or a bytearray of little
+        endian words.  Returns a DAPBlockFuture that completes once every
+        packet of the block has been acknowledged.
+        """
+        if isinstance(data, bytearray):
+            count = len(data) // 4
+        else:
+            count = len(data)
+        return self._transferBlockAsync(addr, count, WRITE | AP_ACC | AP_REG['DRW'], data)
+
     # read aligned word (the size is in words)
     def readBlock32(self, addr, size):
-        # put address in TAR
-        self.writeAP(AP_REG['CSW'], CSW_VALUE | CSW_SIZE32)
-        self.writeAP(AP_REG['TAR'], addr)
-        data = []
+        return self.readBlock32Async(addr, size).result()
+
+    def readBlock32Async(self, addr, size, as_bytes = False):
+        """
+        Send the reads for a block of aligned words without waiting for
+        the data.  Returns a DAPBlockFuture whose result is the list of
+        words read, or a bytearray of little endian words if as_bytes
+        is set.
+        """
+        return self._transferBlockAsync(addr, size, READ | AP_ACC | AP_REG['DRW'], as_bytes = as_bytes)
+
+    def waitForMatch(self, addr, mask, value, retry = 0):
+        """
+        Have the probe read the word at addr until (word & mask) == value,
+        retrying up to retry times without a USB round trip per read.
+        Returns True if the value matched.
+
+        Everything queued before is flushed first.  The match retry count
+        is only reconfigured when it changes.
+        """
+        self.flush()
+        if retry != self._match_retry:
+            self.protocol.transferConfigure(match_retry = retry)
+            self._match_retry = retry
+        self._writeAP(AP_REG['CSW'], CSW_VALUE | CSW_SIZE32)
+        self._write(WRITE | AP_ACC | AP_REG['TAR'], addr)
+        self._write(WRITE | MATCH_MASK, mask)
+        future = DAPFuture(self)
+        self._write(READ | AP_ACC | AP_REG['DRW'] | VALUE_MATCH, value, future)
         try:
-            resp = self._transferBlock(size, READ | AP_ACC | AP_REG['DRW'])
-        except TransferError:
-            self.clearStickyErr()
-            raise
-        for i in range(len(resp)/4):
-            data.append( (resp[i*4 + 0] << 0)   | \
-                         (resp[i*4 + 1] << 8)   | \
-                         (resp[i*4 + 2] << 16)  | \
-                         (resp[i*4 + 3] << 24))
-        # If not in deferred mode flush after calls to _read or _write
-        if not self.deferred_transfer:
-            self.flush()
-        return data
+            future.result()
+        except ValueMismatchError:
+            self.stats.increment('match_timeouts')
+            return False
+        return True
+
+    def getMemoryBurstSize(self):
+        """
+        Return the number of bytes of memory that one pipelined burst of
+        block read packets carries, PACKET_COUNT packets each filled with
+        DAP_TRANSFER_BLOCK data.
+        """
+        words = self.protocol.getTransferBlockWordCount(READ | AP_ACC | AP_REG['DRW'])
+        return words * 4 * self.interface.getPacketCount()
+
+    def getStatistics(self):
+        """
+        Return the transport counters, with the wire protocol counters
+        under 'protocol'.
+        """
+        stats = self.stats.getStatistics()
+        stats['protocol'] = self.protocol.stats.getStatistics()
+        return stats
 
+    def resetStatistics(self):
+        self.stats.reset()
+        self.protocol.stats.reset()
 
     def readDP(self, addr, mode = READ_NOW):
-        res = None
+        future = None
         if mode in (READ_START, READ_NOW):
-            self._write(READ | DP_ACC | (addr & 0x0c))
+            future = self._read(READ | DP_ACC | (addr & 0x0c))
 
-        if mode in (READ_NOW, READ_END):
-            resp = self._read()
-            res =   (resp[0] << 0)  | \
-                    (resp[1] << 8)  | \
-                    (resp[2] << 16) | \
-                    (resp[3] << 24)
+        # If not in deferred mode flush after calls to _read or _write
+        if not self.deferred_transfer:
+            self.flush()
+        return self._readResult(future, mode)
 
-            # All READ_STARTs must have been finished with READ_END before using READ_NOW
-            assert (mode != READ_NOW) or (len(self.data_read_list) == 0)
+    def writeDP(self, addr, data):
+        if not self._writeDP(addr, data):
+            return
 
         # If not in deferred mode flush after calls to _read or _write
         if not self.deferred_transfer:
             self.flush()
-        return res
+        return True
 
-    def writeDP(self, addr, data):
+    def writeAP(self, addr, data):
+        if not self._writeAP(addr, data):
+            return
+
+        # If not in deferred mode flush after calls to _read or _write
+        if not self.deferred_transfer:
+            self.flush()
+        return True
+
+    def _writeDP(self, addr, data):
+        """
+        Queue a DP register write.  Returns False if the write was skipped
+        because the cached value already matches.
+        """
         if addr == DP_REG['SELECT']:
             if data == self.dp_select:
-                return
+                return False
             self.dp_select = data
 
         self._write(WRITE | DP_ACC | (addr & 0x0c), data)
-
-        # If not in deferred mode flush after calls to _read or _write
-        if not self.deferred_transfer:
-            self.flush()
         return True
 
-    def writeAP(self, addr, data):
+    def _writeAP(self, addr, data):
+        """
+        Queue an AP register write, selecting the AP and bank first.
+        Returns False if the write was skipped because the cached value
+        already matches.
+        """
         ap_sel = addr & 0xff000000
         bank_sel = addr & APBANKSEL
-        self.writeDP(DP_REG['SELECT'], ap_sel | bank_sel)
+        self._writeDP(DP_REG['SELECT'], ap_sel | bank_sel)
 
         if addr == AP_REG['CSW']:
             if data == self.csw:
-                return
+                return False
             self.csw = data
 
         self._write(WRITE | AP_ACC | (addr & 0x0c), data)
-        # If not in deferred mode flush after calls to _read or _write
-        if not self.deferred_transfer:
-            self.flush()
-
         return True
 
     def readAP(self, addr, mode = READ_NOW):
-        res = None
+        future = None
         if mode in (READ_START, READ_NOW):
             ap_sel = addr & 0xff000000
             bank_sel = addr & APBANKSEL
 
             self.writeDP(DP_REG['SELECT'], ap_sel | bank_sel)
-            self._write(READ | AP_ACC | (addr & 0x0c))
-
-        if mode in (READ_NOW, READ_END):
-            resp = self._read()
-            res =   (resp[0] << 0)  | \
-                    (resp[1] << 8)  | \
-                    (resp[2] << 16) | \
-                    (resp[3] << 24)
-
-            # All READ_STARTs must have been finished with READ_END before using READ_NOW
-            assert (mode != READ_NOW) or (len(self.data_read_list) == 0)
+            future = self._read(READ | AP_ACC | (addr & 0x0c))
 
         # If not in deferred mode flush after calls to _read or _write
         if not self.deferred_transfer:
             self.flush()
 
-        return res
+        return self._readResult(future, mode)
 
     def reset(self):
         self.flush()
@@ -344,9 +569,17 @@ class CMSIS_DAP(Transport):
         READ_START, READ_NOW and READ_END.  The option READ_NOW is the
         default and will cause the read to flush all previous writes,
         and read the data immediately.  To improve performance, multiple
-        reads can be made using READ_START and finished later with READ_NOW.
-        This allows the reads to be buffered and sent at once.  Note - All
-        READ_ENDs must be called before a call using READ_NOW can be made.
+        reads can be made using READ_START and finished later with READ_END,
+        in the same order they were started.  This allows the reads to be
+        buffered and sent at once.  READ_START returns a DAPFuture which
+        can be used instead of READ_END to get the result of that read.
+
+        Commands are packed into DAP_TRANSFER packets up to the packet size
+        reported by the probe, and up to PACKET_COUNT packets are kept in
+        flight before waiting for a response.
+
+        The *Async functions queue their commands regardless of this
+        setting and return a future instead of flushing.
         """
         if self.deferred_transfer and not enable:
             self.flush()
@@ -356,49 +589,135 @@ class CMSIS_DAP(Transport):
         """
         Flush out all commands
         """
-        transfer_count = len(self.request_list)
-        if transfer_count > 0:
-            assert transfer_count <= COMMANDS_PER_DAP_TRANSFER
-            try:
-                data = self.protocol.transfer(transfer_count, self.request_list, self.data_list)
-                self.data_read_list.extend(data)
-            except TransferError:
-                # Dump any pending commands
-                self.request_list = []
-                self.data_list = []
-                # Dump any data read
-                self.data_read_list = []
-                # Invalidate cached registers
-                self.csw = -1
-                self.dp_select = -1
-                # Clear error
-                self.clearStickyErr()
-                raise
-            self.request_list = []
-            self.data_list = []
+        self.stats.increment('flushes')
+        self._sendPacket()
+        while self._packets_in_flight:
+            self._receivePacket()
 
-    def _write(self, request, data = 0):
+    def _write(self, request, data = 0, future = None):
         """
         Write a single command
         """
         assert type(request) in (int, long), "request is not an int"
         assert type(data) in (int, long), "data is not an int"
-        self.request_list.append(request)
-        self.data_list.append(data)
-        transfer_count = len(self.request_list)
-        if (transfer_count >= COMMANDS_PER_DAP_TRANSFER):
-            self.flush()
+        if self._crnt_packet is None:
+            self._crnt_packet = _TransferPacket(self.interface.getPacketSize())
+        elif not self._crnt_packet.canAdd(request):
+            self._sendPacket()
+            self._crnt_packet = _TransferPacket(self.interface.getPacketSize())
+        self._crnt_packet.add(request, data, future)
+
+    def _read(self, request, convert = None):
+        """
+        Queue a single read command and return a future for its result
+        """
+        future = DAPFuture(self, convert)
+        self._write(request, 0, future)
+        return future
 
-    def _read(self):
+    def _readResult(self, future, mode):
         """
-        Read the response from a single command
+        Return the result of a read for the given read mode
         """
-        if len(self.data_read_list) < 4:
-            self.flush()
-        data = self.data_read_list[0:4]
-        self.data_read_list = self.data_read_list[4:]
-        return data
+        if mode == READ_START:
+            self._read_futures.append(future)
+            return future
+        if mode == READ_END:
+            future = self._read_futures.popleft()
+        return future.result()
+
+    def _waitFor(self, future):
+        """
+        Send and receive packets until the result of future is available
+        """
+        if future._packet is self._crnt_packet:
+            self._sendPacket()
+        while not future.done:
+            self._receivePacket()
 
-    def _transferBlock(self, count, request, data = [0]):
-        self.flush()
-        return self.protocol.transferBlock(count, request, data)
+    def _sendPacket(self):
+        """
+        Send the packet being filled, keeping at most PACKET_COUNT
+        packets outstanding on the probe
+        """
+        if not self._crnt_packet:
+            return
+        self._waitForRoom()
+        packet = self._crnt_packet
+        self._crnt_packet = None
+        packet.send(self.protocol)
+        self._packets_in_flight.append(packet)
+        self.stats.record('packets_in_flight', len(self._packets_in_flight))
+
+    def _queuePacket(self, packet):
+        """
+        Send a packet built outside of the DAP_TRANSFER packet being filled
+        """
+        try:
+            self._waitForRoom()
+        except ValueError as error:
+            packet.fail(error)
+            raise
+        packet.send(self.protocol)
+        self._packets_in_flight.append(packet)
+        self.stats.record('packets_in_flight', len(self._packets_in_flight))
+
+    def _waitForRoom(self):
+        while len(self._packets_in_flight) >= self.interface.getPacketCount():
+            self._receivePacket()
+
+    def _receivePacket(self):
+        """
+        Read the response to the oldest packet in flight
+        """
+        packet = self._packets_in_flight.popleft()
+        try:
+            packet.receive(self.protocol)
+        except ValueError as error:
+            packet.fail(error)
+            self._abortPackets(error)
+            if isinstance(error, TransferError):
+                self.stats.increment('transfer_errors')
+                # Invalidate cached registers
+                self.csw = -1
+                self.dp_select = -1
+                # Clear error
+                self.clearStickyErr()
+            raise
+
+    def _abortPackets(self, error):
+        """
+        Drop all queued commands and the responses of packets still in flight
+        """
+        while self._packets_in_flight:
+            packet = self._packets_in_flight.popleft()
+            self.interface.read()
+            packet.fail(error)
+        if self._crnt_packet is not None:
+            self._crnt_packet.fail(error)
+            self._crnt_packet = None
+        # Dump any reads waiting for READ_END
+        self._read_futures.clear()
+
+    def _transferBlockAsync(self, addr, count, request, data = None, as_bytes = False):
+        """
+        Queue a block transfer to or from DRW starting at addr, split into
+        DAP_TRANSFER_BLOCK packets of the probe's packet size
+        """
+        self.stats.record('block_words', count)
+        # put address in TAR
+        self._writeAP(AP_REG['CSW'], CSW_VALUE | CSW_SIZE32)
+        self._writeAP(AP_REG['TAR'], addr)
+        # The TAR write must reach the probe before the block
+        self._sendPacket()
+
+        max_words = self.protocol.getTransferBlockWordCount(request)
+        packet_count = (count + max_words - 1) // max_words
+        future = DAPBlockFuture(self, packet_count, request & READ, as_bytes)
+        # Words per chunk are 4 bytes each when data is a bytearray
+        scale = 4 if isinstance(data, bytearray) else 1
+        for offset in range(0, count, max_words):
+            n = min(count - offset, max_words)
+            chunk = data[offset*scale:(offset + n)*scale] if data is not None else None
+            self._queuePacket(_TransferBlockPacket(n, request, chunk, future))
+        return future
@@ -17,7 +17,9 @@
 
 import logging
 import array
-from transport import TransferError
+import struct
+from transport import TransferError, ValueMismatchError
+from ..utility.statistics import Statistics
 
 COMMAND_ID = {'DAP_INFO': 0x00,
               'DAP_LED': 0x01,
@@ -40,6 +42,8 @@ COMMAND_ID = {'DAP_INFO': 0x00,
               'DAP_VENDOR0': 0x80,
               }
 
+COMMAND_NAME = dict((value, name) for name, value in COMMAND_ID.items())
+
 ID_INFO = {'VENDOR_ID': 0x01,
            'PRODUCT_ID': 0x02,
            'SERIAL_NUMBER': 0x03,
@@ -71,21 +75,48 @@ DAP_ERROR = 0xff
 DAP_TRANSFER_OK = 1
 DAP_TRANSFER_WAIT = 2
 DAP_TRANSFER_FAULT = 4
+DAP_TRANSFER_MISMATCH = 0x10
+
+# Bytes of header before the data words in a DAP_TRANSFER_BLOCK command
+# (command, DAP index, 2-byte count, request) and response (command, 2-byte
+# count, response).
+TRANSFER_BLOCK_COMMAND_HEADER_SIZE = 5
+TRANSFER_BLOCK_RESPONSE_HEADER_SIZE = 4
 
-MAX_PACKET_SIZE = 0x0E
+# Bytes of header in a DAP_TRANSFER command (command, DAP index, count) and
+# response (command, count, response).
+TRANSFER_COMMAND_HEADER_SIZE = 3
+TRANSFER_RESPONSE_HEADER_SIZE = 3
+
+# The transfer count of a DAP_TRANSFER command is a single byte.
+MAX_TRANSFER_COUNT = 255
 
 ## @brief This class implements the CMSIS-DAP wire protocol.
 class CMSIS_DAP_Protocol(object):
     def __init__(self, interface):
         self.interface = interface
+        self.stats = Statistics()
+
+    def _write(self, cmd):
+        stats = self.stats
+        stats.increment('packets_written')
+        stats.increment('bytes_written', len(cmd))
+        stats.increment(COMMAND_NAME.get(cmd[0], 'DAP_UNKNOWN'))
+        self.interface.write(cmd)
+
+    def _read(self):
+        resp = self.interface.read()
+        self.stats.increment('packets_read')
+        self.stats.increment('bytes_read', len(resp))
+        return resp
 
     def dapInfo(self, id_):
         cmd = []
         cmd.append(COMMAND_ID['DAP_INFO'])
         cmd.append(ID_INFO[id_])
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_INFO']:
             raise ValueError('DAP_INFO response error')
 
@@ -112,9 +143,9 @@ class CMSIS_DAP_Protocol(object):
         cmd = []
         cmd.append(COMMAND_ID['DAP_CONNECT'])
         cmd.append(mode)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_CONNECT']:
             raise ValueError('DAP_CONNECT response error')
 
@@ -132,9 +163,9 @@ class CMSIS_DAP_Protocol(object):
     def disconnect(self):
         cmd = []
         cmd.append(COMMAND_ID['DAP_DISCONNECT'])
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_DISCONNECT']:
             raise ValueError('DAP_DISCONNECT response error')
 
@@ -151,9 +182,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append((data >> 8) & 0xff)
         cmd.append((data >> 16) & 0xff)
         cmd.append((data >> 24) & 0xff)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_WRITE_ABORT']:
             raise ValueError('DAP_WRITE_ABORT response error')
 
@@ -165,9 +196,9 @@ class CMSIS_DAP_Protocol(object):
     def resetTarget(self):
         cmd = []
         cmd.append(COMMAND_ID['DAP_RESET_TARGET'])
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_RESET_TARGET']:
             raise ValueError('DAP_RESET_TARGET response error')
 
@@ -184,9 +215,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append(wait_retry >> 8)
         cmd.append(match_retry & 0xff)
         cmd.append(match_retry >> 8)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_TRANSFER_CONFIGURE']:
             raise ValueError('DAP_TRANSFER_CONFIGURE response error')
 
@@ -196,25 +227,49 @@ class CMSIS_DAP_Protocol(object):
         return resp[1]
 
     def transfer(self, count, request, data = [0], dap_index = 0):
+        self.transferSend(count, request, data, dap_index)
+        return self.transferReceive(count, request)
+
+    def transferSend(self, count, request, data = [0], dap_index = 0):
+        """
+        Send a DAP_TRANSFER command without waiting for the response.
+
+        The response must later be collected with transferReceive().
+        """
         cmd = []
         cmd.append(COMMAND_ID['DAP_TRANSFER'])
         cmd.append(dap_index)
         cmd.append(count)
-        count_write = count
         for i in range(count):
             cmd.append(request[i])
-            if not ( request[i] & ((1 << 1) | (1 << 4))):
+            if not (request[i] & (1 << 1)) or (request[i] & (1 << 4)):
+                # Write data or match value for a value-match read
                 cmd.append(data[i] & 0xff)
                 cmd.append((data[i] >> 8) & 0xff)
                 cmd.append((data[i] >> 16) & 0xff)
                 cmd.append((data[i] >> 24) & 0xff)
-                count_write -= 1
-        self.interface.write(cmd)
+        self.stats.record('transfers_per_packet', count)
+        self._write(cmd)
+
+    def transferReceive(self, count, request):
+        """
+        Read and check the response to a DAP_TRANSFER command previously
+        sent with transferSend().  Returns the bytes of read data.
+        """
+        count_read = 0
+        for i in range(count):
+            if (request[i] & (1 << 1)) and not (request[i] & (1 << 4)):
+                count_read += 1
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_TRANSFER']:
             raise ValueError('DAP_TRANSFER response error')
 
+        # A value-match read ran out of retries. The transfers after it
+        # were not performed.
+        if resp[2] & DAP_TRANSFER_MISMATCH:
+            raise ValueMismatchError()
+
         if resp[2] != DAP_TRANSFER_OK:
             if resp[2] == DAP_TRANSFER_FAULT:
                 raise TransferError()
@@ -225,43 +280,91 @@ class CMSIS_DAP_Protocol(object):
         if resp[1] != count:
             raise ValueError('Transfer not completed')
 
-        return resp[3:3+count_write*4]
+        return resp[3:3+count_read*4]
+
+    def getTransferBlockWordCount(self, request):
+        """
+        Return the maximum number of words that a single DAP_TRANSFER_BLOCK
+        packet can carry for the given request, based on the packet size
+        reported by the probe.
+        """
+        packet_size = self.interface.getPacketSize()
+        if request & (1 << 1):
+            # Read data is returned in the response
+            header_size = TRANSFER_BLOCK_RESPONSE_HEADER_SIZE
+        else:
+            # Write data is sent with the command
+            header_size = TRANSFER_BLOCK_COMMAND_HEADER_SIZE
+        return (packet_size - header_size) // 4
+
+    def transferBlockSend(self, count, request, data = [0], dap_index = 0):
+        """
+        Send a single DAP_TRANSFER_BLOCK command without waiting for the
+        response.  count must fit in one packet, see getTransferBlockWordCount().
+        Write data is either a list of words or a bytearray of little endian
+        words.
+
+        The response must later be collected with transferBlockReceive().
+        """
+        cmd = []
+        cmd.append(COMMAND_ID['DAP_TRANSFER_BLOCK'])
+        cmd.append(dap_index)
+        cmd.append(count & 0xff)
+        cmd.append((count >> 8) & 0xff)
+        cmd.append(request)
+        if not (request & ((1 << 1))):
+            if not isinstance(data, bytearray):
+                data = struct.pack('<%dI' % count, *[d & 0xffffffff for d in data[:count]])
+            cmd.extend(bytearray(data[:count*4]))
+        self.stats.record('block_words', count)
+        self._write(cmd)
+
+    def transferBlockReceive(self, count, request):
+        """
+        Read and check the response to a DAP_TRANSFER_BLOCK command previously
+        sent with transferBlockSend().  Returns the bytes of read data.
+        """
+        resp = self._read()
+        if resp[0] != COMMAND_ID['DAP_TRANSFER_BLOCK']:
+            raise ValueError('DAP_TRANSFER_BLOCK response error')
+
+        if resp[3] != DAP_TRANSFER_OK:
+            if resp[3] == DAP_TRANSFER_FAULT:
+                raise TransferError()
+            raise ValueError('DAP_TRANSFER_BLOCK response error')
+
+        if (resp[1] | (resp[2] << 8)) != count:
+            raise ValueError('Transfer not completed')
+
+        if not (request & (1 << 1)):
+            return []
+        return resp[4:4+count*4]
 
     def transferBlock(self, count, request, data = [0], dap_index = 0):
         packet_count = count
         max_pending_reads = self.interface.getPacketCount()
+        max_words = self.getTransferBlockWordCount(request)
         reads_pending = 0
-        nb = 0
+        offset = 0
         resp = []
         error_transfer = False
         error_response = False
 
-        # we send successfully several packets if the size is bigger than MAX_PACKET_COUNT
+        # we send successfully several packets if the size is bigger than max_words
         while packet_count > 0 or reads_pending > 0:
             # Make sure the transmit buffer stays saturated
             while packet_count > 0 and reads_pending < max_pending_reads:
-                cmd = []
-                cmd.append(COMMAND_ID['DAP_TRANSFER_BLOCK'])
-                cmd.append(dap_index)
-                packet_written = min(packet_count, MAX_PACKET_SIZE)
-                cmd.append(packet_written & 0xff)
-                cmd.append((packet_written >> 8) & 0xff)
-                cmd.append(request)
-                if not (request & ((1 << 1))):
-                    for i in range(packet_written):
-                        cmd.append(data[i + nb*MAX_PACKET_SIZE] & 0xff)
-                        cmd.append((data[i + nb*MAX_PACKET_SIZE] >> 8) & 0xff)
-                        cmd.append((data[i + nb*MAX_PACKET_SIZE] >> 16) & 0xff)
-                        cmd.append((data[i + nb*MAX_PACKET_SIZE] >> 24) & 0xff)
-                self.interface.write(cmd)
-                packet_count = packet_count - MAX_PACKET_SIZE
-                nb = nb + 1
+                packet_written = min(packet_count, max_words)
+                self.transferBlockSend(packet_written, request,
+                                       data[offset:offset + packet_written], dap_index)
+                packet_count = packet_count - packet_written
+                offset = offset + packet_written
                 reads_pending = reads_pending + 1
 
             # Read data
             if reads_pending > 0:
                 # we then read
-                tmp = self.interface.read()
+                tmp = self._read()
                 if tmp[0] != COMMAND_ID['DAP_TRANSFER_BLOCK']:
                     # Error occurred - abort further writes
                     # but make sure to finish reading remaining packets
@@ -296,9 +399,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append((clock >> 8) & 0xff)
         cmd.append((clock >> 16) & 0xff)
         cmd.append((clock >> 24) & 0xff)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_SWJ_CLOCK']:
                 raise ValueError('DAP_SWJ_CLOCK response error')
 
@@ -321,9 +424,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append((wait >> 8) & 0xff)
         cmd.append((wait >> 16) & 0xff)
         cmd.append((wait >> 24) & 0xff)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_SWJ_PINS']:
                 raise ValueError('DAP_SWJ_PINS response error')
 
@@ -333,9 +436,9 @@ class CMSIS_DAP_Protocol(object):
         cmd = []
         cmd.append(COMMAND_ID['DAP_SWD_CONFIGURE'])
         cmd.append(conf)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_SWD_CONFIGURE']:
                 raise ValueError('DAP_SWD_CONFIGURE response error')
 
@@ -350,9 +453,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append(len(data)*8)
         for i in range(len(data)):
             cmd.append(data[i])
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_SWJ_SEQUENCE']:
                 raise ValueError('DAP_SWJ_SEQUENCE response error')
 
@@ -367,9 +470,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append(1)
         cmd.append(info)
         cmd.append(tdi)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_JTAG_SEQUENCE']:
             raise ValueError('DAP_JTAG_SEQUENCE response error')
 
@@ -383,9 +486,9 @@ class CMSIS_DAP_Protocol(object):
         cmd.append(COMMAND_ID['DAP_JTAG_CONFIGURE'])
         cmd.append(dev_num)
         cmd.append(irlen)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_JTAG_CONFIGURE']:
             raise ValueError('DAP_JTAG_CONFIGURE response error')
 
@@ -398,9 +501,9 @@ class CMSIS_DAP_Protocol(object):
         cmd = []
         cmd.append(COMMAND_ID['DAP_JTAG_IDCODE'])
         cmd.append(index)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
         if resp[0] != COMMAND_ID['DAP_JTAG_IDCODE']:
             raise ValueError('DAP_JTAG_IDCODE response error')
 
@@ -415,9 +518,9 @@ class CMSIS_DAP_Protocol(object):
     def vendor(self, index):
         cmd = []
         cmd.append(COMMAND_ID['DAP_VENDOR0'] + index)
-        self.interface.write(cmd)
+        self._write(cmd)
 
-        resp = self.interface.read()
+        resp = self._read()
 
         if resp[0] != COMMAND_ID['DAP_VENDOR0'] + index:
             raise ValueError('DAP_VENDOR response error')
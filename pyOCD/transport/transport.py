@@ -26,10 +26,15 @@ READ_END = 3
 class TransferError(ValueError):
     pass
 
+## @brief A value-match read finished without the value matching.
+class ValueMismatchError(ValueError):
+    pass
+
 class Transport(object):
 
     def __init__(self, interface):
         self.interface = interface
+        self.deferred_transfer = False
         return
 
     def init(self):
@@ -65,6 +70,34 @@ class Transport(object):
     def readBlock32(self, addr, data):
         return
 
+    def writeMemAsync(self, addr, data, transfer_size = 32):
+        return
+
+    def readMemAsync(self, addr, transfer_size = 32):
+        return
+
+    def writeBlock32Async(self, addr, data):
+        return
+
+    def readBlock32Async(self, addr, size, as_bytes = False):
+        return
+
+    def getMemoryBurstSize(self):
+        return 0
+
+    def getStatistics(self):
+        return {}
+
+    def resetStatistics(self):
+        return
+
+    def waitForMatch(self, addr, mask, value, retry = 0):
+        """
+        Return True if (word at addr & mask) == value. Transports that
+        can have the probe repeat the read do so up to retry more times.
+        """
+        return (self.readMem(addr) & mask) == value
+
     def assertReset(self, asserted):
         return
 
@@ -21,24 +21,22 @@ import binascii
 
 def byteListToU32leList(data):
     """Convert a list of bytes to a list of 32-bit integers (little endian)"""
-    res = []
-    for i in range(len(data) / 4):
-        res.append(data[i * 4 + 0] |
-                   data[i * 4 + 1] << 8 |
-                   data[i * 4 + 2] << 16 |
-                   data[i * 4 + 3] << 24)
-    return res
+    return bytesToU32leList(bytearray(data[:len(data) & ~0x03]))
 
 
 def u32leListToByteList(data):
     """Convert a word array into a byte array"""
-    res = []
-    for x in data:
-        res.append((x >> 0) & 0xff)
-        res.append((x >> 8) & 0xff)
-        res.append((x >> 16) & 0xff)
-        res.append((x >> 24) & 0xff)
-    return res
+    return list(u32leListToBytes([x & 0xffffffff for x in data]))
+
+
+def bytesToU32leList(data):
+    """Convert little endian bytes (str, bytearray or memoryview) to a list of 32-bit integers"""
+    return list(struct.unpack_from('<%dI' % (len(data) // 4), data))
+
+
+def u32leListToBytes(data):
+    """Convert a list of 32-bit integers to a little endian bytearray"""
+    return bytearray(struct.pack('<%dI' % len(data), *data))
 
 
 def u16leListToByteList(data):
@@ -98,5 +96,6 @@ def hexDecode(cmd):
     return binascii.unhexlify(cmd)
 
 
-def hexEncode(string):
-    return binascii.hexlify(string)
+def hexEncode(data):
+    """Convert binary data (str or bytearray) to a hex string"""
+    return binascii.hexlify(bytes(data))
@@ -0,0 +1,124 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import collections
+import functools
+from time import time
+
+## @brief Histogram with power of two buckets.
+#
+# A value v is counted in the smallest bucket b, a power of two, with v < b.
+# Values below 1 are counted in bucket 1.
+class Histogram(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = collections.defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.buckets[1 << int(value).bit_length() if value >= 1 else 1] += 1
+
+    def getStatistics(self):
+        return {
+            'count' : self.count,
+            'total' : self.total,
+            'min' : self.min,
+            'max' : self.max,
+            'mean' : float(self.total) / self.count if self.count else None,
+            'buckets' : dict(self.buckets),
+            }
+
+## @brief Named counters and histograms of one layer of the debugger.
+#
+# Recording is a dictionary update, cheap enough to leave enabled on every
+# USB packet and every target API call.
+class Statistics(object):
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+
+    def increment(self, name, count = 1):
+        self.counters[name] += count
+
+    def record(self, name, value):
+        self.histograms[name].add(value)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def getStatistics(self):
+        """
+        Return a dict of the counters and, under 'histograms', a dict of
+        the statistics of each histogram.
+        """
+        stats = dict(self.counters)
+        stats['histograms'] = dict((name, histogram.getStatistics())
+                                   for name, histogram in self.histograms.items())
+        return stats
+
+def timed(name):
+    """
+    Decorator recording the latency of a method, in microseconds, in the
+    histogram name of the object's stats attribute.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            start = time()
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.stats.record(name, (time() - start) * 1000000)
+        return wrapper
+    return decorator
+
+def formatStatistics(stats, indent = ''):
+    """
+    Return a list of text lines describing a nested statistics dict.
+    """
+    lines = []
+    for name in sorted(stats.keys()):
+        value = stats[name]
+        if isinstance(value, dict) and 'buckets' in value:
+            if not value['count']:
+                continue
+            lines.append("%s%s: count=%d mean=%.1f min=%.1f max=%.1f" % (indent, name,
+                         value['count'], value['mean'], value['min'], value['max']))
+            for bucket in sorted(value['buckets'].keys()):
+                lines.append("%s    <%-8d %d" % (indent, bucket, value['buckets'][bucket]))
+        elif isinstance(value, dict):
+            sublines = formatStatistics(value, indent + '  ')
+            if sublines:
+                lines.append("%s%s:" % (indent, name))
+                lines.extend(sublines)
+        elif isinstance(value, float):
+            lines.append("%s%s: %.6f" % (indent, name, value))
+        else:
+            lines.append("%s%s: %s" % (indent, name, value))
+    return lines
@@ -0,0 +1,454 @@
+"""
+ mbed CMSIS-DAP debugger
+ Copyright (c) 2015 ARM Limited
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os, sys
+import argparse
+import json
+import logging
+import socket
+from time import sleep, time
+from random import Random
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+import pyOCD
+from pyOCD.board import MbedBoard
+from pyOCD.interface.sim_backend import SimulatedCMSISDAP, SIM_TARGETS, DEFAULT_SIM_TARGET
+from pyOCD.gdbserver import GDBServer
+from pyOCD.gdbserver import rsp
+from pyOCD.utility.conversion import hexDecode
+from pyOCD.gdbserver.halt_watch import HALT_WATCH
+from pyOCD.target.target import TARGET_HALTED
+
+## Default bytes of RAM and flash used by each memory benchmark.
+DEFAULT_RAM_SIZE = 0x4000
+DEFAULT_FLASH_SIZE = 0x4000
+
+## Each measurement is repeated this many times and the best run is kept.
+DEFAULT_REPEAT = 3
+
+## Default allowed regression against a baseline, in percent.
+DEFAULT_THRESHOLD = 10.0
+
+## Operations timed by each register, step and halt benchmark.
+OPERATION_COUNT = 50
+
+## Registers read by the register batch benchmark.
+REGISTER_BATCH = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7', 'r8', 'r9',
+                  'r10', 'r11', 'r12', 'sp', 'lr', 'pc', 'xpsr']
+
+THUMB_NOP = 0xbf00
+THUMB_BKPT = 0xbe00
+
+# Units of the results. Throughput is better when higher, latency when lower.
+UNIT_BYTES_PER_SECOND = 'B/s'
+UNIT_OPS_PER_SECOND = 'ops/s'
+UNIT_MICROSECONDS = 'us'
+HIGHER_IS_BETTER = {
+    UNIT_BYTES_PER_SECOND : True,
+    UNIT_OPS_PER_SECOND : True,
+    UNIT_MICROSECONDS : False,
+    }
+
+class BenchmarkError(Exception):
+    pass
+
+## @brief Minimal GDB client used to time the server's memory packets.
+class GDBClient(object):
+    def __init__(self, port, timeout = 10.0):
+        deadline = time() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(('localhost', port))
+                break
+            except socket.error:
+                if time() > deadline:
+                    raise
+                sleep(0.05)
+        self.sock.settimeout(timeout)
+        self.buffer = ''
+
+    def command(self, data):
+        """
+        Send a packet and return the payload of the reply.
+        """
+        self.sock.sendall(rsp.createPacket(data))
+        while True:
+            found = rsp.findPacket(self.buffer)
+            if found is not None:
+                break
+            data = self.sock.recv(0x10000)
+            if not data:
+                raise BenchmarkError("GDB server closed the connection")
+            self.buffer += data
+        begin, end = found
+        packet = self.buffer[begin:end]
+        self.buffer = self.buffer[end:]
+        self.sock.sendall('+')
+        return packet[1:-3]
+
+    def close(self):
+        self.sock.close()
+
+def _freePort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+## @brief Runs the benchmarks against an initialized board.
+#
+# RAM and flash ranges are taken from the target's memory map: the RAM
+# benchmarks use the start of the first RAM region and the flash benchmarks
+# the end of the first flash region, away from vector tables and
+# configuration fields. The flash benchmarks erase and program flash.
+class Benchmark(object):
+    def __init__(self, board, ram_size = DEFAULT_RAM_SIZE, flash_size = DEFAULT_FLASH_SIZE,
+                 repeat = DEFAULT_REPEAT, run_flash = True, run_gdb = True):
+        self.board = board
+        self.target = board.target
+        self.repeat = repeat
+        self.run_flash = run_flash
+        self.run_gdb = run_gdb
+        self.random = Random(0)
+        self.results = {}
+
+        memory_map = self.target.getMemoryMap()
+        if memory_map is None:
+            raise BenchmarkError("Target %s has no memory map" % self.target.part_number)
+        ram = [region for region in memory_map if region.isRam]
+        flash = [region for region in memory_map if region.isFlash]
+        if not ram:
+            raise BenchmarkError("No RAM region in the memory map")
+        self.ram_start = ram[0].start
+        self.ram_size = min(ram_size, ram[0].length) & ~3
+        self.flash_region = flash[0] if flash else None
+        if self.flash_region is not None:
+            size = min(flash_size, self.flash_region.length)
+            blocksize = self.flash_region.blocksize or 1
+            self.flash_size = (size + blocksize - 1) // blocksize * blocksize
+            self.flash_start = self.flash_region.end + 1 - self.flash_size
+
+    def _randomData(self, size):
+        return [self.random.randrange(0, 256) for _ in range(size)]
+
+    def _roundTrips(self):
+        stats = self.board.getStatistics()['transport'].get('protocol', {})
+        return stats.get('packets_written', 0)
+
+    def measure(self, name, unit, amount, function, setup = None):
+        """
+        Time function() and record the best of the repeated runs.
+
+        amount is the number of bytes or operations handled by one call of
+        function, or for a latency, the number of operations to average over.
+        """
+        best = None
+        round_trips = 0
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            trips = self._roundTrips()
+            start = time()
+            function()
+            elapsed = time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+                round_trips = self._roundTrips() - trips
+        best = max(best, 1e-9)
+        if unit == UNIT_MICROSECONDS:
+            value = best * 1000000 / amount
+        else:
+            value = amount / best
+        self.results[name] = {
+            'value' : value,
+            'unit' : unit,
+            'higher_is_better' : HIGHER_IS_BETTER[unit],
+            'round_trips' : round_trips,
+            }
+        logging.info("%-32s %14.1f %s (%d round trips)", name, value, unit, round_trips)
+
+    def run(self):
+        self.target.halt()
+        self.target.enableMemoryCache(False)
+        self.board.resetStatistics()
+        self.memoryBenchmarks()
+        self.coreBenchmarks()
+        self.haltBenchmarks()
+        if self.run_gdb:
+            self.gdbBenchmarks()
+        if self.run_flash and self.flash_region is not None:
+            self.flashBenchmarks()
+        return self.results
+
+    def memoryBenchmarks(self):
+        target = self.target
+        addr = self.ram_start
+        size = self.ram_size
+        words = [self.random.randrange(0, 1 << 32) for _ in range(size // 4)]
+        data = self._randomData(size - 2)
+
+        self.measure('ram_write_aligned', UNIT_BYTES_PER_SECOND, size,
+                     lambda: target.writeBlockMemoryAligned32(addr, words))
+        self.measure('ram_read_aligned', UNIT_BYTES_PER_SECOND, size,
+                     lambda: target.readBlockMemoryAligned32(addr, size // 4))
+        if target.readBlockMemoryAligned32(addr, size // 4) != words:
+            raise BenchmarkError("Aligned RAM readback mismatch")
+
+        self.measure('ram_write_unaligned', UNIT_BYTES_PER_SECOND, len(data),
+                     lambda: target.writeBlockMemoryUnaligned8(addr + 1, data))
+        self.measure('ram_read_unaligned', UNIT_BYTES_PER_SECOND, len(data),
+                     lambda: target.readBlockMemoryUnaligned8(addr + 1, len(data)))
+        if target.readBlockMemoryUnaligned8(addr + 1, len(data)) != data:
+            raise BenchmarkError("Unaligned RAM readback mismatch")
+
+        if self.flash_region is not None:
+            start = self.flash_region.start
+            size = min(self.ram_size, self.flash_region.length)
+            self.measure('flash_read', UNIT_BYTES_PER_SECOND, size,
+                         lambda: target.readBlockMemoryUnaligned8(start, size))
+
+    def _loadSled(self, count):
+        """
+        Write count Thumb NOPs followed by a BKPT at the start of RAM.
+        """
+        code = [THUMB_NOP] * count + [THUMB_BKPT]
+        data = []
+        for halfword in code:
+            data += [halfword & 0xff, halfword >> 8]
+        self.target.writeBlockMemoryUnaligned8(self.ram_start, data)
+        return self.ram_start + count * 2
+
+    def _setPC(self, pc):
+        self.target.writeCoreRegister('pc', pc)
+        self.target.writeCoreRegister('xpsr', 1 << 24)
+
+    def coreBenchmarks(self):
+        target = self.target
+
+        def readRegisters():
+            for _ in range(OPERATION_COUNT):
+                target.invalidateRegisterCache()
+                target.readCoreRegistersRaw(REGISTER_BATCH)
+        self.measure('register_batch_read', UNIT_OPS_PER_SECOND, OPERATION_COUNT, readRegisters)
+
+        self._loadSled(OPERATION_COUNT)
+
+        def step():
+            for _ in range(OPERATION_COUNT):
+                target.step()
+        self.measure('step', UNIT_OPS_PER_SECOND, OPERATION_COUNT, step,
+                     setup = lambda: self._setPC(self.ram_start))
+
+    def haltBenchmarks(self):
+        """
+        Time how long each halt watch takes to notice that the core halted.
+        The core is resumed at a BKPT, so it halts immediately.
+        """
+        target = self.target
+        bkpt = self._loadSled(0)
+        for name in sorted(HALT_WATCH.keys()):
+            watch = HALT_WATCH[name](target)
+
+            def resumeUntilHalted():
+                for _ in range(OPERATION_COUNT):
+                    target.resume()
+                    watch.start()
+                    deadline = time() + 5
+                    while True:
+                        sleep(watch.nextInterval())
+                        if watch.isHalted():
+                            break
+                        if time() > deadline:
+                            raise BenchmarkError("Core did not halt at the BKPT")
+            self.measure('halt_latency_' + name, UNIT_MICROSECONDS, OPERATION_COUNT,
+                         resumeUntilHalted, setup = lambda: self._setPC(bkpt))
+            target.halt()
+
+    def gdbBenchmarks(self):
+        """
+        Time GDB 'm', 'x' and 'X' memory packets through a GDB server on a
+        local socket.
+        """
+        port = _freePort()
+        options = {'telnet_port' : _freePort(), 'break_at_hardfault' : False}
+        server = GDBServer(self.board, port, options)
+        client = GDBClient(port)
+        try:
+            addr = self.ram_start
+            size = self.ram_size
+            chunk = server.packet_size // 2 - 16
+            data = ''.join(chr(b) for b in self._randomData(size))
+
+            def readHex():
+                for offset in range(0, size, chunk):
+                    n = min(chunk, size - offset)
+                    client.command('m%x,%x' % (addr + offset, n))
+
+            def readBinary():
+                for offset in range(0, size, chunk):
+                    n = min(chunk, size - offset)
+                    client.command('x%x,%x' % (addr + offset, n))
+
+            def writeBinary():
+                for offset in range(0, size, chunk):
+                    n = min(chunk, size - offset)
+                    payload = rsp.escape(data[offset:offset + n])
+                    if client.command('X%x,%x:%s' % (addr + offset, n, payload)) != 'OK':
+                        raise BenchmarkError("GDB 'X' packet failed")
+
+            self.measure('gdb_write_X', UNIT_BYTES_PER_SECOND, size, writeBinary)
+            self.measure('gdb_read_m', UNIT_BYTES_PER_SECOND, size, readHex)
+            self.measure('gdb_read_x', UNIT_BYTES_PER_SECOND, size, readBinary)
+            if hexDecode(client.command('m%x,%x' % (addr, 16))) != bytearray(data[:16]):
+                raise BenchmarkError("GDB readback mismatch")
+            client.command('D')
+        finally:
+            client.close()
+            server.join(10)
+        self.target.halt()
+
+    def flashBenchmarks(self):
+        flash = self.board.flash
+        addr = self.flash_start
+        size = self.flash_size
+        data = self._randomData(size)
+        # Every other sector changed
+        blocksize = self.flash_region.blocksize or size
+        changed = list(data)
+        for offset in range(0, size, blocksize * 2):
+            changed[offset] ^= 0xff
+
+        def program(data, **kwargs):
+            return lambda: flash.flashBlock(addr, data, **kwargs)
+
+        self.measure('flash_program_chip_erase', UNIT_BYTES_PER_SECOND, size,
+                     program(data, smart_flash = False, chip_erase = True))
+        self.measure('flash_program_sector_erase', UNIT_BYTES_PER_SECOND, size,
+                     program(data, smart_flash = False, chip_erase = False))
+        self.measure('flash_program_fast_verify', UNIT_BYTES_PER_SECOND, size,
+                     program(data, smart_flash = False, chip_erase = False, fast_verify = True))
+        self.measure('flash_program_unchanged', UNIT_BYTES_PER_SECOND, size,
+                     program(data, smart_flash = True, chip_erase = False))
+        self.measure('flash_program_half_changed', UNIT_BYTES_PER_SECOND, size,
+                     program(changed, smart_flash = True, chip_erase = False),
+                     setup = program(data, smart_flash = True, chip_erase = False))
+        if self.target.readBlockMemoryUnaligned8(addr, size) != changed:
+            raise BenchmarkError("Flash readback mismatch")
+
+def compareToBaseline(results, baseline, threshold = DEFAULT_THRESHOLD):
+    """
+    Compare results with the results of a baseline run.
+
+    The baseline may give per benchmark thresholds in percent under
+    'thresholds'. Returns a list of (name, baseline value, value, change in
+    percent, failed) tuples, where a positive change is an improvement.
+    """
+    thresholds = baseline.get('thresholds', {})
+    comparison = []
+    for name in sorted(results.keys()):
+        if name not in baseline.get('results', {}):
+            continue
+        base = baseline['results'][name]['value']
+        value = results[name]['value']
+        if base == 0:
+            continue
+        change = (value - base) * 100.0 / base
+        if not results[name]['higher_is_better']:
+            change = -change
+        failed = change < -thresholds.get(name, threshold)
+        comparison.append((name, base, value, change, failed))
+    return comparison
+
+def connectBoard(args):
+    if args.sim:
+        interface = SimulatedCMSISDAP(args.sim, latency = args.latency)
+        board = MbedBoard(interface, SIM_TARGETS[args.sim]['board_id'], interface.unique_id,
+                          frequency = args.frequency)
+        board.init()
+        return board
+    return MbedBoard.chooseBoard(board_id = args.board, target_override = args.target,
+                                 frequency = args.frequency)
+
+def main():
+    parser = argparse.ArgumentParser(description='pyOCD benchmark')
+    parser.add_argument('-b', '--board', metavar = 'ID', help = 'Unique ID of the board to use')
+    parser.add_argument('-t', '--target', help = 'Override the target type')
+    parser.add_argument('-s', '--sim', nargs = '?', const = DEFAULT_SIM_TARGET, choices = sorted(SIM_TARGETS.keys()),
+                        help = 'Use a simulated probe and target instead of a board (default %s)' % DEFAULT_SIM_TARGET)
+    parser.add_argument('-l', '--latency', type = float, default = 0.001,
+                        help = 'USB latency of the simulated probe in seconds (default 0.001)')
+    parser.add_argument('-f', '--frequency', type = int, default = 1000000, help = 'SWD clock frequency in Hz')
+    parser.add_argument('--ram-size', type = lambda x: int(x, 0), default = DEFAULT_RAM_SIZE,
+                        help = 'Bytes of RAM used by the memory benchmarks')
+    parser.add_argument('--flash-size', type = lambda x: int(x, 0), default = DEFAULT_FLASH_SIZE,
+                        help = 'Bytes of flash used by the flash benchmarks')
+    parser.add_argument('-r', '--repeat', type = int, default = DEFAULT_REPEAT,
+                        help = 'Runs of each measurement, the best is kept')
+    parser.add_argument('--no-flash', action = 'store_true', help = 'Skip the flash programming benchmarks')
+    parser.add_argument('--no-gdb', action = 'store_true', help = 'Skip the GDB server benchmarks')
+    parser.add_argument('-o', '--output', help = 'Write the results as JSON to this file')
+    parser.add_argument('--baseline', help = 'JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type = float, default = DEFAULT_THRESHOLD,
+                        help = 'Allowed regression against the baseline in percent')
+    parser.add_argument('-d', '--debug', action = 'store_true', help = 'Enable debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.debug else logging.INFO)
+
+    board = connectBoard(args)
+    try:
+        benchmark = Benchmark(board, args.ram_size, args.flash_size, args.repeat,
+                              run_flash = not args.no_flash, run_gdb = not args.no_gdb)
+        results = benchmark.run()
+        report = {
+            'version' : pyOCD.__version__,
+            'target' : board.getTargetType(),
+            'board_id' : board.getUniqueID(),
+            'interface' : board.interface.product_name,
+            'simulated' : bool(args.sim),
+            'config' : {
+                'latency' : args.latency if args.sim else None,
+                'frequency' : args.frequency,
+                'ram_size' : benchmark.ram_size,
+                'flash_size' : benchmark.flash_size if benchmark.flash_region else 0,
+                'repeat' : args.repeat,
+                },
+            'results' : results,
+            'statistics' : board.getStatistics(),
+            }
+    finally:
+        board.uninit(False)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("{:<32}{:>16}{:>16}{:>10}".format("Benchmark", "Baseline", "Result", "Change"))
+        for name, base, value, change, regressed in compareToBaseline(results, baseline, args.threshold):
+            print("{:<32}{:>16.1f}{:>16.1f}{:>9.1f}%{}".format(name, base, value, change,
+                  "  REGRESSION" if regressed else ""))
+            failed = failed or regressed
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
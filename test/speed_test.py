@@ -26,6 +26,7 @@ sys.path.insert(0, parentdir)
 
 import pyOCD
 from pyOCD.board import MbedBoard
+from pyOCD.transport.cmsis_dap import READ, WRITE, AP_ACC, AP_REG
 from test_util import Test, TestResult
 import logging
 
@@ -55,7 +56,7 @@ class SpeedTest(Test):
                 write_speed = "Fail"
                 usb_speed = "Fail"
                 usb_overlapped = "Fail"
-            print("{:<10}{:<16}{:<16}{:<16}{:<16}".format(result.board.target_type, read_speed, write_speed, usb_speed, usb_overlapped))
+            print("{:<10}{:<16}{:<16}{:<16}{:<16}".format(result.board.target_type, write_speed, read_speed, usb_speed, usb_overlapped))
         print("")
 
     def run(self, board):
@@ -163,7 +164,12 @@ def speed_test(board_id):
 
         print "\r\n\r\n------ TEST USB TRANSFER SPEED ------"
         max_packets = interface.getPacketCount()
-        data_to_write = [0x80] + [0x00] * 63
+        packet_size = interface.getPacketSize()
+        print("Packet size: %i bytes" % packet_size)
+        print("Words per block read: %i, block write: %i" % (
+                transport.protocol.getTransferBlockWordCount(READ | AP_ACC | AP_REG['DRW']),
+                transport.protocol.getTransferBlockWordCount(WRITE | AP_ACC | AP_REG['DRW'])))
+        data_to_write = [0x80] + [0x00] * (packet_size - 1)
         start = time()
         packet_count = USB_TEST_XFER_COUNT
         while packet_count > 0:
@@ -171,13 +177,13 @@ def speed_test(board_id):
                 interface.read()
                 packet_count = packet_count - 1
         stop = time()
-        result.usb_speed = USB_TEST_XFER_COUNT * 64 / (stop-start)
+        result.usb_speed = USB_TEST_XFER_COUNT * packet_size / (stop-start)
         print "USB transfer rate %f B/s" % result.usb_speed
 
         print "\r\n\r\n------ TEST OVERLAPPED USB TRANSFER SPEED ------"
         max_packets = interface.getPacketCount()
         print("Concurrent packets: %i" % max_packets)
-        data_to_write = [0x80] + [0x00] * 63
+        data_to_write = [0x80] + [0x00] * (packet_size - 1)
         start = time()
         packet_count = USB_TEST_XFER_COUNT
         reads_pending = 0
@@ -193,7 +199,7 @@ def speed_test(board_id):
                 interface.read()
                 reads_pending = reads_pending - 1
         stop = time()
-        result.usb_overlapped = USB_TEST_XFER_COUNT * 64 / (stop-start)
+        result.usb_overlapped = USB_TEST_XFER_COUNT * packet_size / (stop-start)
         print "USB transfer rate %f B/s" % result.usb_overlapped
 
         print "\r\n\r\n------ TEST RAM READ / WRITE SPEED ------"
@@ -216,7 +222,7 @@ def speed_test(board_id):
         for i in range(len(block)):
             if (block[i] != data[i]):
                 error = True
-                print "ERROR: 0x%X, 0x%X, 0x%X!!!" % ((addr + i), block[i], data[i])
+                print "ERROR: 0x%X, 0x%X, 0x%X!!!" % ((test_addr + i), block[i], data[i])
         if error:
             print "TEST FAILED"
         else: